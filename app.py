@@ -1,20 +1,39 @@
 import logging
 from logging.handlers import TimedRotatingFileHandler
-import threading, tempfile, time
-from datetime import datetime
+import threading, time
+import heapq, itertools, random
+import atexit
+import unicodedata
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from difflib import SequenceMatcher
 import os
 import re
+import signal
+import sys
 import json
+import sqlite3
 import base64
 import markdown
 import smtplib
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 from email.message import EmailMessage
 from email.utils import formatdate, make_msgid
 from flask import Flask, request
 from dotenv import load_dotenv
+try:
+    import websocket   # websocket-client — нужен только для JELLYFIN_WS_ENABLED
+except ImportError:
+    websocket = None
+try:
+    import fcntl       # блокировка файла лидера (Linux/macOS)
+except ImportError:
+    fcntl = None
+    import msvcrt      # то же на Windows
 
 load_dotenv()
 
@@ -40,7 +59,7 @@ logging.getLogger().addHandler(rotating_handler)
 state_directory = 'A:/notifierr'
 os.makedirs(state_directory, exist_ok=True)
 
-# Полный путь к season_counts.json (задаётся в коде, без переменных среды)
+# Старый season_counts.json — теперь только источник одноразового импорта в notifierr.db
 SEASON_COUNTS_FILE = os.path.join(state_directory, 'season_counts.json')
 
 
@@ -50,36 +69,97 @@ TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID", "").strip()
 JELLYFIN_BASE_URL = os.environ["JELLYFIN_BASE_URL"]
 JELLYFIN_API_KEY = os.environ["JELLYFIN_API_KEY"]
 MDBLIST_API_KEY = os.environ["MDBLIST_API_KEY"]
+MDBLIST_CACHE_TTL_SEC = float(os.getenv("MDBLIST_CACHE_TTL_SEC", "86400"))              # моложе — отдаём без запроса
+MDBLIST_CACHE_MAX_STALE_SEC = float(os.getenv("MDBLIST_CACHE_MAX_STALE_SEC", "2592000")) # старше TTL, но моложе — отдаём и обновляем в фоне
 TMDB_API_KEY = os.environ["TMDB_API_KEY"]
 TMDB_V3_BASE = "https://api.themoviedb.org/3"
 TMDB_TRAILER_LANG = os.getenv("TMDB_TRAILER_LANG", "en-US")  # пример: ru-RU, sv-SE, en-US
+TMDB_TRAILER_CACHE_TTL_SEC = float(os.getenv("TMDB_TRAILER_CACHE_TTL_SEC", "86400"))         # найденный трейлер помним сутки
+TMDB_TRAILER_CACHE_NEG_TTL_SEC = float(os.getenv("TMDB_TRAILER_CACHE_NEG_TTL_SEC", "21600")) # «трейлера нет» — 6 часов
+TMDB_TRAILER_CACHE_SIZE = int(os.getenv("TMDB_TRAILER_CACHE_SIZE", "2000"))                  # LRU-предел записей
 INCLUDE_MEDIA_TECH_INFO = os.getenv("INCLUDE_MEDIA_TECH_INFO", "true").strip().lower() in ("1","true","yes","y","on")
 EPISODE_MSG_MIN_GAP_SEC = int(os.getenv("EPISODE_MSG_MIN_GAP_SEC", "0"))  # анти-спам: минимум N секунд между сообщениями по сезону
+EPISODE_COALESCE_QUIET_SEC = float(os.getenv("EPISODE_COALESCE_QUIET_SEC", "15"))        # пачка серий сезона: ждём N сек тишины (0 — выкл.)
+EPISODE_COALESCE_MAX_HOLD_SEC = float(os.getenv("EPISODE_COALESCE_MAX_HOLD_SEC", "120")) # но держим не дольше N сек от первой серии
 JELLYFIN_USER_ID = os.getenv("JELLYFIN_USER_ID")  # опционально; если не задан, определим автоматически по токену
 LANGUAGE = os.getenv("LANGUAGE", "ru").lower()
 
 # --- RADARR quality-upgrade tracking ---
 RADARR_ENABLED = os.getenv("RADARR_ENABLED", "0").lower() in ("1","true","yes","on")
 RADARR_WEBHOOK_SECRET = os.getenv("RADARR_WEBHOOK_SECRET", "").strip()  # опционально; передаём ?secret=...
-RADARR_PENDING_FILE = os.getenv("RADARR_PENDING_FILE", os.path.join(state_directory, "radarr_pending.json"))
+RADARR_PENDING_FILE = os.getenv("RADARR_PENDING_FILE", os.path.join(state_directory, "radarr_pending.json"))  # только для импорта в notifierr.db
 RADARR_RECHECK_AFTER_SEC = int(os.getenv("RADARR_RECHECK_AFTER_SEC", "120"))  # через сколько проверить (по умолчанию 5 мин)
-RADARR_SCAN_PERIOD_SEC = int(os.getenv("RADARR_SCAN_PERIOD_SEC", "60"))      # период тика воркера
+RADARR_SCAN_PERIOD_SEC = int(os.getenv("RADARR_SCAN_PERIOD_SEC", "60"))      # пауза воркера после ошибки прохода
 
-RADARR_JSON_LOCK = threading.Lock()
 # Если вдруг у Radarr нет tmdbId, можно разрешить фолбэк на IMDb:
 RADARR_USE_IMDB_FALLBACK = os.getenv("RADARR_USE_IMDB_FALLBACK", "1").lower() in ("1","true","yes","on")
 
 # --- SONARR quality-upgrade tracking ---
 SONARR_ENABLED = os.getenv("SONARR_ENABLED", "0").lower() in ("1","true","yes","on")
 SONARR_WEBHOOK_SECRET = os.getenv("SONARR_WEBHOOK_SECRET", "").strip()  # опционально (?secret=...)
-SONARR_PENDING_FILE = os.getenv("SONARR_PENDING_FILE", os.path.join(state_directory, "sonarr_pending.json"))
+SONARR_PENDING_FILE = os.getenv("SONARR_PENDING_FILE", os.path.join(state_directory, "sonarr_pending.json"))  # только для импорта в notifierr.db
 SONARR_RECHECK_AFTER_SEC = int(os.getenv("SONARR_RECHECK_AFTER_SEC", "300"))  # интервал переопроса
-SONARR_SCAN_PERIOD_SEC  = int(os.getenv("SONARR_SCAN_PERIOD_SEC",  "15"))    # период тика воркера
+SONARR_SCAN_PERIOD_SEC  = int(os.getenv("SONARR_SCAN_PERIOD_SEC",  "15"))    # пауза воркера после ошибки прохода
+
+# — Перепроверка ожидающих записей по событиям Jellyfin (вместо частого опроса) —
+PENDING_EVENT_WAKE = os.getenv("PENDING_EVENT_WAKE", "1").lower() in ("1","true","yes","on")   # событие Jellyfin по фильму/сезону будит запись
+PENDING_WAKE_DELAY_SEC = float(os.getenv("PENDING_WAKE_DELAY_SEC", "10"))                    # даём Jellyfin дочитать MediaStreams
+RADARR_SAFETY_RECHECK_SEC = int(os.getenv("RADARR_SAFETY_RECHECK_SEC", "1800"))  # страховочный опрос, если события не было
+SONARR_SAFETY_RECHECK_SEC = int(os.getenv("SONARR_SAFETY_RECHECK_SEC", "1800"))
+# «ждём, пока Jellyfin подхватит файл»: с событиями — редкий страховочный опрос, без них — как раньше
+RADARR_IDLE_RECHECK_SEC = RADARR_SAFETY_RECHECK_SEC if PENDING_EVENT_WAKE else RADARR_RECHECK_AFTER_SEC
+SONARR_IDLE_RECHECK_SEC = SONARR_SAFETY_RECHECK_SEC if PENDING_EVENT_WAKE else SONARR_RECHECK_AFTER_SEC
+
+# — Сколько и как долго ждать апгрейд, который так и не случился —
+PENDING_BACKOFF_MAX_SEC = float(os.getenv("PENDING_BACKOFF_MAX_SEC", "21600"))   # потолок интервала перепроверки (удваивается с каждой пустой)
+PENDING_BACKOFF_JITTER = float(os.getenv("PENDING_BACKOFF_JITTER", "0.2"))       # ±20% — чтобы записи не проверялись пачкой
+PENDING_MAX_AGE_SEC = float(os.getenv("PENDING_MAX_AGE_SEC", "1209600"))         # старше (по умолчанию 14 дней) — истекла
+PENDING_EXPIRED_ACTION = os.getenv("PENDING_EXPIRED_ACTION", "park").strip().lower()  # park — без опроса, но будится событием Jellyfin; drop — удалить
+PENDING_MAX_CONCURRENCY = int(os.getenv("PENDING_MAX_CONCURRENCY", "4"))  # сколько созревших записей Radarr+Sonarr проверяются одновременно (нагрузка на Jellyfin)
+
+# — Индекс Series/Movie по внешним ID (для Radarr/Sonarr) —
+PROVIDER_INDEX_DELTA_SEC = float(os.getenv("PROVIDER_INDEX_DELTA_SEC", "120"))  # не чаще раза в N сек спрашиваем изменения (MinDateLastSaved)
+
+# — Jellyfin WebSocket (/socket) вместо/в дополнение к Webhook-плагину —
+JELLYFIN_WS_ENABLED = os.getenv("JELLYFIN_WS_ENABLED", "0").lower() in ("1","true","yes","on")
+JELLYFIN_WS_URL = os.getenv("JELLYFIN_WS_URL", "").strip()                               # по умолчанию ws(s)://<JELLYFIN_BASE_URL>/socket?api_key=...
+JELLYFIN_WS_PROCESS_DELAY_SEC = float(os.getenv("JELLYFIN_WS_PROCESS_DELAY_SEC", "30"))  # ждём, пока Jellyfin дочитает метаданные
+JELLYFIN_WS_BACKOFF_MAX_SEC = float(os.getenv("JELLYFIN_WS_BACKOFF_MAX_SEC", "300"))     # потолок паузы между переподключениями
+ANNOUNCED_ITEMS_TTL_SEC = float(os.getenv("ANNOUNCED_ITEMS_TTL_SEC", "86400"))            # один элемент (webhook, socket, догонялка) объявляем один раз — отметки в notifierr.db
+
+# — Догоняем то, что Jellyfin добавил, пока уведомлялка была выключена —
+CATCHUP_ON_START = os.getenv("CATCHUP_ON_START", "1").lower() in ("1","true","yes","on")
+CATCHUP_HEARTBEAT_SEC = float(os.getenv("CATCHUP_HEARTBEAT_SEC", "60"))     # как часто отмечаем «до этого момента всё слышали»
+CATCHUP_OVERLAP_SEC = float(os.getenv("CATCHUP_OVERLAP_SEC", "120"))        # запас назад: вебхук приходит позже DateCreated
+CATCHUP_MAX_ITEMS = int(os.getenv("CATCHUP_MAX_ITEMS", "1000"))             # не больше стольких (самых свежих) элементов
+CATCHUP_BATCH_SIZE = int(os.getenv("CATCHUP_BATCH_SIZE", "20"))             # элементов в одной пачке очереди
+CATCHUP_BATCH_INTERVAL_SEC = float(os.getenv("CATCHUP_BATCH_INTERVAL_SEC", "15"))  # пачки разносятся во времени, а не валятся разом
 
 # — Автозаполнение season_counts.json при старте —
 SEASON_COUNTS_PRIME_ON_START = os.getenv("SEASON_COUNTS_PRIME_ON_START", "0").lower() in ("1","true","yes","on")
-SEASON_COUNTS_PRIME_PAGE_SIZE = int(os.getenv("SEASON_COUNTS_PRIME_PAGE_SIZE", "100"))  # пачка сериалов за проход
-SEASON_COUNTS_PRIME_SAVE_SEC  = float(os.getenv("SEASON_COUNTS_PRIME_SAVE_SEC", "3"))   # как часто сохранять json в процессе
+SEASON_COUNTS_PRIME_PAGE_SIZE = int(os.getenv("SEASON_COUNTS_PRIME_PAGE_SIZE", "2000"))  # эпизодов за один запрос
+SEASON_COUNTS_PRIME_LOG_SEC   = float(os.getenv("SEASON_COUNTS_PRIME_LOG_SEC", "10"))    # как часто писать прогресс в лог
+SEASON_COUNTS_PRIME_CONCURRENCY = int(os.getenv("SEASON_COUNTS_PRIME_CONCURRENCY", "2"))  # страниц запрашиваем одновременно (щадим Jellyfin)
+# — Сверка season_counts с Jellyfin по изменениям (MinDateLastSaved) —
+SEASON_COUNTS_RECONCILE_SEC = float(os.getenv("SEASON_COUNTS_RECONCILE_SEC", "900"))          # период сверки, 0 — выключено
+SEASON_COUNTS_RECONCILE_SETTLE_SEC = float(os.getenv("SEASON_COUNTS_RECONCILE_SETTLE_SEC", "600"))  # свежие серии не трогаем: их объявит Episode-вебхук
+# — Запись season_counts на диск в фоне (write-behind) —
+SEASON_COUNTS_FLUSH_SEC = float(os.getenv("SEASON_COUNTS_FLUSH_SEC", "2"))                # как часто сбрасывать изменённые сезоны
+SEASON_COUNTS_FLUSH_MAX_DIRTY = int(os.getenv("SEASON_COUNTS_FLUSH_MAX_DIRTY", "200"))    # столько накопилось — сбрасываем сразу
+
+# — Состояние и очередь входящих вебхуков (SQLite в state_directory) —
+STATE_DB_FILE = os.path.join(state_directory, "notifierr.db")
+EVENT_QUEUE_ENABLED = os.getenv("EVENT_QUEUE_ENABLED", "1").lower() in ("1","true","yes","on")  # 0 = обрабатывать прямо в запросе
+EVENT_QUEUE_WORKERS = int(os.getenv("EVENT_QUEUE_WORKERS", "2"))                  # сколько событий обрабатываем параллельно
+EVENT_QUEUE_MAX_ATTEMPTS = int(os.getenv("EVENT_QUEUE_MAX_ATTEMPTS", "5"))        # после стольких неудач — в dead-letter
+EVENT_QUEUE_RETRY_BASE_SEC = float(os.getenv("EVENT_QUEUE_RETRY_BASE_SEC", "30")) # пауза перед повтором (удваивается)
+EVENT_QUEUE_LEASE_SEC = float(os.getenv("EVENT_QUEUE_LEASE_SEC", "600"))          # «зависшее» в обработке событие выдаём заново
+EVENT_QUEUE_ADMIN_SECRET = os.getenv("EVENT_QUEUE_ADMIN_SECRET", "").strip()      # опционально (?secret=...) для /queue/* и /index/rebuild
+
+# — Несколько процессов (gunicorn -w N, в т.ч. --preload): фоновые циклы крутит только один — лидер;
+#   под gunicorn выборы проходят в каждом воркере после fork (хук в gunicorn.conf.py) —
+LEADER_LOCK_FILE = os.path.join(state_directory, "notifierr.leader.lock")
+LEADER_RETRY_SEC = float(os.getenv("LEADER_RETRY_SEC", "5"))   # как часто остальные процессы пробуют занять место лидера
 
 
 
@@ -186,6 +266,19 @@ SYNOCHAT_RETRIES = int(os.getenv("SYNOCHAT_RETRIES", "3"))
 SYNOCHAT_RETRY_BASE_DELAY = float(os.getenv("SYNOCHAT_RETRY_BASE_DELAY", "0.8"))
 SYNOCHAT_RETRY_BACKOFF = float(os.getenv("SYNOCHAT_RETRY_BACKOFF", "1.7"))
 
+# ----- Параллельная рассылка по каналам -----
+NOTIFY_MAX_WORKERS  = int(os.getenv("NOTIFY_MAX_WORKERS", "8"))       # сколько каналов отправляем одновременно
+NOTIFY_DEADLINE_SEC = float(os.getenv("NOTIFY_DEADLINE_SEC", "60"))   # дольше не ждём — отвечаем, отправка доживает в фоне
+
+# ----- HTTP: keep-alive пулы соединений -----
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))                   # соединений на один upstream-хост
+HTTP_POOL_SIZES = os.getenv("HTTP_POOL_SIZES", "")                              # переопределения: "jellyfin.local=20,api.telegram.org=4"
+HTTP_DEFAULT_TIMEOUT_SEC = float(os.getenv("HTTP_DEFAULT_TIMEOUT_SEC", "30"))   # если вызов не задал свой timeout
+
+# ----- Обогащение уведомлений (рейтинги, трейлер, техблок…) -----
+ENRICH_MAX_WORKERS  = int(os.getenv("ENRICH_MAX_WORKERS", "8"))       # сколько запросов обогащения идут одновременно
+ENRICH_DEADLINE_SEC = float(os.getenv("ENRICH_DEADLINE_SEC", "45"))   # дольше не ждём — шлём без недособранных блоков
+
 # ----- External image host (optional) -----
 IMGBB_API_KEY = os.getenv("IMGBB_API_KEY", "").strip()
 imgbb_upload_done = threading.Event()   # Сигнал о завершении загрузки
@@ -193,61 +286,378 @@ uploaded_image_url = None               # Здесь хранится ссылк
 
 
 
-def fetch_mdblist_ratings(content_type: str, tmdb_id: str) -> str:
+#HTTP-клиент: по одной keep-alive сессии (пулу соединений) на каждый upstream
+class PooledHttpClient:
     """
-    Запрос к https://api.mdblist.com/tmdb/{type}/{tmdbId}
-    и формирование текста с найденными рейтингами.
-    Возвращает строку вида:
-      "- IMDb: 7.8\n- Rotten Tomatoes: 84%\n…"
-    или пустую строку при ошибке/отсутствии данных.
+    Повторяет API requests.get/post/put/head, но держит отдельную requests.Session
+    на каждый хост (Jellyfin, TMDb, MDBList, Telegram, …), чтобы не платить TCP+TLS
+    рукопожатием за каждый вызов. Считает запросы и реально открытые соединения.
+    """
+
+    def __init__(self, pool_maxsize: int, default_timeout: float, overrides: dict | None = None):
+        self.pool_maxsize = pool_maxsize
+        self.default_timeout = default_timeout
+        self.overrides = overrides or {}
+        self._sessions: dict[str, requests.Session] = {}
+        self._requests: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _session(self, url: str) -> tuple[str, requests.Session]:
+        parts = urlsplit(url)
+        host = parts.netloc.lower()
+        with self._lock:
+            s = self._sessions.get(host)
+            if s is None:
+                size = int(self.overrides.get(parts.hostname or host, self.pool_maxsize))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, size))
+                s = requests.Session()
+                s.mount("http://", adapter)
+                s.mount("https://", adapter)
+                self._sessions[host] = s
+                self._requests[host] = 0
+            self._requests[host] += 1
+        return host, s
+
+    def request(self, method: str, url: str, **kwargs):
+        kwargs.setdefault("timeout", self.default_timeout)
+        _, s = self._session(url)
+        return s.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        kwargs.setdefault("allow_redirects", True)
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def head(self, url: str, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def stats(self) -> dict:
+        """{host: {"requests": N, "connections": M, "reused": N - M}} — насколько работает keep-alive."""
+        out = {}
+        with self._lock:
+            items = list(self._sessions.items())
+            counts = dict(self._requests)
+        for host, s in items:
+            opened = 0
+            # один и тот же адаптер смонтирован на http:// и https:// — считаем его один раз
+            for adapter in {id(a): a for a in s.adapters.values()}.values():
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is not None:
+                        opened += int(getattr(pool, "num_connections", 0))
+            total = counts.get(host, 0)
+            out[host] = {"requests": total, "connections": opened, "reused": max(0, total - opened)}
+        return out
+
+
+def _parse_pool_overrides(raw: str) -> dict:
+    """'jellyfin.local=20, api.telegram.org=4' -> {'jellyfin.local': 20, 'api.telegram.org': 4}"""
+    out = {}
+    for part in re.split(r"[,\s]+", raw or ""):
+        host, _, size = part.partition("=")
+        if host and size.strip().isdigit():
+            out[host.strip().lower()] = int(size)
+    return out
+
+
+http_client = PooledHttpClient(
+    pool_maxsize=HTTP_POOL_MAXSIZE,
+    default_timeout=HTTP_DEFAULT_TIMEOUT_SEC,
+    overrides=_parse_pool_overrides(HTTP_POOL_SIZES),
+)
+
+
+#In-process кэш с TTL
+class TTLCache:
     """
+    Потокобезопасный кэш «ключ → значение» со сроком жизни записей и LRU-вытеснением.
+    None — тоже значение («ничего не нашли»): такие ответы живут negative_ttl секунд,
+    чтобы не переспрашивать внешний API на каждом уведомлении.
+    """
+    MISSING = object()   # get(key, TTLCache.MISSING) — отличить «нет записи» от сохранённого None
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float | None = None):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl = float(ttl)
+        self.negative_ttl = float(ttl if negative_ttl is None else negative_ttl)
+        self._data: OrderedDict = OrderedDict()   # key -> (expires_ts, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is not None and rec[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return rec[1]
+            if rec is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, ttl: float | None = None) -> None:
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def add(self, key, value=True, ttl: float | None = None) -> bool:
+        """Атомарно положить значение, только если живой записи ещё нет. True — положили."""
+        if ttl is None:
+            ttl = self.negative_ttl if value is None else self.ttl
+        now = time.monotonic()
+        with self._lock:
+            rec = self._data.get(key)
+            if rec is not None and rec[0] > now:
+                return False
+            self._data[key] = (now + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            return True
+
+    def discard(self, key) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+#Обогащение уведомлений: граф независимых запросов (TMDb, MDBList, Jellyfin…)
+_enrich_executor = ThreadPoolExecutor(max_workers=max(1, ENRICH_MAX_WORKERS), thread_name_prefix="enrich")
+# Отдельный пул для проверки созревших записей Radarr/Sonarr: общий на оба воркера, так что одновременно
+# к Jellyfin ходят не больше PENDING_MAX_CONCURRENCY записей. Их обогащение уходит в _enrich_executor.
+_pending_executor = ThreadPoolExecutor(max_workers=max(1, PENDING_MAX_CONCURRENCY), thread_name_prefix="pending")
+_enrich_stats: dict = {}   # "label.step" -> {"count", "errors", "total_sec", "max_sec"}
+_enrich_stats_lock = threading.Lock()
+
+
+class EnrichmentStage:
+    """
+    Набор шагов обогащения с зависимостями между ними.
+      stage.add("series", lambda season: get_item_details(...), deps=("season",))
+    Шаг получает результаты своих зависимостей именованными аргументами и стартует, как только
+    они готовы; независимые шаги идут параллельно в общем пуле _enrich_executor.
+    Ошибка обычного шага — лог + default, зависимые шаги получат этот default.
+    Ошибка шага с required=True пробрасывается из run() (очередь событий повторит попытку);
+    если к дедлайну такой шаг ещё не готов — run() бросает TimeoutError, default получают только обычные шаги.
+    Время каждого шага — в stage.timings и в счётчиках /stats.
+    """
+
+    def __init__(self, label: str):
+        self.label = label
+        self._steps: dict = {}   # name -> (fn, deps, default, required)
+        self.results: dict = {}
+        self.timings: dict = {}
+        self.errors: dict = {}
+
+    def add(self, name: str, fn, deps: tuple = (), default=None, required: bool = False) -> "EnrichmentStage":
+        for d in deps:
+            if d not in self._steps:
+                raise ValueError(f"{self.label}: step {name} depends on unknown step {d}")
+        self._steps[name] = (fn, tuple(deps), default, required)
+        return self
+
+    @staticmethod
+    def _timed(fn, kwargs: dict):
+        started = time.monotonic()
+        try:
+            return fn(**kwargs), None, time.monotonic() - started
+        except Exception as ex:
+            return None, ex, time.monotonic() - started
+
+    def run(self, deadline_sec: float | None = None) -> dict:
+        deadline = time.monotonic() + (ENRICH_DEADLINE_SEC if deadline_sec is None else deadline_sec)
+        waiting = dict(self._steps)
+        running = {}   # future -> name
+        started = time.monotonic()
+        try:
+            while waiting or running:
+                for name, (fn, deps, _, _) in list(waiting.items()):
+                    if all(d in self.results for d in deps):
+                        del waiting[name]
+                        kwargs = {d: self.results[d] for d in deps}
+                        running[_enrich_executor.submit(self._timed, fn, kwargs)] = name
+                if not running:
+                    break
+                done, _ = wait(running, timeout=max(0.0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+                if not done:
+                    unfinished = set(running.values()) | set(waiting)
+                    missing = sorted(n for n in unfinished if self._steps[n][3])
+                    if missing:
+                        raise TimeoutError(f"Enrichment {self.label}: deadline exceeded, "
+                                           f"required step(s) not finished: {', '.join(missing)}")
+                    logging.warning(f"Enrichment {self.label}: deadline exceeded, skipping: "
+                                    f"{', '.join(sorted(unfinished))}")
+                    break
+                for fut in done:
+                    name = running.pop(fut)
+                    _, _, default, required = self._steps[name]
+                    value, error, elapsed = fut.result()
+                    self.timings[name] = round(elapsed, 3)
+                    self._record(name, elapsed, error)
+                    if error is not None:
+                        self.errors[name] = error
+                        if required:
+                            raise error
+                        logging.warning(f"Enrichment {self.label}: step {name} failed: {error}")
+                        value = default
+                    self.results[name] = value
+        finally:
+            # недоделанные необязательные шаги (дедлайн/ошибка) — default, чтобы сборка сообщения не падала
+            for name, (_, _, default, required) in self._steps.items():
+                if not required:
+                    self.results.setdefault(name, default)
+        logging.debug(f"Enrichment {self.label}: {round(time.monotonic() - started, 3)}s, steps {self.timings}")
+        return self.results
+
+    def _record(self, name: str, elapsed: float, error) -> None:
+        key = f"{self.label}.{name}"
+        with _enrich_stats_lock:
+            st = _enrich_stats.setdefault(key, {"count": 0, "errors": 0, "total_sec": 0.0, "max_sec": 0.0})
+            st["count"] += 1
+            st["errors"] += 1 if error is not None else 0
+            st["total_sec"] = round(st["total_sec"] + elapsed, 3)
+            st["max_sec"] = round(max(st["max_sec"], elapsed), 3)
+
+
+def enrichment_stats() -> dict:
+    with _enrich_stats_lock:
+        return {k: dict(v) for k, v in _enrich_stats.items()}
+
+
+#MDBList: кэш ответов в notifierr.db (stale-while-revalidate — бережём дневную квоту)
+_mdblist_refreshing: set = set()
+_mdblist_refresh_lock = threading.Lock()
+_mdblist_stats = {"fresh": 0, "stale": 0, "miss": 0, "fetch_errors": 0}
+
+
+def _mdblist_fetch(content_type: str, tmdb_id: str) -> dict | None:
+    """Запрос к https://api.mdblist.com/tmdb/{type}/{tmdbId}; полный ответ сохраняем в кэш."""
     url = f"https://api.mdblist.com/tmdb/{content_type}/{tmdb_id}?apikey={MDBLIST_API_KEY}"
     try:
-        resp = requests.get(url, timeout=10)
+        resp = http_client.get(url, timeout=10)
         resp.raise_for_status()
         data = resp.json()
-        ratings = data.get("ratings")
-        if not isinstance(ratings, list):
-            return ""
+        if not isinstance(data, dict):
+            return None
+    except (requests.RequestException, ValueError) as e:
+        _mdblist_stats["fetch_errors"] += 1
+        app.logger.warning(f"MDblist API error for {content_type}/{tmdb_id}: {e}")
+        return None
+    try:
+        _state_db().execute(
+            "INSERT OR REPLACE INTO mdblist_cache (content_type, tmdb_id, data, fetched_ts) VALUES (?, ?, ?, ?)",
+            (content_type, tmdb_id, json.dumps(data, ensure_ascii=False), _now_ts()),
+        )
+    except Exception as ex:
+        logging.warning(f"MDblist cache store failed for {content_type}/{tmdb_id}: {ex}")
+    return data
 
-        lines = []
-        for r in ratings:
-            source = r.get("source")
-            value = r.get("value")
-            if source is None or value is None:
-                continue
-            lines.append(f"- {source}: {value}")
 
-        return "\n".join(lines)
-    except requests.RequestException as e:
-        app.logger.warning(f"MDblist API error for {content_type}/{tmdb_id}: {e}")
-        return ""
+def _mdblist_refresh_async(content_type: str, tmdb_id: str) -> None:
+    key = (content_type, tmdb_id)
+    with _mdblist_refresh_lock:
+        if key in _mdblist_refreshing:
+            return
+        _mdblist_refreshing.add(key)
+
+    def _run():
+        try:
+            _mdblist_fetch(content_type, tmdb_id)
+        finally:
+            with _mdblist_refresh_lock:
+                _mdblist_refreshing.discard(key)
+
+    threading.Thread(target=_run, name="mdblist-refresh", daemon=True).start()
 
-def send_telegram_photo(photo_id, caption):
-    base_photo_url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
 
-    # 1) Пытаемся скачать картинку у Jellyfin c api_key и таймаутом
+def get_mdblist_data(content_type: str, tmdb_id: str) -> dict | None:
+    """
+    Полный ответ MDBList для (content_type, tmdb_id):
+      - свежая запись (моложе MDBLIST_CACHE_TTL_SEC) — сразу из кэша;
+      - устаревшая (но моложе MDBLIST_CACHE_MAX_STALE_SEC) — тоже сразу, а обновление уходит в фон;
+      - нет записи — синхронный запрос; при ошибке отдаём хоть что-то из кэша.
+    """
+    content_type = str(content_type).strip().lower()
+    tmdb_id = str(tmdb_id).strip()
+    row = None
     try:
-        image_response = requests.get(
-            base_photo_url,
-            params={"api_key": JELLYFIN_API_KEY},
-            timeout=10
-        )
-    except requests.RequestException as e:
-        app.logger.warning(f"Failed to fetch JF image: {e}")
-        image_response = None
+        row = _state_db().execute(
+            "SELECT data, fetched_ts FROM mdblist_cache WHERE content_type = ? AND tmdb_id = ?",
+            (content_type, tmdb_id),
+        ).fetchone()
+    except Exception as ex:
+        logging.warning(f"MDblist cache read failed: {ex}")
+
+    if row is not None:
+        age = _now_ts() - float(row["fetched_ts"] or 0)
+        if age < MDBLIST_CACHE_TTL_SEC:
+            _mdblist_stats["fresh"] += 1
+            return json.loads(row["data"])
+        if age < MDBLIST_CACHE_MAX_STALE_SEC:
+            _mdblist_stats["stale"] += 1
+            _mdblist_refresh_async(content_type, tmdb_id)
+            return json.loads(row["data"])
+
+    _mdblist_stats["miss"] += 1
+    data = _mdblist_fetch(content_type, tmdb_id)
+    if data is None and row is not None:
+        return json.loads(row["data"])
+    return data
+
+
+def fetch_mdblist_ratings(content_type: str, tmdb_id: str) -> str:
+    """
+    Рейтинги MDBList (через кэш get_mdblist_data) в виде текста:
+      "- IMDb: 7.8\n- Rotten Tomatoes: 84%\n…"
+    или пустая строка при ошибке/отсутствии данных.
+    """
+    data = get_mdblist_data(content_type, tmdb_id) or {}
+    ratings = data.get("ratings")
+    if not isinstance(ratings, list):
+        return ""
+
+    lines = []
+    for r in ratings:
+        source = r.get("source")
+        value = r.get("value")
+        if source is None or value is None:
+            continue
+        lines.append(f"- {source}: {value}")
+
+    return "\n".join(lines)
+
+def send_telegram_photo(photo_id, caption, poster: dict | None = None):
+    # 1) Постер из Jellyfin (уже скачанный send_notification, либо качаем сами)
+    poster = _poster_or_fetch(photo_id, poster)
 
     # 2) Если картинка есть — шлём фото, иначе — текстом
     tg_base = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-    if image_response is not None and image_response.ok:
+    if poster:
         url = f"{tg_base}/sendPhoto"
         data = {
             "chat_id": TELEGRAM_CHAT_ID,
             "caption": caption,
             "parse_mode": "Markdown",
         }
-        files = {"photo": ("photo.jpg", image_response.content, "image/jpeg")}
-        response = requests.post(url, data=data, files=files, timeout=15)
+        files = {"photo": (poster["filename"], poster["bytes"], poster["mimetype"])}
+        response = http_client.post(url, data=data, files=files, timeout=15)
     else:
         app.logger.warning("JF image not available, sending text-only message")
         url = f"{tg_base}/sendMessage"
@@ -256,28 +666,27 @@ def send_telegram_photo(photo_id, caption):
             "text": caption,
             "parse_mode": "Markdown",
         }
-        response = requests.post(url, data=data, timeout=15)
+        response = http_client.post(url, data=data, timeout=15)
 
     return response
 
 def send_telegram_text(text: str):
     tg_base = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-    return requests.post(f"{tg_base}/sendMessage", data={
+    return http_client.post(f"{tg_base}/sendMessage", data={
         "chat_id": TELEGRAM_CHAT_ID,
         "text": text,
         "parse_mode": "Markdown",
     }, timeout=15)
 
-def send_telegram_photo_only(item_id: str):
+def send_telegram_photo_only(item_id: str, poster: dict | None = None):
     tg_base = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-    url = f"{JELLYFIN_BASE_URL}/Items/{item_id}/Images/Primary"
     try:
-        r = requests.get(url, params={"api_key": JELLYFIN_API_KEY}, timeout=10)
-        if not r.ok:
+        poster = _poster_or_fetch(item_id, poster)
+        if not poster:
             return None
-        return requests.post(f"{tg_base}/sendPhoto",
+        return http_client.post(f"{tg_base}/sendPhoto",
                              data={"chat_id": TELEGRAM_CHAT_ID},
-                             files={"photo": ("photo.jpg", r.content, "image/jpeg")},
+                             files={"photo": (poster["filename"], poster["bytes"], poster["mimetype"])},
                              timeout=15)
     except Exception:
         return None
@@ -292,10 +701,54 @@ def get_item_details(item_id):
         f"{JELLYFIN_BASE_URL}/emby/Items"
         f"?Recursive=true&Fields=DateCreated,Overview,ProviderIds,ExternalUrls,MediaStreams,MediaSources&Ids={item_id}"
     )
-    response = requests.get(url, headers=headers, params=params, timeout=10)
+    response = http_client.get(url, headers=headers, params=params, timeout=10)
     response.raise_for_status()
     return response.json()
 
+def get_item_path(item_id) -> str | None:
+    """
+    Путь основного файла элемента — лёгкий запрос без MediaStreams/MediaSources.
+    Нужен, чтобы понять, что Jellyfin уже видит новый файл, прежде чем тянуть полные детали.
+    """
+    params = {'api_key': JELLYFIN_API_KEY, 'Recursive': 'true', 'Fields': 'Path', 'Ids': item_id}
+    try:
+        response = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", headers={'accept': 'application/json'},
+                                   params=params, timeout=10)
+        response.raise_for_status()
+        items = response.json().get("Items") or []
+        return (str(items[0].get("Path") or "") or None) if items else None
+    except Exception as ex:
+        logging.debug(f"get_item_path failed for {item_id}: {ex}")
+        return None
+
+def get_items_details(item_ids) -> dict:
+    """
+    Пакетный вариант get_item_details: один запрос /emby/Items?Ids=a,b,c на несколько связанных
+    элементов (эпизод, сезон, сериал). Возвращает {id: {"Items": [item]}} — в том же формате,
+    что и get_item_details, так что extract_* хелперы работают без изменений.
+    Элементы, которых Jellyfin не вернул, в словарь не попадают.
+    """
+    wanted = [str(i) for i in dict.fromkeys(item_ids) if i]
+    if not wanted:
+        return {}
+    headers = {'accept': 'application/json'}
+    params = {
+        'api_key': JELLYFIN_API_KEY,
+        'Recursive': 'true',
+        'Fields': 'DateCreated,Overview,ProviderIds,ExternalUrls,MediaStreams,MediaSources',
+        'Ids': ",".join(wanted),
+    }
+    response = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", headers=headers, params=params, timeout=10)
+    response.raise_for_status()
+    # Jellyfin отдаёт Id без дефисов — сравниваем в нормализованном виде, ключи оставляем как спросили
+    by_norm = {str(it.get("Id") or "").replace("-", "").lower(): it for it in (response.json().get("Items") or [])}
+    out = {}
+    for item_id in wanted:
+        item = by_norm.get(item_id.replace("-", "").lower())
+        if item is not None:
+            out[item_id] = {"Items": [item]}
+    return out
+
 def extract_tmdb_id_from_jellyfin_details(details) -> str | None:
     """
     Принимает json от get_item_details(..) и пытается вернуть TMDb ID как строку.
@@ -369,19 +822,41 @@ def _pick_best_tmdb_video(results: list, preferred_iso: str | None = None) -> st
     return None
 
 
+_tmdb_trailer_cache = TTLCache(
+    maxsize=TMDB_TRAILER_CACHE_SIZE,
+    ttl=TMDB_TRAILER_CACHE_TTL_SEC,
+    negative_ttl=TMDB_TRAILER_CACHE_NEG_TTL_SEC,
+)
+
+
 def get_tmdb_trailer_url(media_type: str, tmdb_id: str | int, preferred_lang: str | None = None) -> str | None:
     """
     Возвращает URL трейлера с TMDB для movie/tv c фолбэком языка:
     1) preferred_lang (+ include_video_language=iso,en,null)
     2) en-US (+ include_video_language=en,null)
     3) без фильтра языка (любой доступный)
+    Результат (в том числе «трейлера нет») кэшируется по (media, tmdb_id, язык).
     """
     if not tmdb_id:
         return None
 
     media = "movie" if str(media_type).lower() == "movie" else "tv"
-    url = f"{TMDB_V3_BASE}/{media}/{tmdb_id}/videos"
     pref = preferred_lang or "en-US"
+    key = (media, str(tmdb_id).strip(), pref)
+    cached = _tmdb_trailer_cache.get(key, TTLCache.MISSING)
+    if cached is not TTLCache.MISSING:
+        return cached
+
+    trailer_url, complete = _fetch_tmdb_trailer_url(media, tmdb_id, pref)
+    # «не нашли» кэшируем только если TMDb честно ответил на все запросы (а не упал по сети)
+    if trailer_url or complete:
+        _tmdb_trailer_cache.put(key, trailer_url)
+    return trailer_url
+
+
+def _fetch_tmdb_trailer_url(media: str, tmdb_id: str | int, pref: str) -> tuple[str | None, bool]:
+    """Сами запросы к TMDb /videos. Возвращает (url | None, все ли запросы прошли без ошибок)."""
+    url = f"{TMDB_V3_BASE}/{media}/{tmdb_id}/videos"
     pref_iso = _iso639_1(pref)
 
     tries = [
@@ -391,10 +866,11 @@ def get_tmdb_trailer_url(media_type: str, tmdb_id: str | int, preferred_lang: st
     ]
 
     all_results = []
+    complete = True
     for params in tries:
         params = {**params, "api_key": TMDB_API_KEY}
         try:
-            r = requests.get(url, params=params, timeout=10)
+            r = http_client.get(url, params=params, timeout=10)
             r.raise_for_status()
             data = r.json() or {}
             results = data.get("results") or []
@@ -402,12 +878,13 @@ def get_tmdb_trailer_url(media_type: str, tmdb_id: str | int, preferred_lang: st
             # если именно на этом шаге уже есть «лучший» — можно вернуть сразу
             best_here = _pick_best_tmdb_video(results, preferred_iso=pref_iso)
             if best_here:
-                return best_here
+                return best_here, True
         except requests.RequestException as e:
+            complete = False
             logging.warning(f"TMDB videos fetch failed ({media}/{tmdb_id}, {params}): {e}")
 
     # Фолбэк: попробуем выбрать лучший из суммарного списка
-    return _pick_best_tmdb_video(all_results, preferred_iso=pref_iso)
+    return _pick_best_tmdb_video(all_results, preferred_iso=pref_iso), complete
 
 # Добавление технической информации в сообщение о новом фильме
 def _channels_to_layout(channels: int | None) -> str:
@@ -641,8 +1118,379 @@ def _resolution_label(width: int | None, height: int | None) -> str:
     # знак умножения × — аккуратнее, чем "x"
     return f"{label()} ({w}×{h})"
 
+#Состояние (счётчики сезонов, ожидания Radarr/Sonarr, очередь, кэши) — SQLite в state_directory
+_state_db_local = threading.local()
+
+
+def _state_db() -> sqlite3.Connection:
+    """
+    Своё соединение с STATE_DB_FILE на каждый поток (WAL: читатели не ждут писателя).
+    Соединение, унаследованное через fork (gunicorn --preload), не используем — открываем новое.
+    """
+    conn = getattr(_state_db_local, "conn", None)
+    if conn is None or _state_db_local.pid != os.getpid():
+        conn = sqlite3.connect(STATE_DB_FILE, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _state_db_local.conn = conn
+        _state_db_local.pid = os.getpid()
+    return conn
+
+
+def _state_db_init() -> None:
+    db = _state_db()
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS state_meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS season_counts (
+            season_id    TEXT    PRIMARY KEY,
+            last_count   INTEGER NOT NULL DEFAULT 0,
+            last_sent_ts REAL    NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS radarr_pending (
+            key           TEXT PRIMARY KEY,
+            next_check_ts REAL NOT NULL,
+            data          TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS radarr_pending_due ON radarr_pending (next_check_ts);
+        CREATE TABLE IF NOT EXISTS sonarr_pending (
+            key           TEXT PRIMARY KEY,
+            next_check_ts REAL NOT NULL,
+            data          TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sonarr_pending_due ON sonarr_pending (next_check_ts);
+        CREATE TABLE IF NOT EXISTS event_queue (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            source          TEXT    NOT NULL,
+            payload         TEXT    NOT NULL,
+            status          TEXT    NOT NULL DEFAULT 'pending',
+            attempts        INTEGER NOT NULL DEFAULT 0,
+            next_attempt_ts REAL    NOT NULL,
+            claimed_ts      REAL,
+            last_error      TEXT,
+            created_ts      REAL    NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS event_queue_due ON event_queue (status, next_attempt_ts);
+        CREATE TABLE IF NOT EXISTS event_dead_letter (
+            id          INTEGER PRIMARY KEY,
+            source      TEXT    NOT NULL,
+            payload     TEXT    NOT NULL,
+            attempts    INTEGER NOT NULL,
+            last_error  TEXT,
+            created_ts  REAL    NOT NULL,
+            failed_ts   REAL    NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS season_counts_prime (
+            season_id TEXT    PRIMARY KEY,
+            present   INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS announced_items (
+            item_id      TEXT PRIMARY KEY,
+            announced_ts REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mdblist_cache (
+            content_type TEXT NOT NULL,
+            tmdb_id      TEXT NOT NULL,
+            data         TEXT NOT NULL,
+            fetched_ts   REAL NOT NULL,
+            PRIMARY KEY (content_type, tmdb_id)
+        );
+    """)
+
+
+def state_meta_get(key: str, default: str | None = None) -> str | None:
+    row = _state_db().execute("SELECT value FROM state_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row is not None else default
+
+
+def state_meta_set(key: str, value) -> None:
+    _state_db().execute("INSERT OR REPLACE INTO state_meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+
+class PendingStore:
+    """
+    Ожидающие проверки записи Radarr/Sonarr: одна строка на ключ, JSON записи в data,
+    next_check_ts вынесен в индексируемую колонку — воркер читает только то, что пора проверить.
+    """
+
+    def __init__(self, table: str):
+        self.table = table
+
+    def get(self, key: str) -> dict | None:
+        row = _state_db().execute(f"SELECT data FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        return json.loads(row["data"]) if row is not None else None
+
+    def all(self) -> dict:
+        rows = _state_db().execute(f"SELECT key, data FROM {self.table}").fetchall()
+        return {r["key"]: json.loads(r["data"]) for r in rows}
+
+    def put(self, key: str, entry: dict) -> None:
+        self.put_many({key: entry})
+
+    def put_many(self, entries: dict) -> None:
+        if not entries:
+            return
+        db = _state_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            self.write_rows(db, entries)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def write_rows(self, db: sqlite3.Connection, entries: dict) -> None:
+        """upsert записей внутри уже открытой транзакции вызывающего."""
+        db.executemany(
+            f"INSERT OR REPLACE INTO {self.table} (key, next_check_ts, data) VALUES (?, ?, ?)",
+            [(k, float(e.get("next_check_ts") or 0.0), json.dumps(e, ensure_ascii=False)) for k, e in entries.items()],
+        )
+
+    def delete(self, keys) -> None:
+        keys = list(keys)
+        if not keys:
+            return
+        db = _state_db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(f"DELETE FROM {self.table} WHERE key = ?", [(k,) for k in keys])
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def count(self) -> int:
+        return int(_state_db().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0])
+
+
+class PendingScheduler:
+    """
+    Ожидающие записи Radarr/Sonarr в памяти поверх PendingStore: min-heap по next_check_ts.
+    Воркер спит ровно до ближайшей записи (wait_due); put()/delete()/wake() будят его досрочно.
+    На диск уходят только изменённые строки; таблица читается один раз — при первом обращении.
+    """
+
+    def __init__(self, store: PendingStore):
+        self.store = store
+        self._entries: dict = {}
+        self._heap: list = []     # (next_check_ts, seq, key); устаревшие кортежи отбрасываются при извлечении
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._loaded = False
+        self.counters = {"confirmed": 0, "expired": 0, "abandoned": 0}
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self._entries = self.store.all()
+            self._rebuild_heap()
+            self._loaded = True
+
+    def _rebuild_heap(self) -> None:
+        self._heap = [(float(e.get("next_check_ts") or 0.0), next(self._seq), k) for k, e in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def _push(self, key: str, entry: dict) -> None:
+        heapq.heappush(self._heap, (float(entry.get("next_check_ts") or 0.0), next(self._seq), key))
+        if len(self._heap) > 2 * len(self._entries) + 64:
+            self._rebuild_heap()
+
+    def _is_current(self, item: tuple) -> bool:
+        entry = self._entries.get(item[2])
+        return entry is not None and float(entry.get("next_check_ts") or 0.0) == item[0]
+
+    def get(self, key: str) -> dict | None:
+        with self._cond:
+            self._ensure_loaded()
+            entry = self._entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def put(self, key: str, entry: dict) -> None:
+        self.put_many({key: entry})
+
+    def put_many(self, entries: dict) -> None:
+        if not entries:
+            return
+        with self._cond:
+            self._ensure_loaded()
+            self.store.put_many(entries)
+            for key, entry in entries.items():
+                self._entries[key] = dict(entry)
+                self._push(key, entry)
+            self._cond.notify_all()
+
+    def delete(self, keys) -> None:
+        keys = [k for k in keys]
+        if not keys:
+            return
+        with self._cond:
+            self._ensure_loaded()
+            self.store.delete(keys)
+            for key in keys:
+                self._entries.pop(key, None)
+            self._cond.notify_all()
+
+    def wake(self, key: str, at_ts: float | None = None) -> bool:
+        """Перенести проверку записи на at_ts (по умолчанию — сейчас), если она была назначена позже."""
+        at_ts = _now_ts() if at_ts is None else at_ts
+        with self._cond:
+            self._ensure_loaded()
+            entry = self._entries.get(key)
+            if entry is None or float(entry.get("next_check_ts") or 0.0) <= at_ts:
+                return False
+            entry = dict(entry, next_check_ts=at_ts)
+            self.store.put(key, entry)
+            self._entries[key] = entry
+            self._push(key, entry)
+            self._cond.notify_all()
+            return True
+
+    def wake_where(self, matches, at_ts: float | None = None) -> list:
+        """
+        wake() для всех записей, на которых matches(key, entry) истинно. Возвращает разбуженные ключи.
+        matches вызывается вне блокировки (может ходить в Jellyfin) — на снимке записей.
+        """
+        with self._cond:
+            self._ensure_loaded()
+            snapshot = [(k, dict(e)) for k, e in self._entries.items()]
+        keys = [k for k, e in snapshot if matches(k, e)]
+        return [k for k in keys if self.wake(k, at_ts)]
+
+    def wait_due(self, timeout: float | None = None) -> dict:
+        """Блокируется до ближайшего next_check_ts (или timeout) и возвращает копии всех созревших записей."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._ensure_loaded()
+            while True:
+                while self._heap and not self._is_current(self._heap[0]):
+                    heapq.heappop(self._heap)
+                now = _now_ts()
+                if self._heap and self._heap[0][0] <= now:
+                    due = {}
+                    while self._heap and self._heap[0][0] <= now:
+                        item = heapq.heappop(self._heap)
+                        if self._is_current(item):
+                            due[item[2]] = dict(self._entries[item[2]])
+                    return due
+                # не дольше часа за раз: у припаркованных записей next_check_ts далеко за TIMEOUT_MAX
+                wait = min(self._heap[0][0] - now, 3600.0) if self._heap else None
+                if deadline is not None:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        return {}
+                    wait = left if wait is None else min(wait, left)
+                self._cond.wait(wait)
+
+    def finish(self, taken: dict, retry_ts: float) -> None:
+        """Записи из wait_due, которые воркер не перепланировал и не удалил (ошибка посреди прохода), — на retry_ts."""
+        with self._cond:
+            stale = {k: dict(self._entries[k], next_check_ts=retry_ts) for k in taken
+                     if k in self._entries
+                     and float(self._entries[k].get("next_check_ts") or 0.0) == float(taken[k].get("next_check_ts") or 0.0)}
+        self.put_many(stale)
+
+    def count(self) -> int:
+        with self._cond:
+            self._ensure_loaded()
+            return len(self._entries)
+
+    def reload(self) -> None:
+        """Забыть копию в памяти: следующее обращение перечитает таблицу (процесс только что стал лидером)."""
+        with self._cond:
+            self._loaded = False
+            self._entries, self._heap = {}, []
+
+    def bump(self, counter: str) -> None:
+        with self._cond:
+            self.counters[counter] = self.counters.get(counter, 0) + 1
+
+    def stats(self) -> dict:
+        with self._cond:
+            self._ensure_loaded()
+            nxt = min((float(e.get("next_check_ts") or 0.0) for e in self._entries.values() if not e.get("parked")), default=None)
+            parked = sum(1 for e in self._entries.values() if e.get("parked"))
+            return {"pending": len(self._entries), "parked": parked, "heap": len(self._heap),
+                    "next_due_in_sec": round(nxt - _now_ts(), 1) if nxt is not None else None,
+                    **self.counters}
+
+
+PENDING_PARKED_TS = 253402300799.0   # 9999-12-31: припаркованная запись не опрашивается, её будит только событие
+
+
+def pending_next_check_ts(entry: dict, now: float, base_sec: float) -> float:
+    """
+    Следующая «пустая» перепроверка записи: base_sec * 2^(attempts-1) с джиттером, не дольше
+    PENDING_BACKOFF_MAX_SEC. Счётчик attempts хранится в самой записи; припаркованная — не опрашивается.
+    """
+    if entry.get("parked"):
+        return PENDING_PARKED_TS
+    attempts = int(entry.get("attempts") or 0) + 1
+    entry["attempts"] = attempts
+    delay = min(max(base_sec, PENDING_BACKOFF_MAX_SEC), base_sec * (2 ** min(attempts - 1, 30)))
+    return now + delay * (1 + random.uniform(-PENDING_BACKOFF_JITTER, PENDING_BACKOFF_JITTER))
+
+
+def pending_expire_if_old(sched: "PendingScheduler", key: str, entry: dict, now: float) -> bool:
+    """Запись старше PENDING_MAX_AGE_SEC: паркуем или удаляем (PENDING_EXPIRED_ACTION). True — обрабатывать не нужно."""
+    created = float(entry.setdefault("created_ts", now))
+    if entry.get("parked") or now - created < PENDING_MAX_AGE_SEC:
+        return False
+    sched.bump("expired")
+    if PENDING_EXPIRED_ACTION == "drop":
+        sched.delete([key])
+        logging.info(f"Pending {sched.store.table}: {key} expired after {int((now - created) // 86400)}d — dropped")
+    else:
+        entry["parked"] = True
+        entry["next_check_ts"] = PENDING_PARKED_TS
+        sched.put(key, entry)
+        logging.info(f"Pending {sched.store.table}: {key} expired after {int((now - created) // 86400)}d — parked")
+    return True
+
+
+def run_pending_batch(label: str, items: dict, fn) -> dict:
+    """
+    fn(key, value) для всех items в общем пуле _pending_executor (не больше PENDING_MAX_CONCURRENCY разом).
+    Возвращает {key: результат}; упавшая запись логируется и в результат не попадает —
+    её, не перепланированную, воркер отдаёт PendingScheduler.finish().
+    """
+    futures = {k: _pending_executor.submit(fn, k, v) for k, v in items.items()}
+    results = {}
+    for k, fut in futures.items():
+        try:
+            results[k] = fut.result()
+        except Exception as ex:
+            logging.warning(f"Pending {label}: {k} failed: {ex}")
+    return results
+
+
+radarr_pending = PendingScheduler(PendingStore("radarr_pending"))
+sonarr_pending = PendingScheduler(PendingStore("sonarr_pending"))
+
+
 #Добавление информации о колличестве добавлений серий (колличество из планируемых)
+# season_counts меняется в памяти под блокировкой своего сезона (season_lock) — без диска;
+# _season_counts_lock — только для операций над всем словарём и набором «грязных» сезонов.
+# На диск изменённые строки уносит фоновый _season_counts_flusher_loop.
 _season_counts_lock = threading.Lock()
+_season_locks = [threading.Lock() for _ in range(64)]
+_season_dirty: set = set()
+_season_flush_wakeup = threading.Event()
+
+
+def season_lock(season_id: str) -> threading.Lock:
+    """Блокировка сезона (полосатая: 64 штуки на все сезоны, по хэшу id)."""
+    return _season_locks[hash(season_id) % len(_season_locks)]
+
+
+def mark_season_dirty(*season_ids) -> None:
+    """Сезон изменён в памяти — фоновый сброс запишет его (сразу, если набралось SEASON_COUNTS_FLUSH_MAX_DIRTY)."""
+    with _season_counts_lock:
+        _season_dirty.update(season_ids)
+        many = len(_season_dirty) >= SEASON_COUNTS_FLUSH_MAX_DIRTY
+    if many:
+        _season_flush_wakeup.set()
 
 def get_jellyfin_user_id() -> str | None:
     """Определяем Id пользователя для api_key (кешируем в глобальной JELLYFIN_USER_ID)."""
@@ -651,7 +1499,7 @@ def get_jellyfin_user_id() -> str | None:
         return JELLYFIN_USER_ID
     try:
         url = f"{JELLYFIN_BASE_URL}/Users/Me"
-        resp = requests.get(url, params={"api_key": JELLYFIN_API_KEY}, timeout=10)
+        resp = http_client.get(url, params={"api_key": JELLYFIN_API_KEY}, timeout=10)
         if resp.ok:
             JELLYFIN_USER_ID = (resp.json() or {}).get("Id")
             return JELLYFIN_USER_ID
@@ -659,36 +1507,103 @@ def get_jellyfin_user_id() -> str | None:
         pass
     return None
 
-def _atomic_json_write(path: str, data: dict):
-    """Безопасная запись json."""
-    tmp = None
-    try:
-        d = json.dumps(data, ensure_ascii=False, indent=2)
-        fd, tmp = tempfile.mkstemp(prefix=".tmp_", suffix=".json")
-        with os.fdopen(fd, "w", encoding="utf-8") as f:
-            f.write(d)
-        os.replace(tmp, path)
-    finally:
-        try:
-            if tmp and os.path.exists(tmp):
-                os.remove(tmp)
-        except Exception:
-            pass
-
 def load_season_counts() -> dict:
+    rows = _state_db().execute("SELECT season_id, last_count, last_sent_ts FROM season_counts").fetchall()
+    return {r["season_id"]: {"last_count": r["last_count"], "last_sent_ts": r["last_sent_ts"]} for r in rows}
+
+def flush_season_counts() -> int:
+    """Одной транзакцией upsert всех «грязных» сезонов. При ошибке они остаются грязными. Возвращает число строк."""
+    with _season_counts_lock:
+        batch = set(_season_dirty)
+        _season_dirty.clear()
+    rows = []
+    for sid in batch:
+        with season_lock(sid):
+            st = season_counts.get(sid)
+            if st is not None:
+                rows.append((sid, int(st.get("last_count") or 0), float(st.get("last_sent_ts") or 0)))
+    if not rows:
+        return 0
+    db = _state_db()
     try:
-        with open(SEASON_COUNTS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+        db.execute("BEGIN IMMEDIATE")
+        db.executemany(
+            "INSERT INTO season_counts (season_id, last_count, last_sent_ts) VALUES (?, ?, ?)"
+            " ON CONFLICT(season_id) DO UPDATE SET last_count = excluded.last_count, last_sent_ts = excluded.last_sent_ts",
+            rows,
+        )
+        db.execute("COMMIT")
+    except Exception as e:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        with _season_counts_lock:
+            _season_dirty.update(batch)
+        logging.warning(f"Failed to save season counts: {e}")
+        return 0
+    return len(rows)
+
+
+def _season_counts_flusher_loop():
+    while True:
+        _season_flush_wakeup.wait(SEASON_COUNTS_FLUSH_SEC)
+        _season_flush_wakeup.clear()
+        flush_season_counts()
+
 
-def save_season_counts(data: dict) -> None:
+@atexit.register
+def _flush_season_counts_at_exit():
+    n = flush_season_counts()
+    if n:
+        logging.info(f"Season counts: {n} season(s) flushed on shutdown")
+
+def _read_json_file(path: str) -> dict | None:
+    """Содержимое JSON-файла; {} — файла нет, None — файл есть, но прочитать его не удалось."""
+    if not os.path.exists(path):
+        return {}
     try:
-        _atomic_json_write(SEASON_COUNTS_FILE, data)
-    except Exception as e:
-        logging.warning(f"Failed to save {SEASON_COUNTS_FILE}: {e}")
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f) or {}
+    except Exception as ex:
+        logging.warning(f"Could not read {path}: {ex}")
+        return None
 
-# Глобальное состояние
+def _import_json_state_once() -> None:
+    """
+    Однократный перенос старых season_counts.json / radarr_pending.json / sonarr_pending.json в notifierr.db.
+    Файлы не удаляются (остаются как резервная копия). Всё ложится одной транзакцией вместе с отметкой
+    json_imported; если хоть один существующий файл не прочитался — отметку не ставим, повторим при следующем старте.
+    """
+    if state_meta_get("json_imported"):
+        return
+    counts = _read_json_file(SEASON_COUNTS_FILE)
+    radarr = _read_json_file(RADARR_PENDING_FILE)
+    sonarr = _read_json_file(SONARR_PENDING_FILE)
+    if counts is None or radarr is None or sonarr is None:
+        logging.warning("State: JSON import postponed until every existing state file can be read")
+        return
+    db = _state_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.executemany(
+            "INSERT OR IGNORE INTO season_counts (season_id, last_count, last_sent_ts) VALUES (?, ?, ?)",
+            [(sid, int((st or {}).get("last_count") or 0), float((st or {}).get("last_sent_ts") or 0))
+             for sid, st in counts.items()],
+        )
+        radarr_pending.store.write_rows(db, radarr)
+        sonarr_pending.store.write_rows(db, sonarr)
+        db.execute("INSERT OR REPLACE INTO state_meta (key, value) VALUES ('json_imported', ?)", (str(time.time()),))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    if counts or radarr or sonarr:
+        logging.info(f"State: imported {len(counts)} season count(s), {len(radarr)} Radarr and "
+                     f"{len(sonarr)} Sonarr pending entries from JSON into {STATE_DB_FILE}")
+
+# Глобальное состояние: season_counts — копия таблицы в памяти (проверки без запросов к БД),
+# на диск уходят только изменённые строки (mark_season_dirty → flush_season_counts)
+_state_db_init()
+_import_json_state_once()
 season_counts = load_season_counts()
 
 
@@ -721,7 +1636,7 @@ def get_season_episode_count(series_id: str, season_id: str) -> int:
     url = f"{JELLYFIN_BASE_URL}/Shows/{series_id}/Episodes"
 
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=10)
+        r = http_client.get(url, headers=headers, params=params, timeout=10)
         r.raise_for_status()
         data = r.json() or {}
         items = data.get("Items") or []
@@ -752,7 +1667,7 @@ def get_tmdb_season_total_episodes(tv_tmdb_id: str | int, season_number: int, pr
         p.update(params)
         url = f"{TMDB_V3_BASE}/tv/{tv_tmdb_id}/season/{int(season_number)}"
         try:
-            r = requests.get(url, params=p, timeout=10)
+            r = http_client.get(url, params=p, timeout=10)
             r.raise_for_status()
             data = r.json() or {}
             # Обычно в ответе есть массив episodes — его длина и есть «плановое» количество.
@@ -804,7 +1719,7 @@ def get_season_episodes_with_files(series_id: str, season_id: str) -> list[dict]
 
     url = f"{JELLYFIN_BASE_URL}/Shows/{series_id}/Episodes"
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=10)
+        r = http_client.get(url, headers=headers, params=params, timeout=10)
         r.raise_for_status()
         items = (r.json() or {}).get("Items") or []
         # оставляем только те, у кого реально есть файл
@@ -1137,15 +2052,6 @@ def _split_caption_for_reddit(caption: str) -> tuple[str, str]:
         body = body[2:]
     return header or "Jellyfin", body.strip()
 
-def jellyfin_image_exists(item_id: str, timeout: float = 5.0) -> bool:
-    """Проверяем наличие Primary-постера в Jellyfin (упрощённо)."""
-    try:
-        url = f"{JELLYFIN_BASE_URL}/Items/{item_id}/Images/Primary"
-        r = requests.get(url, params={"api_key": JELLYFIN_API_KEY}, timeout=timeout)
-        return r.ok and (r.content is not None) and len(r.content) > 0
-    except Exception:
-        return False
-
 def _extract_bold_line(line: str) -> str | None:
     m = re.fullmatch(r"\*\s*(.+?)\s*\*", (line or "").strip())
     return m.group(1).strip() if m else None
@@ -1232,7 +2138,7 @@ def upload_image_to_imgbb(image_bytes):
     for attempt in range(1, 4):
         try:
             logging.info(f"Попытка загрузки на imgbb #{attempt}")
-            response = requests.post(url, data=payload, timeout=20)
+            response = http_client.post(url, data=payload, timeout=20)
             response.raise_for_status()
             data = response.json()
             uploaded_image_url = data['data']['url']
@@ -1257,12 +2163,15 @@ def wait_for_imgbb_upload(timeout: float | None = 10.0):
     return uploaded_image_url
 
 
-def get_jellyfin_image_and_upload_imgbb(photo_id):
-    jellyfin_image_url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
+def get_jellyfin_image_and_upload_imgbb(photo_id, poster: dict | None = None):
     try:
-        resp = requests.get(jellyfin_image_url, timeout=10)
-        resp.raise_for_status()
-        return upload_image_to_imgbb(resp.content)
+        if not IMGBB_API_KEY:
+            # без ключа постер не нужен — upload сам отметит пропуск
+            return upload_image_to_imgbb(b"")
+        poster = _poster_or_fetch(photo_id, poster)
+        if not poster:
+            raise ValueError("poster is not available")
+        return upload_image_to_imgbb(poster["bytes"])
     except Exception as ex:
         logging.warning(f"Ошибка скачивания из Jellyfin: {ex}")
         # ВАЖНО: разблокировать потенциальных ожидателей imgbb
@@ -1273,7 +2182,7 @@ def get_jellyfin_image_and_upload_imgbb(photo_id):
         return None
 
 #Discord
-def send_discord_message(photo_id, message, title="Jellyfin", uploaded_url=None):
+def send_discord_message(photo_id, message, title="Jellyfin", uploaded_url=None, poster: dict | None = None):
     """
     Отправляет уведомление в Discord через Webhook.
     Картинку берём НАПРЯМУЮ из Jellyfin и прикрепляем как файл.
@@ -1283,22 +2192,15 @@ def send_discord_message(photo_id, message, title="Jellyfin", uploaded_url=None)
         logging.warning("DISCORD_WEBHOOK_URL not set, skipping Discord notification.")
         return None
 
-    # 1) тянем постер из Jellyfin
-    jellyfin_image_url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
+    # 1) постер из Jellyfin
     image_bytes = None
     filename = "poster.jpg"
     mimetype = "image/jpeg"
-    try:
-        r = requests.get(jellyfin_image_url, timeout=30)
-        r.raise_for_status()
-        image_bytes = r.content
-        ct = r.headers.get("Content-Type", "image/jpeg").split(";")[0].strip().lower()
-        if "png" in ct:
-            filename, mimetype = "poster.png", "image/png"
-        elif "webp" in ct:
-            filename, mimetype = "poster.webp", "image/webp"
-    except Exception as ex:
-        logging.warning(f"Discord: failed to fetch image from Jellyfin: {ex}")
+    poster = _poster_or_fetch(photo_id, poster)
+    if poster:
+        image_bytes, filename, mimetype = poster["bytes"], poster["filename"], poster["mimetype"]
+    else:
+        logging.warning("Discord: image from Jellyfin is not available")
 
     # 2) готовим payload
     payload = {
@@ -1318,7 +2220,7 @@ def send_discord_message(photo_id, message, title="Jellyfin", uploaded_url=None)
             files = {
                 "file": (filename, image_bytes, mimetype)
             }
-            resp = requests.post(
+            resp = http_client.post(
                 DISCORD_WEBHOOK_URL,
                 data={"payload_json": json.dumps(payload, ensure_ascii=False)},
                 files=files,
@@ -1326,7 +2228,7 @@ def send_discord_message(photo_id, message, title="Jellyfin", uploaded_url=None)
             )
         else:
             # без картинки — обычный JSON
-            resp = requests.post(DISCORD_WEBHOOK_URL, json=payload, timeout=30)
+            resp = http_client.post(DISCORD_WEBHOOK_URL, json=payload, timeout=30)
 
         resp.raise_for_status()
         logging.info("Discord notification sent successfully")
@@ -1344,7 +2246,7 @@ def _slack_try_join_channel(channel_id: str) -> bool:
     if not (SLACK_BOT_TOKEN and channel_id):
         return False
     try:
-        resp = requests.post(
+        resp = http_client.post(
             "https://slack.com/api/conversations.join",
             headers={
                 "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
@@ -1384,7 +2286,7 @@ def send_slack_text_only(message_markdown: str) -> bool:
         "mrkdwn": True,
     }
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=30)
+        resp = http_client.post(url, headers=headers, json=payload, timeout=30)
         resp.raise_for_status()
         data = resp.json()
         if not data.get("ok"):
@@ -1397,7 +2299,7 @@ def send_slack_text_only(message_markdown: str) -> bool:
         return False
 
 
-def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown: str) -> bool:
+def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown: str, poster: dict | None = None) -> bool:
     """
     Slack: загрузка файла по новому потоку:
       1) files.getUploadURLExternal (получаем upload_url и file_id)
@@ -1409,26 +2311,15 @@ def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown:
         logging.debug("Slack disabled/misconfigured; skip.")
         return False
 
-    # 1) достаём картинку из Jellyfin
+    # 1) картинка из Jellyfin
     img_bytes = None
     filename = "poster.jpg"
     mimetype = "image/jpeg"
-    try:
-        if "_fetch_jellyfin_primary" in globals():
-            b, mt, fn = _fetch_jellyfin_primary(photo_id)
-            img_bytes, mimetype, filename = b, mt, fn
-        else:
-            jf_url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
-            r = requests.get(jf_url, timeout=30)
-            r.raise_for_status()
-            img_bytes = r.content
-            ct = r.headers.get("Content-Type", "image/jpeg").split(";")[0].strip().lower()
-            if "png" in ct:
-                filename, mimetype = "poster.png", "image/png"
-            elif "webp" in ct:
-                filename, mimetype = "poster.webp", "image/webp"
-    except Exception as ex:
-        logging.warning(f"Slack: failed to fetch image from Jellyfin: {ex}")
+    poster = _poster_or_fetch(photo_id, poster)
+    if poster:
+        img_bytes, mimetype, filename = poster["bytes"], poster["mimetype"], poster["filename"]
+    else:
+        logging.warning("Slack: image from Jellyfin is not available")
 
     if not img_bytes:
         # нет картинки — отправим текст
@@ -1437,7 +2328,7 @@ def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown:
     # 2) files.getUploadURLExternal
     auth_h = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
     try:
-        resp = requests.post(
+        resp = http_client.post(
             "https://slack.com/api/files.getUploadURLExternal",
             headers=auth_h,
             data={"filename": filename, "length": str(len(img_bytes))},
@@ -1458,9 +2349,9 @@ def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown:
     try:
         # можно сырыми байтами:
         up_headers = {"Content-Type": mimetype}
-        up = requests.post(upload_url, data=img_bytes, headers=up_headers, timeout=60)
+        up = http_client.post(upload_url, data=img_bytes, headers=up_headers, timeout=60)
         # альтернативно: multipart (иногда помогает при прокси):
-        # up = requests.post(upload_url, files={"filename": (filename, img_bytes, mimetype)}, timeout=60)
+        # up = http_client.post(upload_url, files={"filename": (filename, img_bytes, mimetype)}, timeout=60)
         if up.status_code != 200:
             logging.warning(f"Slack upload_url returned {up.status_code}: {up.text[:200]}")
             return send_slack_text_only(caption_markdown)
@@ -1475,7 +2366,7 @@ def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown:
             "channel_id": SLACK_CHANNEL_ID,
             "initial_comment": sanitize_whatsapp_text(caption_markdown) or "",
         }
-        return requests.post(
+        return http_client.post(
             "https://slack.com/api/files.completeUploadExternal",
             headers={**auth_h, "Content-Type": "application/json; charset=utf-8"},
             json=comp_payload,
@@ -1512,7 +2403,7 @@ def send_slack_message_with_image_from_jellyfin(photo_id: str, caption_markdown:
         return send_slack_text_only(caption_markdown)
 
 #Email
-def send_email_with_image_jellyfin(item_id: str, subject: str, body_markdown: str):
+def send_email_with_image_jellyfin(item_id: str, subject: str, body_markdown: str, poster: dict | None = None):
     """
     Отправляет email с:
       - text/plain (plain-версия текста)
@@ -1534,15 +2425,15 @@ def send_email_with_image_jellyfin(item_id: str, subject: str, body_markdown: st
         extensions=["extra", "sane_lists", "nl2br"]
     )
 
-    # Тянем картинку из Jellyfin (с повторами)
+    # Картинка из Jellyfin (fetch_jellyfin_poster уже с повторами)
     img_bytes = None
     img_subtype = "jpeg"
-    try:
-        img_bytes = _fetch_jellyfin_image_with_retries(item_id, attempts=3, timeout=10, delay=1.5)
-        # subtype подберём осторожно (если есть headers в ретрае — можно хранить вместе)
-        # здесь предполагаем jpeg; при желании можно расширить определение
-    except Exception as ex:
-        logging.warning(f"Email: failed to fetch Jellyfin image: {ex}")
+    img_filename = "poster.jpg"
+    poster = _poster_or_fetch(item_id, poster)
+    if poster:
+        img_bytes = poster["bytes"]
+        img_subtype = poster["mimetype"].split("/")[-1]
+        img_filename = poster["filename"]
 
     msg = EmailMessage()
     msg["Subject"] = subject or SMTP_SUBJECT
@@ -1570,7 +2461,7 @@ def send_email_with_image_jellyfin(item_id: str, subject: str, body_markdown: st
             msg.get_payload()[1].add_related(img_bytes, maintype="image", subtype=img_subtype, cid=cid)
         except Exception as ex:
             logging.warning(f"Email: cannot embed inline image (fallback as attachment): {ex}")
-            msg.add_attachment(img_bytes, maintype="image", subtype=img_subtype, filename="poster.jpg")
+            msg.add_attachment(img_bytes, maintype="image", subtype=img_subtype, filename=img_filename)
     else:
         # нет картинки — просто HTML без тега <img>
         msg.add_alternative(f"<html><body>{body_html_rendered}</body></html>", subtype="html")
@@ -1631,7 +2522,7 @@ def send_gotify_message(item_id: str, message, title="Jellyfin", priority=5, upl
     headers = {"X-Gotify-Format": "markdown"}
 
     try:
-        response = requests.post(url, json=data, headers=headers)
+        response = http_client.post(url, json=data, headers=headers)
         response.raise_for_status()
         logging.info("Gotify notification sent successfully")
         return response
@@ -1663,7 +2554,7 @@ def _reddit_get_token() -> str | None:
             "password": REDDIT_PASSWORD,
         }
         # Basic-авторизация client_id:client_secret + обязательный User-Agent
-        r = requests.post(
+        r = http_client.post(
             "https://www.reddit.com/api/v1/access_token",
             data=data,
             auth=(REDDIT_APP_ID, REDDIT_APP_SECRET),
@@ -1717,7 +2608,7 @@ def send_reddit_post(title: str, body_markdown: str, external_image_url: str | N
             "api_type": "json",
         }
 
-        r = requests.post("https://oauth.reddit.com/api/submit", headers=headers, data=data, timeout=20)
+        r = http_client.post("https://oauth.reddit.com/api/submit", headers=headers, data=data, timeout=20)
         if r.status_code != 200:
             logging.warning(f"Reddit submit HTTP {r.status_code}: {r.text[:300]}")
             return False
@@ -1761,7 +2652,7 @@ def send_reddit_link_post_with_comment(title: str, url: str, body_markdown: str
             "nsfw": "true" if REDDIT_NSFW else "false",
             "api_type": "json",
         }
-        r = requests.post("https://oauth.reddit.com/api/submit", headers=headers, data=submit_data, timeout=20)
+        r = http_client.post("https://oauth.reddit.com/api/submit", headers=headers, data=submit_data, timeout=20)
         if r.status_code != 200:
             logging.warning(f"Reddit link submit HTTP {r.status_code}: {r.text[:300]}")
             return False
@@ -1777,7 +2668,7 @@ def send_reddit_link_post_with_comment(title: str, url: str, body_markdown: str
 
         if thing_id and body_markdown:
             cdata = {"thing_id": thing_id, "text": body_markdown, "api_type": "json"}
-            cr = requests.post("https://oauth.reddit.com/api/comment", headers=headers, data=cdata, timeout=20)
+            cr = http_client.post("https://oauth.reddit.com/api/comment", headers=headers, data=cdata, timeout=20)
             if cr.status_code != 200:
                 logging.warning(f"Reddit comment HTTP {cr.status_code}: {cr.text[:300]}")
             else:
@@ -1837,7 +2728,7 @@ def send_whatsapp_image_via_rest(
         return None
 
     try:
-        resp = requests.post(url, data=form, files=files, auth=auth, timeout=30)
+        resp = http_client.post(url, data=form, files=files, auth=auth, timeout=30)
         resp.raise_for_status()
         logging.info("WhatsApp image sent successfully")
         return resp
@@ -1870,9 +2761,9 @@ def send_whatsapp_text_via_rest(message: str, phone_jid: str | None = None):
     }
 
     try:
-        r = requests.post(url_text, data=form, auth=auth, timeout=20)
+        r = http_client.post(url_text, data=form, auth=auth, timeout=20)
         if r.status_code == 404:
-            r = requests.post(url_msg, data=form, auth=auth, timeout=20)
+            r = http_client.post(url_msg, data=form, auth=auth, timeout=20)
         r.raise_for_status()
         logging.info("WhatsApp text sent successfully")
         return r
@@ -1912,18 +2803,17 @@ def send_whatsapp_image_with_retries(
     return False
 
 #Signal
-def send_signal_message_with_image(photo_id, message, SIGNAL_NUMBER, SIGNAL_RECIPIENTS, api_url=SIGNAL_URL):
+def send_signal_message_with_image(photo_id, message, SIGNAL_NUMBER, SIGNAL_RECIPIENTS, api_url=SIGNAL_URL,
+                                   poster: dict | None = None):
     """
     Отправляет текст и изображение из Jellyfin в Signal через base64_attachments.
     """
-    # Скачиваем изображение из Jellyfin
-    jellyfin_image_url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
     try:
-        image_resp = requests.get(jellyfin_image_url)
-        image_resp.raise_for_status()
-        image_bytes = image_resp.content
+        poster = _poster_or_fetch(photo_id, poster)
+        if not poster:
+            raise ValueError("image from Jellyfin is not available")
         # Кодируем в base64
-        image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+        image_b64 = base64.b64encode(poster["bytes"]).decode("utf-8")
 
         data = {
             "message": message,
@@ -1932,7 +2822,7 @@ def send_signal_message_with_image(photo_id, message, SIGNAL_NUMBER, SIGNAL_RECI
             "base64_attachments": [image_b64],
         }
 
-        resp = requests.post(api_url, json=data)
+        resp = http_client.post(api_url, json=data)
         resp.raise_for_status()
         logging.info("Signal image message sent successfully")
         return resp
@@ -1985,7 +2875,7 @@ def send_pushover_message(message: str,
             files = {"attachment": ("poster.jpg", image_bytes, "image/jpeg")}
         elif image_url:
             try:
-                ir = requests.get(image_url, timeout=6)
+                ir = http_client.get(image_url, timeout=6)
                 ir.raise_for_status()
                 content = ir.content
                 if len(content) <= 5242880:
@@ -2004,7 +2894,7 @@ def send_pushover_message(message: str,
         delay = max(0.0, PUSHOVER_RETRY_BASE_DELAY)
         for attempt in range(1, attempts + 1):
             try:
-                resp = requests.post(
+                resp = http_client.post(
                     endpoint,
                     data=data,
                     files=files,
@@ -2044,7 +2934,7 @@ def send_pushover_message(message: str,
         return False
 
 #MAtrix
-def send_matrix_image_then_text_from_jellyfin(photo_id: str, caption_markdown: str) -> bool:
+def send_matrix_image_then_text_from_jellyfin(photo_id: str, caption_markdown: str, poster: dict | None = None) -> bool:
     """
     1) Тянем постер из Jellyfin
     2) Загружаем в Matrix (media repo) -> mxc://
@@ -2056,10 +2946,11 @@ def send_matrix_image_then_text_from_jellyfin(photo_id: str, caption_markdown: s
         return False
 
     # 1) картинка из Jellyfin
-    try:
-        img_bytes, mimetype, filename = _fetch_jellyfin_primary(photo_id)
-    except Exception as ex:
-        logging.warning(f"Matrix(JF): cannot fetch image from Jellyfin: {ex}")
+    poster = _poster_or_fetch(photo_id, poster)
+    if poster:
+        img_bytes, mimetype, filename = poster["bytes"], poster["mimetype"], poster["filename"]
+    else:
+        logging.warning("Matrix(JF): image from Jellyfin is not available")
         # хотя бы текст отправим
         resp_txt = send_matrix_text_rest(caption_markdown)
         return bool(resp_txt and resp_txt.ok)
@@ -2125,7 +3016,7 @@ def send_matrix_text_rest(message_markdown: str):
 
         # 1) Правильный путь: PUT (спецификация)
         try:
-            resp = requests.put(url, headers=headers, json=payload, timeout=30)
+            resp = http_client.put(url, headers=headers, json=payload, timeout=30)
             resp.raise_for_status()
             logging.info("Matrix text sent successfully via PUT v3")
             return resp
@@ -2134,7 +3025,7 @@ def send_matrix_text_rest(message_markdown: str):
             if status == 405:
                 # 2) Фоллбэк: POST тем же урлом (некоторые reverse-proxy режут PUT)
                 logging.warning("Matrix PUT blocked (405). Trying POST fallback…")
-                resp2 = requests.post(url, headers=headers, json=payload, timeout=30)
+                resp2 = http_client.post(url, headers=headers, json=payload, timeout=30)
                 resp2.raise_for_status()
                 logging.info("Matrix text sent successfully via POST fallback")
                 return resp2
@@ -2160,7 +3051,7 @@ def matrix_upload_image_rest(image_bytes: bytes, filename: str, mimetype: str =
     url_v3 = f"{base}/_matrix/media/v3/upload?filename={quote(filename)}"
 
     try:
-        r = requests.post(url_v3, headers=headers, data=image_bytes, timeout=30)
+        r = http_client.post(url_v3, headers=headers, data=image_bytes, timeout=30)
         r.raise_for_status()
         return r.json().get("content_uri")
     except requests.exceptions.HTTPError as e:
@@ -2169,7 +3060,7 @@ def matrix_upload_image_rest(image_bytes: bytes, filename: str, mimetype: str =
             logging.warning(f"media/v3/upload returned {code}, trying r0…")
             try:
                 url_r0 = f"{base}/_matrix/media/r0/upload?filename={quote(filename)}"
-                r2 = requests.post(url_r0, headers=headers, data=image_bytes, timeout=30)
+                r2 = http_client.post(url_r0, headers=headers, data=image_bytes, timeout=30)
                 r2.raise_for_status()
                 return r2.json().get("content_uri")
             except Exception as ex2:
@@ -2199,14 +3090,14 @@ def _matrix_send_event_rest(room_id: str, event_type: str, content: dict):
     headers = {"Authorization": f"Bearer {MATRIX_ACCESS_TOKEN}", "Content-Type": "application/json"}
 
     try:
-        resp = requests.put(url, headers=headers, json=content, timeout=30)
+        resp = http_client.put(url, headers=headers, json=content, timeout=30)
         resp.raise_for_status()
         return resp
     except requests.exceptions.HTTPError as e:
         if getattr(e.response, "status_code", None) == 405:
             logging.warning("PUT blocked (405). Trying POST fallback…")
             try:
-                resp2 = requests.post(url, headers=headers, json=content, timeout=30)
+                resp2 = http_client.post(url, headers=headers, json=content, timeout=30)
                 resp2.raise_for_status()
                 return resp2
             except Exception as ex2:
@@ -2226,7 +3117,7 @@ def _jf_list_active_sessions(active_within_sec: int) -> list:
             "api_key": JELLYFIN_API_KEY,
             "ActiveWithinSeconds": str(active_within_sec)
         }
-        r = requests.get(f"{JELLYFIN_BASE_URL}/Sessions", params=params, timeout=10)
+        r = http_client.get(f"{JELLYFIN_BASE_URL}/Sessions", params=params, timeout=10)
         r.raise_for_status()
         return r.json() or []
     except Exception as ex:
@@ -2244,7 +3135,7 @@ def _jf_send_session_message(session_id: str, header: str, text: str, timeout_ms
         if not JELLYFIN_INAPP_FORCE_MODAL and (timeout_ms is not None) and (int(timeout_ms) > 0):
             payload["TimeoutMs"] = int(timeout_ms)
 
-        r = requests.post(url, headers=headers, json=payload, timeout=8)
+        r = http_client.post(url, headers=headers, json=payload, timeout=8)
         if r.status_code not in (200, 204):
             logging.warning(f"JF message {session_id} failed {r.status_code}: {r.text[:200]}")
             return False
@@ -2323,7 +3214,7 @@ def send_homeassistant_message(message: str,
         if domain != "persistent_notification" and image_url:
             payload["data"] = {"image": image_url}
 
-        resp = requests.post(url, headers=headers, json=payload, timeout=8, verify=HA_VERIFY_SSL)
+        resp = http_client.post(url, headers=headers, json=payload, timeout=8, verify=HA_VERIFY_SSL)
         if resp.status_code != 200:
             logging.warning(f"Home Assistant notify failed {resp.status_code}: {resp.text[:300]}")
             return False
@@ -2386,7 +3277,7 @@ def send_synology_chat_message(text: str, file_url: str | None = None) -> bool:
 
         for attempt in range(1, attempts + 1):
             # --- Попытка №1: form ---
-            r1 = requests.post(
+            r1 = http_client.post(
                 SYNOCHAT_WEBHOOK_URL,
                 data={"payload": json.dumps(payload, ensure_ascii=False)},
                 timeout=SYNOCHAT_TIMEOUT_SEC,
@@ -2398,7 +3289,7 @@ def send_synology_chat_message(text: str, file_url: str | None = None) -> bool:
                 return True
 
             # --- Попытка №2: JSON body ---
-            r2 = requests.post(
+            r2 = http_client.post(
                 SYNOCHAT_WEBHOOK_URL,
                 headers={"Content-Type": "application/json"},
                 json=payload,
@@ -2472,243 +3363,324 @@ def _synochat_resp_ok(resp):
 
 
 
-def send_notification(item_id: str, caption_markdown: str):
-    """
-    1) Всегда пытаемся отправить в Telegram (фото+подпись) с фолбэком на (фото отдельно + текст отдельно).
-    2) Параллельно/последовательно пытаемся Discord, Slack, Email, Gotify (если настроено).
-    """
-    # Telegram (с фолбэком)
-    if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
-        tg_response = send_telegram_photo(item_id, caption_markdown)
-        if tg_response and tg_response.ok:
-            logging.info("Notification sent via Telegram")
-        else:
-            # ФОЛБЭК: разбиваем на два сообщения (фото -> текст)
-            logging.warning("Telegram (photo+caption) failed; trying split: photo-only then text…")
-            ok_photo = send_telegram_photo_only(item_id)
-            ok_text  = send_telegram_text(caption_markdown)
-            if ok_photo and ok_text:
-                logging.info("Telegram split (photo then text) sent successfully")
-            else:
-                logging.warning("Telegram split fallback failed")
-
-    # Для сервисов, которым нужен внешний URL на картинку
-    uploaded_url = get_jellyfin_image_and_upload_imgbb(item_id)
+#Рассылка по каналам: каждый включённый канал — отдельная задача в общем пуле
+_notify_executor = ThreadPoolExecutor(max_workers=max(1, NOTIFY_MAX_WORKERS), thread_name_prefix="notify")
 
-    # Discord
-    if DISCORD_WEBHOOK_URL:
-        discord_response = send_discord_message(item_id, caption_markdown, uploaded_url=uploaded_url)
-        if discord_response and discord_response.ok:
-            logging.info("Notification sent via Discord")
-        else:
-            logging.warning("Notification failed via Discord")
 
-    # ======= SLACK: файл-изображение с комментарием =======
+def _notify_uploaded_url(ctx: dict) -> str | None:
+    """Ждёт загрузку постера на imgbb (если она запущена для этого уведомления)."""
+    fut = ctx.get("imgbb")
+    if fut is None:
+        return None
     try:
-        if SLACK_BOT_TOKEN and SLACK_CHANNEL_ID:
-            ok = send_slack_message_with_image_from_jellyfin(item_id, caption_markdown)
-            if ok:
-                logging.info("Notification sent via Slack")
-            else:
-                logging.warning("Notification failed via Slack")
-        else:
-            logging.debug("Slack disabled or not configured; skip.")
-    except Exception as sl_ex:
-        logging.warning(f"Slack send failed: {sl_ex}")
-    # =====================================================
+        return fut.result(timeout=NOTIFY_DEADLINE_SEC)
+    except TimeoutError:
+        logging.warning("IMGBB upload not finished before notification deadline; continue without image URL.")
+        return None
+    except Exception as ex:
+        logging.warning(f"IMGBB upload for notification failed: {ex}")
+        return None
 
-    # Email
-    # ======= EMAIL: письмо с inline-картинкой из Jellyfin =======
-    try:
-        if SMTP_TO and SMTP_HOST:
-            email_ok = send_email_with_image_jellyfin(item_id, subject=SMTP_SUBJECT, body_markdown=caption_markdown)
-            if email_ok:
-                logging.info("Notification sent via Email")
-            else:
-                logging.warning("Notification failed via Email")
-    except Exception as em_ex:
-        logging.warning(f"Email send failed: {em_ex}")
 
-    # Gotify
-    if GOTIFY_URL and GOTIFY_TOKEN:
-        gotify_response = send_gotify_message(item_id, caption_markdown, uploaded_url=uploaded_url)
-        if gotify_response and gotify_response.ok:
-            logging.info("Notification sent via Gotify")
-        else:
-            logging.warning("Notification failed via Gotify")
+def _notify_telegram(ctx: dict) -> bool:
+    item_id, caption_markdown = ctx["item_id"], ctx["caption"]
+    tg_response = send_telegram_photo(item_id, caption_markdown, poster=ctx["poster"])
+    if tg_response and tg_response.ok:
+        logging.info("Notification sent via Telegram")
+        return True
+    # ФОЛБЭК: разбиваем на два сообщения (фото -> текст)
+    logging.warning("Telegram (photo+caption) failed; trying split: photo-only then text…")
+    ok_photo = send_telegram_photo_only(item_id, poster=ctx["poster"])
+    ok_text  = send_telegram_text(caption_markdown)
+    if ok_photo and ok_text:
+        logging.info("Telegram split (photo then text) sent successfully")
+        return True
+    logging.warning("Telegram split fallback failed")
+    return False
 
-    # ======= MATRIX (REST): СНАЧАЛА изображение из Jellyfin, затем текст =======
-    try:
-        if MATRIX_URL and MATRIX_ACCESS_TOKEN and MATRIX_ROOM_ID:
-            ok = send_matrix_image_then_text_from_jellyfin(item_id, caption_markdown)
-            if ok:
-                logging.info("Notification sent via Matrix (REST, image from Jellyfin then text)")
-            else:
-                logging.warning("Matrix (REST, Jellyfin): image+text flow failed; trying text-only fallback")
-                send_matrix_text_rest(caption_markdown)
-        else:
-            logging.debug("Matrix disabled or not configured; skip.")
-    except Exception as m_ex:
-        logging.warning(f"Matrix send failed: {m_ex}")
 
-#reddit
-    try:
-        if REDDIT_ENABLED:
-            # Заголовок = «шапка» (первая жирная строка), тело = caption БЕЗ «шапки»
-            post_title, body_md = _split_caption_for_reddit(caption_markdown or "")
-            external_url = uploaded_url or None  # прямой URL на постер (если есть)
-
-            if REDDIT_SPLIT_TO_COMMENT and external_url:
-                # Режим 1: пост-ссылка (картинка), описание — комментарием
-                send_reddit_link_post_with_comment(
-                    title=post_title,
-                    url=external_url,
-                    body_markdown=body_md
-                )
-            else:
-                # Режим 0: обычный self-post; если есть URL — поставим его первой строкой в самом посте
-                send_reddit_post(
-                    title=post_title,
-                    body_markdown=body_md,
-                    external_image_url=external_url  # может быть None — тогда просто текст
-                )
-    except Exception as ex:
-        logging.warning(f"Reddit wrapper failed: {ex}")
+def _notify_discord(ctx: dict) -> bool:
+    discord_response = send_discord_message(ctx["item_id"], ctx["caption"], poster=ctx["poster"])
+    if discord_response and discord_response.ok:
+        logging.info("Notification sent via Discord")
+        return True
+    logging.warning("Notification failed via Discord")
+    return False
 
-    # ======= WHATSAPP: сначала картинка с подписью (с ретраями), при провале — текст =======
-    try:
-        wa_jid = _wa_get_jid_from_env()
-        if WHATSAPP_API_URL and wa_jid:
-            ok_img = send_whatsapp_image_with_retries(
-                caption=caption_markdown,
-                phone_jid=wa_jid,
-                image_url=uploaded_url
-            )
-            if not ok_img:
-                logging.warning("WhatsApp image failed after retries; sending text-only fallback")
-                send_whatsapp_text_via_rest(caption_markdown, phone_jid=wa_jid)
-        else:
-            logging.debug("WhatsApp disabled or no JID; skip WhatsApp send.")
-    except Exception as wa_ex:
-        logging.warning(f"WhatsApp send block failed: {wa_ex}")
 
-    # --- ОТПРАВКА В SIGNAL ---
-    # Plain text для Signal (без Markdown)
-    if SIGNAL_URL and SIGNAL_NUMBER:
-        signal_resp = send_signal_message_with_image(
-            item_id,
-            clean_markdown_for_apprise(caption_markdown),
-            SIGNAL_NUMBER,
-            SIGNAL_RECIPIENTS
-        )
-        if signal_resp and signal_resp.ok:
-            logging.info("Notification sent via Signal")
-        else:
-            logging.warning("Notification failed via Signal")
+def _notify_slack(ctx: dict) -> bool:
+    ok = send_slack_message_with_image_from_jellyfin(ctx["item_id"], ctx["caption"], poster=ctx["poster"])
+    if ok:
+        logging.info("Notification sent via Slack")
+    else:
+        logging.warning("Notification failed via Slack")
+    return bool(ok)
 
-#Отправка в pushover
-    try:
-        if PUSHOVER_USER_KEY and PUSHOVER_TOKEN:
-            _title = "Jellyfin"
-            # опционально: вытащим заголовок из первой жирной строки сообщения
-            img_bytes = _safe_fetch_jellyfin_image_bytes(item_id)  # <— напрямую из Jellyfin
-            # uploaded_url — ваш уже известный URL постера (если есть)
-            html_msg = markdown_to_pushover_html(caption_markdown or "")
-            send_pushover_message(
-                message=html_msg,
-                title=_title,
-                image_bytes=img_bytes,  # <— передаём байты, никаких i.ibb.co
-                sound=(PUSHOVER_SOUND or None),
-                priority=PUSHOVER_PRIORITY,
-                device=(PUSHOVER_DEVICE or None),
-                html=True
-            )
-    except Exception as ex:
-        logging.warning(f"Pushover wrapper failed: {ex}")
 
-#отправка в jellyfin
-    try:
-        if JELLYFIN_INAPP_ENABLED:
-            # Для клиентов Jellyfin лучше plain text без Markdown
-            jf_header, jf_text = make_jf_inapp_payload_from_caption(caption_markdown or "")
-            send_jellyfin_inapp_message(
-                message=jf_text,
-                title=jf_header
-            )
-    except Exception as ex:
-        logging.warning(f"Jellyfin in-app notify failed: {ex}")
+def _notify_email(ctx: dict) -> bool:
+    email_ok = send_email_with_image_jellyfin(ctx["item_id"], subject=SMTP_SUBJECT, body_markdown=ctx["caption"],
+                                              poster=ctx["poster"])
+    if email_ok:
+        logging.info("Notification sent via Email")
+    else:
+        logging.warning("Notification failed via Email")
+    return bool(email_ok)
 
-#Отправка в home assistant
-    try:
-        if HA_BASE_URL and HA_TOKEN:
-            _title = "Jellyfin"
-            # Можно красиво вытащить заголовок из первой жирной строки, если хотите:
-            # m = re.match(r"\*\s*(.+?)\s*\*", caption); _title = (m.group(1)[:120] if m else _title)
-
-            # uploaded_url — это ваш URL постера (если он есть)
-            send_homeassistant_message(
-                message=caption_markdown,
-                title=_title,
-                service_path=None,  # берётся из HA_DEFAULT_SERVICE
-                notification_id="jellyfin",  # опционально для persistent_notification
-                image_url=uploaded_url  # <-- вот тут передаём картинку
-            )
-    except Exception as ex:
-        logging.warning(f"Home Assistant notify wrapper failed: {ex}")
 
-    # ======= Synology Chat =======
-    try:
-        if SYNOCHAT_ENABLED and SYNOCHAT_WEBHOOK_URL:
-            # plain-текст (Chat не рендерит Markdown как Telegram)
-            caption_plain = clean_markdown_for_apprise(caption_markdown or "")
-            file_url = uploaded_url if (SYNOCHAT_INCLUDE_POSTER and uploaded_url) else None
-            send_synology_chat_message(caption_plain, file_url=file_url)
-    except Exception as ex:
-        logging.warning(f"Synology Chat wrapper failed: {ex}")
-    # =============================
+def _notify_gotify(ctx: dict) -> bool:
+    gotify_response = send_gotify_message(ctx["item_id"], ctx["caption"], uploaded_url=_notify_uploaded_url(ctx))
+    if gotify_response and gotify_response.ok:
+        logging.info("Notification sent via Gotify")
+        return True
+    logging.warning("Notification failed via Gotify")
+    return False
 
 
+def _notify_matrix(ctx: dict) -> bool:
+    # СНАЧАЛА изображение из Jellyfin, затем текст
+    caption_markdown = ctx["caption"]
+    ok = send_matrix_image_then_text_from_jellyfin(ctx["item_id"], caption_markdown, poster=ctx["poster"])
+    if ok:
+        logging.info("Notification sent via Matrix (REST, image from Jellyfin then text)")
+        return True
+    logging.warning("Matrix (REST, Jellyfin): image+text flow failed; trying text-only fallback")
+    resp = send_matrix_text_rest(caption_markdown)
+    return bool(resp and resp.ok)
+
+
+def _notify_reddit(ctx: dict) -> bool:
+    # Заголовок = «шапка» (первая жирная строка), тело = caption БЕЗ «шапки»
+    post_title, body_md = _split_caption_for_reddit(ctx["caption"] or "")
+    external_url = _notify_uploaded_url(ctx) or None  # прямой URL на постер (если есть)
+
+    if REDDIT_SPLIT_TO_COMMENT and external_url:
+        # Режим 1: пост-ссылка (картинка), описание — комментарием
+        return send_reddit_link_post_with_comment(
+            title=post_title,
+            url=external_url,
+            body_markdown=body_md
+        )
+    # Режим 0: обычный self-post; если есть URL — поставим его первой строкой в самом посте
+    return send_reddit_post(
+        title=post_title,
+        body_markdown=body_md,
+        external_image_url=external_url  # может быть None — тогда просто текст
+    )
 
-#Прочее
-def _fetch_jellyfin_image_with_retries(photo_id: str, attempts: int = 3, timeout: int = 10, delay: float = 1.5):
-    """
-    Пытается скачать Primary-постер из Jellyfin с повторами.
-    Возвращает bytes или None.
-    """
-    url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
-    last_err = None
-    for i in range(1, attempts + 1):
-        try:
-            # Быстрая проверка доступности (необязательно, но полезно)
-            head = requests.head(url, timeout=timeout)
-            if head.ok:
-                resp = requests.get(url, timeout=timeout)
-                resp.raise_for_status()
-                return resp.content
-            else:
-                last_err = f"HTTP {head.status_code}"
-        except Exception as ex:
-            last_err = ex
-        logging.warning(f"Jellyfin image try {i}/{attempts} failed: {last_err}")
-        if i < attempts:
-            time.sleep(delay)
-    return None
 
-def _fetch_jellyfin_primary(photo_id: str):
-    """
-    Возвращает (bytes, mimetype, filename) для Primary-постера из Jellyfin.
-    """
-    url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-    mimetype = resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip().lower()
-    ext = ".jpg"
-    if "png" in mimetype:
-        ext = ".png"
-    elif "webp" in mimetype:
-        ext = ".webp"
-    filename = f"poster{ext}"
-    return resp.content, mimetype, filename
+def _notify_whatsapp(ctx: dict) -> bool:
+    # сначала картинка с подписью (с ретраями), при провале — текст
+    caption_markdown = ctx["caption"]
+    wa_jid = _wa_get_jid_from_env()
+    ok_img = send_whatsapp_image_with_retries(
+        caption=caption_markdown,
+        phone_jid=wa_jid,
+        image_url=_notify_uploaded_url(ctx)
+    )
+    if ok_img:
+        return True
+    logging.warning("WhatsApp image failed after retries; sending text-only fallback")
+    resp = send_whatsapp_text_via_rest(caption_markdown, phone_jid=wa_jid)
+    return bool(resp is not None and resp.ok)
+
+
+def _notify_signal(ctx: dict) -> bool:
+    # Plain text для Signal (без Markdown)
+    signal_resp = send_signal_message_with_image(
+        ctx["item_id"],
+        clean_markdown_for_apprise(ctx["caption"]),
+        SIGNAL_NUMBER,
+        SIGNAL_RECIPIENTS,
+        poster=ctx["poster"]
+    )
+    if signal_resp and signal_resp.ok:
+        logging.info("Notification sent via Signal")
+        return True
+    logging.warning("Notification failed via Signal")
+    return False
+
+
+def _notify_pushover(ctx: dict) -> bool:
+    img_bytes = (ctx["poster"] or {}).get("bytes")  # <— постер, скачанный один раз из Jellyfin
+    html_msg = markdown_to_pushover_html(ctx["caption"] or "")
+    return send_pushover_message(
+        message=html_msg,
+        title="Jellyfin",
+        image_bytes=img_bytes,  # <— передаём байты, никаких i.ibb.co
+        sound=(PUSHOVER_SOUND or None),
+        priority=PUSHOVER_PRIORITY,
+        device=(PUSHOVER_DEVICE or None),
+        html=True
+    )
+
+
+def _notify_jellyfin_inapp(ctx: dict) -> bool:
+    # Для клиентов Jellyfin лучше plain text без Markdown
+    jf_header, jf_text = make_jf_inapp_payload_from_caption(ctx["caption"] or "")
+    return send_jellyfin_inapp_message(message=jf_text, title=jf_header)
+
+
+def _notify_homeassistant(ctx: dict) -> bool:
+    return send_homeassistant_message(
+        message=ctx["caption"],
+        title="Jellyfin",
+        service_path=None,  # берётся из HA_DEFAULT_SERVICE
+        notification_id="jellyfin",  # опционально для persistent_notification
+        image_url=_notify_uploaded_url(ctx)
+    )
+
+
+def _notify_synology_chat(ctx: dict) -> bool:
+    # plain-текст (Chat не рендерит Markdown как Telegram)
+    caption_plain = clean_markdown_for_apprise(ctx["caption"] or "")
+    uploaded_url = _notify_uploaded_url(ctx) if SYNOCHAT_INCLUDE_POSTER else None
+    return send_synology_chat_message(caption_plain, file_url=uploaded_url or None)
+
+
+def _enabled_notification_channels() -> list[tuple[str, object, bool]]:
+    """
+    Список включённых каналов: (имя, функция отправки, нужен ли внешний URL постера с imgbb).
+    """
+    channels = []
+    if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
+        channels.append(("telegram", _notify_telegram, False))
+    if DISCORD_WEBHOOK_URL:
+        channels.append(("discord", _notify_discord, False))
+    if SLACK_BOT_TOKEN and SLACK_CHANNEL_ID:
+        channels.append(("slack", _notify_slack, False))
+    if SMTP_TO and SMTP_HOST:
+        channels.append(("email", _notify_email, False))
+    if GOTIFY_URL and GOTIFY_TOKEN:
+        channels.append(("gotify", _notify_gotify, True))
+    if MATRIX_URL and MATRIX_ACCESS_TOKEN and MATRIX_ROOM_ID:
+        channels.append(("matrix", _notify_matrix, False))
+    if REDDIT_ENABLED:
+        channels.append(("reddit", _notify_reddit, True))
+    if WHATSAPP_API_URL and _wa_get_jid_from_env():
+        channels.append(("whatsapp", _notify_whatsapp, True))
+    if SIGNAL_URL and SIGNAL_NUMBER:
+        channels.append(("signal", _notify_signal, False))
+    if PUSHOVER_USER_KEY and PUSHOVER_TOKEN:
+        channels.append(("pushover", _notify_pushover, False))
+    if JELLYFIN_INAPP_ENABLED:
+        channels.append(("jellyfin_inapp", _notify_jellyfin_inapp, False))
+    if HA_BASE_URL and HA_TOKEN:
+        channels.append(("homeassistant", _notify_homeassistant, True))
+    if SYNOCHAT_ENABLED and SYNOCHAT_WEBHOOK_URL:
+        channels.append(("synology_chat", _notify_synology_chat, True))
+    return channels
+
+
+def _run_notify_channel(name: str, fn, ctx: dict) -> dict:
+    started = time.monotonic()
+    try:
+        ok = bool(fn(ctx))
+        error = None
+    except Exception as ex:
+        logging.warning(f"{name} send failed: {ex}")
+        ok, error = False, str(ex)
+    return {"ok": ok, "elapsed": round(time.monotonic() - started, 3), "error": error}
+
+
+def send_notification(item_id: str, caption_markdown: str, poster: dict | None = None) -> dict:
+    """
+    Рассылает уведомление во все включённые каналы одновременно (пул на NOTIFY_MAX_WORKERS потоков).
+    Постер качается из Jellyfin один раз (или передаётся готовым из pick_jellyfin_poster)
+    и отдаётся всем каналам.
+    Ждём, пока отработают все каналы, но не дольше NOTIFY_DEADLINE_SEC — незавершённые
+    отправки продолжаются в фоне. Возвращает итог:
+      {"item_id": ..., "elapsed": 1.42, "timed_out": ["email"],
+       "channels": {"telegram": {"ok": True, "elapsed": 0.81, "error": None}, ...}}
+    """
+    started = time.monotonic()
+    channels = _enabled_notification_channels()
+    if poster is None and channels:
+        poster = fetch_jellyfin_poster(item_id)
+    # {} = «постера нет, повторно не качать» (см. _poster_or_fetch)
+    ctx = {"item_id": item_id, "caption": caption_markdown, "poster": poster or {}}
+
+    # imgbb ставим в пул первым: каналы, которым нужен внешний URL, ждут именно этот future
+    if any(needs_url for _, _, needs_url in channels):
+        ctx["imgbb"] = _notify_executor.submit(get_jellyfin_image_and_upload_imgbb, item_id, ctx["poster"])
+
+    futures = {
+        _notify_executor.submit(_run_notify_channel, name, fn, ctx): name
+        for name, fn, _ in channels
+    }
+    done, not_done = wait(futures, timeout=NOTIFY_DEADLINE_SEC)
+
+    outcome = {"item_id": item_id, "channels": {}, "timed_out": [], "elapsed": 0.0}
+    for fut, name in futures.items():
+        if fut in done:
+            outcome["channels"][name] = fut.result()
+        else:
+            outcome["channels"][name] = {"ok": None, "elapsed": None, "error": "deadline exceeded"}
+            outcome["timed_out"].append(name)
+    outcome["elapsed"] = round(time.monotonic() - started, 3)
+
+    ok_count = sum(1 for r in outcome["channels"].values() if r["ok"])
+    logging.info(
+        f"Notification {item_id}: {ok_count}/{len(channels)} channels ok in {outcome['elapsed']}s"
+        + (f"; still running after deadline: {', '.join(outcome['timed_out'])}" if outcome["timed_out"] else "")
+    )
+    return outcome
+
+
+
+#Прочее
+def fetch_jellyfin_poster(photo_id: str, attempts: int = 3, timeout: int = 10, delay: float = 1.5) -> dict | None:
+    """
+    Скачивает Primary-постер из Jellyfin ОДИН раз на уведомление (с повторами на сетевые/5xx ошибки).
+    Возвращает {"bytes": ..., "mimetype": "image/jpeg", "filename": "poster.jpg"} или None.
+    Этот объект получают все каналы send_notification вместо собственных загрузок.
+    """
+    if not photo_id:
+        return None
+    url = f"{JELLYFIN_BASE_URL}/Items/{photo_id}/Images/Primary"
+    last_err = None
+    for i in range(1, attempts + 1):
+        try:
+            resp = http_client.get(url, params={"api_key": JELLYFIN_API_KEY}, timeout=timeout)
+            if resp.status_code == 404:
+                # постера просто нет — повторять бессмысленно
+                return None
+            resp.raise_for_status()
+            if not resp.content:
+                return None
+            mimetype = resp.headers.get("Content-Type", "image/jpeg").split(";")[0].strip().lower()
+            ext = ".jpg"
+            if "png" in mimetype:
+                ext = ".png"
+            elif "webp" in mimetype:
+                ext = ".webp"
+            else:
+                mimetype = "image/jpeg"
+            return {"bytes": resp.content, "mimetype": mimetype, "filename": f"poster{ext}"}
+        except Exception as ex:
+            last_err = ex
+        logging.warning(f"Jellyfin image try {i}/{attempts} failed for {photo_id}: {last_err}")
+        if i < attempts:
+            time.sleep(delay)
+    return None
+
+def _poster_or_fetch(photo_id: str, poster: dict | None) -> dict | None:
+    """
+    Постер, переданный из send_notification, либо (при прямом вызове канала) — свежая загрузка.
+    Пустой dict означает «уже пробовали, постера нет» и повторно не качается.
+    """
+    if poster is None:
+        return fetch_jellyfin_poster(photo_id)
+    return poster or None
+
+def pick_jellyfin_poster(primary_id: str, fallback_id: str | None = None) -> tuple[str, dict | None]:
+    """
+    Выбирает, чей постер показывать (сезон → сериал), и сразу возвращает скачанный постер,
+    чтобы send_notification не тянул его повторно: (target_id, poster | None).
+    """
+    poster = fetch_jellyfin_poster(primary_id)
+    if poster or not fallback_id:
+        return primary_id, poster
+    return fallback_id, None
 
 def _wa_get_jid_from_env():
     """
@@ -2733,21 +3705,6 @@ def _wa_get_jid_from_env():
     local = re.sub(r"\D", "", raw)
     return f"{local}@s.whatsapp.net" if local else None
 
-def _safe_fetch_jellyfin_image_bytes(item_id: str) -> bytes | None:
-    """
-    Скачивает постер напрямую из Jellyfin, возвращает bytes либо None.
-    """
-    try:
-        url = f"{JELLYFIN_BASE_URL}/Items/{item_id}/Images/Primary"
-        # если требуется ключ в query, раскомментируй следующую строку:
-        # url = f"{url}?api_key={JELLYFIN_API_KEY}"
-        r = requests.get(url, timeout=6)
-        r.raise_for_status()
-        return r.content
-    except Exception as ex:
-        logging.debug(f"Pushover: Jellyfin image fetch failed for {item_id}: {ex}")
-        return None
-
 
 #Перевод
 MESSAGES = {
@@ -2864,28 +3821,7 @@ def _format_quality_diff_for_message(old_snap: dict, new_snap: dict) -> str:
 
 
 #Проба отслеживания качества
-# ---------- Radarr helpers: JSON state & snapshots ----------
-
-def _load_json(path: str) -> dict:
-    with RADARR_JSON_LOCK:
-        try:
-            if os.path.exists(path):
-                with open(path, "r", encoding="utf-8") as f:
-                    return json.load(f) or {}
-        except Exception as ex:
-            logging.warning(f"Radarr: load_json failed: {ex}")
-        return {}
-
-def _store_json(path: str, data: dict) -> None:
-    with RADARR_JSON_LOCK:
-        try:
-            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
-            tmp = path + ".tmp"
-            with open(tmp, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            os.replace(tmp, path)
-        except Exception as ex:
-            logging.warning(f"Radarr: store_json failed: {ex}")
+# ---------- Radarr helpers: snapshots ----------
 
 def _now_ts() -> float:
     import time as _t
@@ -2908,6 +3844,280 @@ def _format_snap_for_text(s: dict) -> str:
 
 
 
+#Нормализованные названия: сравнение кандидатов без SequenceMatcher на каждый элемент
+_TITLE_YEAR_RE = re.compile(r"\s*[(\[](\d{4})[)\]]\s*$")
+_TITLE_PUNCT_RE = re.compile(r"[^\w\s]+|_")
+TITLE_SHORTLIST = 8   # сколько лучших по токенам кандидатов вообще рассматриваем
+
+
+def normalize_title(title) -> tuple[str, int | None]:
+    """'Star Wars: Andor (2022)' → ('star wars andor', 2022): casefold, без диакритики и пунктуации, год отдельно."""
+    s = unicodedata.normalize("NFKD", str(title or ""))
+    s = "".join(ch for ch in s if not unicodedata.combining(ch)).casefold().strip()
+    year = None
+    m = _TITLE_YEAR_RE.search(s)
+    if m:
+        year, s = int(m.group(1)), s[:m.start()]
+    s = _TITLE_PUNCT_RE.sub(" ", s.replace("&", " and "))
+    return " ".join(s.split()), year
+
+
+def rank_by_title(cands: list, expected_title: str | None, expected_year=None) -> list:
+    """
+    Кандидаты по убыванию: совпал год → совпало нормализованное название → доля общих токенов.
+    SequenceMatcher — только как последний довод для ничьей в верхушке списка.
+    """
+    want, title_year = normalize_title(expected_title)
+    expected_year = expected_year or title_year
+    want_tokens = set(want.split())
+
+    def rank(it):
+        norm = it.get("norm")
+        if norm is None:
+            norm = normalize_title(it.get("Name"))[0]
+        tokens = set(norm.split())
+        union = want_tokens | tokens
+        year = it.get("ProductionYear")
+        year_ok = bool(expected_year and year and int(year) == int(expected_year))
+        return year_ok, bool(want) and norm == want, len(want_tokens & tokens) / len(union) if union else 0.0
+
+    ranked = sorted(cands, key=rank, reverse=True)
+    if want and len(ranked) > 1 and rank(ranked[0]) == rank(ranked[1]):
+        top = rank(ranked[0])
+        tied = [it for it in ranked[:TITLE_SHORTLIST] if rank(it) == top]
+        tied.sort(key=lambda it: SequenceMatcher(None, want, it.get("norm") or normalize_title(it.get("Name"))[0]).ratio(),
+                  reverse=True)
+        ranked = tied + ranked[len(tied):]
+    return ranked
+
+
+#Индекс Jellyfin по внешним ID (TVDB/TMDb/TVMaze/IMDb) для Series и Movie
+class ProviderIdIndex:
+    """
+    In-memory индекс (тип, провайдер, id) → элементы Jellyfin, чтобы не выкачивать всю библиотеку
+    на каждую проверку Radarr/Sonarr. Строится один раз при первом обращении, дальше
+    поддерживается инкрементально: вебхуками Jellyfin (note_webhook) и дельтами по
+    MinDateLastSaved (не чаще PROVIDER_INDEX_DELTA_SEC). Полная перестройка — rebuild() / POST /index/rebuild.
+    Там же — токены нормализованных названий (find_by_title) для записей без внешних ID.
+    """
+    PROVIDER_KEYS = {
+        "tvdb":   ("tvdb", "tvdbid", "thetvdb"),
+        "tmdb":   ("tmdb", "tmdbid", "themoviedb"),
+        "tvmaze": ("tvmaze", "tvmazeid"),
+        "imdb":   ("imdb", "imdbid"),
+    }
+    ITEM_TYPES = ("Series", "Movie")
+    PAGE_SIZE = 2000
+    MISS_DELTA_MIN_SEC = 10.0   # внеочередная дельта по промаху lookup — не чаще
+
+    def __init__(self, delta_sec: float):
+        self.delta_sec = float(delta_sec)
+        self._lock = threading.RLock()          # структуры индекса; под ним только работа в памяти
+        self._refresh_lock = threading.RLock()  # одна выгрузка из Jellyfin за раз; HTTP идёт без self._lock
+        self._items: dict = {}    # item_id -> {"Id", "Type", "Name", "ProductionYear", "keys": [...]}
+        self._by_key: dict = {}   # (type, provider, value) -> set(item_id)
+        self._by_token: dict = {} # (type, токен названия) -> set(item_id)
+        self._built_ts = 0.0
+        self._synced_ts = 0.0     # момент, начиная с которого следующая дельта спрашивает изменения
+        self._delta_checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.deltas = 0
+
+    def _keys_for(self, item_type: str, provider_ids: dict) -> list:
+        keys = []
+        norm = {str(k).strip().lower(): v for k, v in (provider_ids or {}).items()}
+        for provider, names in self.PROVIDER_KEYS.items():
+            for name in names:
+                v = norm.get(name)
+                if v:
+                    keys.append((item_type, provider, str(v).strip().lower()))
+        return keys
+
+    def upsert(self, item: dict) -> None:
+        item_id = item.get("Id")
+        item_type = item.get("Type")
+        if not item_id or item_type not in self.ITEM_TYPES:
+            return
+        keys = self._keys_for(item_type, item.get("ProviderIds"))
+        norm = normalize_title(item.get("Name"))[0]
+        with self._lock:
+            self._drop(item_id)
+            self._items[item_id] = {
+                "Id": item_id, "Type": item_type,
+                "Name": item.get("Name"), "ProductionYear": item.get("ProductionYear"),
+                "norm": norm, "keys": keys,
+            }
+            for k in keys:
+                self._by_key.setdefault(k, set()).add(item_id)
+            for tok in set(norm.split()):
+                self._by_token.setdefault((item_type, tok), set()).add(item_id)
+
+    def remove(self, item_id: str) -> None:
+        with self._lock:
+            self._drop(item_id)
+
+    def _drop(self, item_id: str) -> None:
+        old = self._items.pop(item_id, None)
+        if not old:
+            return
+        postings = [(self._by_key, k) for k in old["keys"]]
+        postings += [(self._by_token, (old["Type"], tok)) for tok in set(old["norm"].split())]
+        for index, k in postings:
+            ids = index.get(k)
+            if ids:
+                ids.discard(item_id)
+                if not ids:
+                    del index[k]
+
+    def _fetch(self, extra: dict) -> list:
+        items, start = [], 0
+        while True:
+            params = {
+                "api_key": JELLYFIN_API_KEY,
+                "IncludeItemTypes": ",".join(self.ITEM_TYPES),
+                "Recursive": "true",
+                "Fields": "ProviderIds,ProductionYear",
+                "EnableImages": "false",
+                "EnableUserData": "false",
+                "StartIndex": start,
+                "Limit": self.PAGE_SIZE,
+                **extra,
+            }
+            r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=30)
+            r.raise_for_status()
+            page = (r.json() or {}).get("Items") or []
+            items.extend(page)
+            if len(page) < self.PAGE_SIZE:
+                return items
+            start += len(page)
+
+    def rebuild(self) -> int:
+        with self._refresh_lock:
+            started = _now_ts()
+            items = self._fetch({})
+            with self._lock:
+                self._items.clear()
+                self._by_key.clear()
+                self._by_token.clear()
+                for it in items:
+                    self.upsert(it)
+                self._built_ts = self._synced_ts = self._delta_checked = started
+                self.rebuilds += 1
+        logging.info(f"Provider index: rebuilt with {len(items)} series/movies in {round(_now_ts() - started, 2)}s")
+        return len(items)
+
+    def refresh_delta(self, force: bool = False, min_gap_sec: float = 0.0) -> int:
+        """
+        Подтягивает элементы, изменённые после прошлой синхронизации (MinDateLastSaved).
+        Обычная дельта — не чаще delta_sec и пропускается, если выгрузка уже идёт в другом потоке;
+        force — не раньше min_gap_sec после прошлой и с ожиданием идущей выгрузки.
+        """
+        with self._lock:
+            built = bool(self._built_ts)
+        if not self._refresh_lock.acquire(blocking=force or not built):
+            return 0
+        try:
+            with self._lock:
+                if not self._built_ts:
+                    built = False
+                else:
+                    now = _now_ts()
+                    if now - self._delta_checked < (min_gap_sec if force else self.delta_sec):
+                        return 0
+                    self._delta_checked = now
+                    # небольшой запас назад — на расхождение часов и неатомарность сохранения в Jellyfin
+                    since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self._synced_ts - 60))
+            if not built:
+                return self.rebuild()
+            items = self._fetch({"MinDateLastSaved": since})
+            with self._lock:
+                for it in items:
+                    self.upsert(it)
+                self._synced_ts = now
+                self.deltas += 1
+        finally:
+            self._refresh_lock.release()
+        if items:
+            logging.debug(f"Provider index: delta applied, {len(items)} changed item(s)")
+        return len(items)
+
+    def _refresh_quietly(self, force: bool = False) -> None:
+        try:
+            self.refresh_delta(force=force, min_gap_sec=self.MISS_DELTA_MIN_SEC)
+        except Exception as ex:
+            logging.warning(f"Provider index refresh failed: {ex}")
+
+    def lookup(self, item_type: str, provider: str, value) -> list:
+        """
+        Кандидаты [{"Id", "Name", "ProductionYear"}] по одному провайдеру. Перед поиском — обычная дельта
+        (не чаще delta_sec); при промахе — внеочередная (не чаще MISS_DELTA_MIN_SEC) и повторный поиск.
+        """
+        if not value:
+            return []
+        key = (item_type, provider, str(value).strip().lower())
+        self._refresh_quietly()
+        for attempt in range(2):
+            with self._lock:
+                ids = self._by_key.get(key)
+                if ids:
+                    self.hits += 1
+                    return [dict(self._items[i]) for i in ids]
+            if attempt == 0:
+                self._refresh_quietly(force=True)
+        with self._lock:
+            self.misses += 1
+        return []
+
+    def find_by_title(self, item_type: str, title: str | None, year=None) -> list:
+        """
+        Кандидаты по названию: элементы, у которых совпала хотя бы половина токенов,
+        упорядоченные rank_by_title; обрезаем до TITLE_SHORTLIST только после ранжирования всех,
+        иначе у однословного названия точное совпадение может потеряться среди равных по счёту.
+        """
+        tokens = set(normalize_title(title)[0].split())
+        if not tokens:
+            return []
+        self._refresh_quietly()
+        hits = Counter()
+        with self._lock:
+            for tok in tokens:
+                hits.update(self._by_token.get((item_type, tok), ()))
+            need = (len(tokens) + 1) // 2
+            cands = [dict(self._items[i]) for i, n in hits.items() if n >= need]
+        return rank_by_title(cands, title, year)[:TITLE_SHORTLIST]
+
+    def note_webhook(self, payload: dict) -> None:
+        """Jellyfin webhook (Movie/Series): добавить/обновить элемент или убрать удалённый."""
+        item_type = payload.get("ItemType")
+        item_id = payload.get("ItemId")
+        if item_type not in self.ITEM_TYPES or not item_id:
+            return
+        if str(payload.get("NotificationType") or "").lower() == "itemdeleted":
+            self.remove(item_id)
+            return
+        with self._lock:
+            if not self._built_ts:
+                return   # индекс ещё не строился — всё равно подтянется целиком
+        name = payload.get("Name") or ""
+        year = payload.get("Year")
+        if year:
+            name = name.replace(f" ({year})", "").strip()
+        provider_ids = {k[len("Provider_"):]: v for k, v in payload.items() if k.startswith("Provider_") and v}
+        self.upsert({"Id": item_id, "Type": item_type, "Name": name, "ProductionYear": year, "ProviderIds": provider_ids})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"items": len(self._items), "keys": len(self._by_key), "tokens": len(self._by_token),
+                    "built_ts": self._built_ts,
+                    "synced_ts": self._synced_ts, "hits": self.hits, "misses": self.misses,
+                    "rebuilds": self.rebuilds, "deltas": self.deltas}
+
+
+provider_index = ProviderIdIndex(PROVIDER_INDEX_DELTA_SEC)
+
+
 def _provider_imdb_equals(item: dict, imdb_id: str) -> bool:
     p = (item.get("ProviderIds") or {})
     imdb_id = (imdb_id or "").strip().lower()
@@ -2917,74 +4127,36 @@ def _provider_imdb_equals(item: dict, imdb_id: str) -> bool:
             return True
     return False
 
-def _jf_find_movie_by_imdb(imdb_id: str, expected_title: str | None = None, expected_year: int | None = None):
-    imdb_id = (imdb_id or "").strip()
-    if not imdb_id:
-        return None
-    # 1) Прямой запрос AnyProviderIdEquals
+def _jf_movies_by_any_provider_id(value: str, matches) -> list:
+    """Прямой запрос AnyProviderIdEquals (для свежих фильмов, которых ещё нет в индексе) + строгая проверка ProviderIds."""
     try:
         params = {
             "api_key": JELLYFIN_API_KEY,
             "IncludeItemTypes": "Movie",
             "Recursive": "true",
-            "AnyProviderIdEquals": imdb_id,
+            "AnyProviderIdEquals": value,
             "Fields": "ProviderIds,ProductionYear,Name,DateCreated"
         }
-        url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=params, timeout=10)
+        r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=10)
         if r.ok:
-            items = (r.json() or {}).get("Items") or []
-            cands = [it for it in items if _provider_imdb_equals(it, imdb_id)]
-            if cands:
-                # Выбор лучшего: совпадение по году → по «похожести» имени → по дате создания
-                def score(it):
-                    s = 0
-                    y = it.get("ProductionYear")
-                    if expected_year and y and int(y) == int(expected_year): s += 100
-                    if expected_title:
-                        from difflib import SequenceMatcher
-                        s += int(SequenceMatcher(None,
-                            (expected_title or "").strip().casefold(),
-                            (it.get("Name") or "").strip().casefold()).ratio() * 50)
-                    # более свежие — чутка предпочтительнее
-                    s += 1
-                    return s
-                best = sorted(cands, key=score, reverse=True)[0]
-                return best.get("Id"), best.get("Name"), best.get("ProductionYear")
+            cands = [it for it in (r.json() or {}).get("Items") or [] if matches(it, value)]
+            for it in cands:
+                provider_index.upsert(dict(it, Type="Movie"))
+            return cands
     except Exception as ex:
-        logging.debug(f"_jf_find_movie_by_imdb direct failed: {ex}")
+        logging.debug(f"AnyProviderIdEquals lookup failed for {value}: {ex}")
+    return []
 
-    # 2) Фолбэк: большой список + явная проверка ProviderIds.Imdb
-    try:
-        params = {
-            "api_key": JELLYFIN_API_KEY,
-            "IncludeItemTypes": "Movie",
-            "Recursive": "true",
-            "Fields": "ProviderIds,ProductionYear,Name",
-            "StartIndex": 0, "Limit": 10000
-        }
-        url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=params, timeout=20)
-        if r.ok:
-            items = (r.json() or {}).get("Items") or []
-            cands = [it for it in items if _provider_imdb_equals(it, imdb_id)]
-            if cands:
-                # тот же скоринг
-                def score(it):
-                    s = 0
-                    y = it.get("ProductionYear")
-                    if expected_year and y and int(y) == int(expected_year): s += 100
-                    if expected_title:
-                        from difflib import SequenceMatcher
-                        s += int(SequenceMatcher(None,
-                            (expected_title or "").strip().casefold(),
-                            (it.get("Name") or "").strip().casefold()).ratio() * 50)
-                    return s
-                best = sorted(cands, key=score, reverse=True)[0]
-                return best.get("Id"), best.get("Name"), best.get("ProductionYear")
-    except Exception as ex:
-        logging.warning(f"_jf_find_movie_by_imdb fallback failed: {ex}")
-    return None
+def _jf_find_movie_by_imdb(imdb_id: str, expected_title: str | None = None, expected_year: int | None = None):
+    imdb_id = (imdb_id or "").strip()
+    if not imdb_id:
+        return None
+    # 1) Индекс по ProviderIds → 2) прямой запрос AnyProviderIdEquals
+    cands = provider_index.lookup("Movie", "imdb", imdb_id) or _jf_movies_by_any_provider_id(imdb_id, _provider_imdb_equals)
+    if not cands:
+        return None
+    best = rank_by_title(cands, expected_title, expected_year)[0]
+    return best.get("Id"), best.get("Name"), best.get("ProductionYear")
 
 def _provider_tmdb_equals(item: dict, tmdb_id: str | int) -> bool:
     """Жёсткая проверка ProviderIds на TMDb ID (с учётом разных ключей)."""
@@ -3001,63 +4173,12 @@ def _jf_find_movie_by_tmdb(tmdb_id: str | int, expected_title: str | None = None
     tid = str(tmdb_id).strip()
     if not tid:
         return None
-
-    def _score(it: dict) -> int:
-        s = 0
-        y = it.get("ProductionYear")
-        if expected_year and y and int(y) == int(expected_year):
-            s += 100
-        if expected_title:
-            from difflib import SequenceMatcher
-            s += int(
-                SequenceMatcher(None,
-                                (expected_title or "").strip().casefold(),
-                                (it.get("Name") or "").strip().casefold()
-                ).ratio() * 50
-            )
-        return s
-
-    # 1) Прямой запрос + фильтрация по ProviderIds
-    try:
-        params = {
-            "api_key": JELLYFIN_API_KEY,
-            "IncludeItemTypes": "Movie",
-            "Recursive": "true",
-            "AnyProviderIdEquals": tid,
-            "Fields": "ProviderIds,ProductionYear,Name,DateCreated"
-        }
-        url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=params, timeout=10)
-        if r.ok:
-            items = (r.json() or {}).get("Items") or []
-            cands = [it for it in items if _provider_tmdb_equals(it, tid)]
-            if cands:
-                best = sorted(cands, key=_score, reverse=True)[0]
-                return best.get("Id"), best.get("Name"), best.get("ProductionYear")
-    except Exception as ex:
-        logging.debug(f"_jf_find_movie_by_tmdb direct failed: {ex}")
-
-    # 2) Фолбэк: большой лист + явная проверка ProviderIds.Tmdb
-    try:
-        params = {
-            "api_key": JELLYFIN_API_KEY,
-            "IncludeItemTypes": "Movie",
-            "Recursive": "true",
-            "Fields": "ProviderIds,ProductionYear,Name",
-            "StartIndex": 0, "Limit": 10000
-        }
-        url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=params, timeout=20)
-        if r.ok:
-            items = (r.json() or {}).get("Items") or []
-            cands = [it for it in items if _provider_tmdb_equals(it, tid)]
-            if cands:
-                best = sorted(cands, key=_score, reverse=True)[0]
-                return best.get("Id"), best.get("Name"), best.get("ProductionYear")
-    except Exception as ex:
-        logging.warning(f"_jf_find_movie_by_tmdb fallback failed: {ex}")
-
-    return None
+    # 1) Индекс по ProviderIds → 2) прямой запрос AnyProviderIdEquals
+    cands = provider_index.lookup("Movie", "tmdb", tid) or _jf_movies_by_any_provider_id(tid, _provider_tmdb_equals)
+    if not cands:
+        return None
+    best = rank_by_title(cands, expected_title, expected_year)[0]
+    return best.get("Id"), best.get("Name"), best.get("ProductionYear")
 
 
 def _channels_to_float(ch) -> float:
@@ -3229,6 +4350,15 @@ def radarr_webhook():
         return "forbidden", 403
 
     data = request.get_json(silent=True) or {}
+    if EVENT_QUEUE_ENABLED or not is_background_leader():
+        event_id = enqueue_event("radarr", data)
+        logging.info(f"Radarr webhook: queued as #{event_id}")
+        return "accepted", 202
+    return process_radarr_event(data)
+
+
+def process_radarr_event(data: dict):
+    """Событие Radarr: снимаем «снимок» качества текущего файла и ставим фильм в ожидание апгрейда."""
     event = (data.get("eventType") or data.get("event") or "").lower()
     movie = data.get("movie") or {}
     tmdb = movie.get("tmdbId")  # может быть int
@@ -3259,6 +4389,24 @@ def radarr_webhook():
         return "not in jellyfin", 200
 
     item_id, jf_name, jf_year = jf
+    key = f"tmdb:{tmdb}" if tmdb else (f"imdb:{imdb}" if RADARR_USE_IMDB_FALLBACK else None)
+    if not key:
+        return "no key", 200
+
+    # Download/Upgrade приносит путь нового файла: по нему воркер дешёвым запросом поймёт, что Jellyfin переключился
+    movie_file = data.get("movieFile") or {}
+    new_path = (movie_file.get("path") or movie_file.get("relativePath") or "").strip()
+    existing = radarr_pending.get(key)
+    if new_path and existing and existing.get("snapshot"):
+        # снимок «до» уже снят на grab — Jellyfin мог успеть пересканировать, не перетираем его
+        existing["new_path"] = new_path
+        existing["attempts"] = 0
+        existing.pop("parked", None)
+        existing["next_check_ts"] = min(float(existing.get("next_check_ts") or 0.0), _now_ts() + RADARR_RECHECK_AFTER_SEC)
+        radarr_pending.put(key, existing)
+        logging.info(f"Radarr webhook: {key} waits for {os.path.basename(new_path)}")
+        return "ok", 200
+
     details = get_item_details(item_id)
     try:
         item0 = (details.get("Items") or [{}])[0]
@@ -3275,165 +4423,132 @@ def radarr_webhook():
         logging.info(f"Radarr webhook: cannot build snapshot for tmdb:{tmdb}")
         return "no snapshot", 200
 
-    pend = _load_json(RADARR_PENDING_FILE)
-    key = f"tmdb:{tmdb}" if tmdb else (f"imdb:{imdb}" if RADARR_USE_IMDB_FALLBACK else None)
-    if not key:
-        return "no key", 200
-
-    pend[key] = {
+    radarr_pending.put(key, {
         "tmdb": str(tmdb) if tmdb else None,
         "imdb": (movie.get("imdbId") or "").strip() if movie.get("imdbId") else None,
         "next_check_ts": _now_ts() + RADARR_RECHECK_AFTER_SEC,
+        "created_ts": _now_ts(),
+        "attempts": 0,
         "movie_name": jf_name or title,
         "year": jf_year or year,
         "snapshot": snap,
+        "new_path": new_path or None,
         "last_item_id": item_id,  # опционально: только для логов/диагностики
-    }
-    _store_json(RADARR_PENDING_FILE, pend)
+    })
     logging.info(f"Radarr webhook: stored snapshot for {key} ({jf_name or title})")
     return "ok", 200
 
 def _format_before_after(old: dict, new: dict) -> str:
     return f"*{t('was')}:* { _format_snap_for_text(old) }\n*{t('now')}:* { _format_snap_for_text(new) }"
 
+def _radarr_check_pending(k: str, entry: dict, now: float) -> bool:
+    """
+    One due Radarr entry: reschedules it itself while waiting; True means
+    the upgrade was announced and the entry can be removed.
+    """
+    if pending_expire_if_old(radarr_pending, k, entry, now):
+        return False
+    old_snap = entry.get("snapshot") or {}
+
+    # Resolve current Jellyfin item by TMDb (with optional IMDb fallback)
+    item_id, name_now, year_now = _resolve_current_item_id(entry)
+    if not item_id:
+        # Jellyfin hasn't indexed/linked it yet — its library event (or the safety poll) wakes us
+        entry["next_check_ts"] = pending_next_check_ts(entry, now, RADARR_IDLE_RECHECK_SEC)
+        radarr_pending.put(k, entry)
+        return False
+
+    # If Radarr told us the expected new file path, wait until Jellyfin points
+    # to a file with the same basename — a path-only query, no MediaStreams
+    expected_path = (entry.get("new_path") or "").strip()
+    if expected_path:
+        cur_path = (get_item_path(item_id) or "").strip()
+        if cur_path and os.path.basename(cur_path).lower() != os.path.basename(expected_path).lower():
+            # Jellyfin not yet switched to the new file — postpone
+            entry["next_check_ts"] = pending_next_check_ts(entry, now, RADARR_IDLE_RECHECK_SEC)
+            radarr_pending.put(k, entry)
+            return False
+
+    # Pull fresh details (with MediaStreams) only once the file is there
+    details = get_item_details(item_id)
+
+    # Build a new quality snapshot and compare with the stored one
+    new_snap = _build_video_snapshot_from_details(details)
+
+    if new_snap and _snap_signature(old_snap) != _snap_signature(new_snap):
+        # ================== Build the full "movie-like" message ==================
+        name = entry.get("movie_name") or name_now or "Movie"
+        year = entry.get("year") or year_now or ""
+
+        overview, runtime_label = _extract_overview_and_runtime(details)
+
+        msg = f"*{t('quality_updated')}*\n\n*{name}* *({year})*"
+        if overview:
+            msg += f"\n\n{overview}"
+        msg += f"\n\n*{t('new_runtime')}*\n{runtime_label}"
+
+        # Quality diff (was → now)
+        msg += "\n\n" + _format_quality_diff_for_message(old_snap, new_snap)
+
+        # Audio tracks list (as in the new-movie template)
+        msg += "\n\n" + _build_audio_tracks_block_from_details(details)
+
+        # Ratings (MDBList via TMDb), trailer (как в шаблоне Movie) and poster — in parallel
+        item0 = (details.get("Items") or [{}])[0]
+        pids = item0.get("ProviderIds") or {}
+        tmdb_id = pids.get("Tmdb") or pids.get("TmdbId") or pids.get("TheMovieDb")
+        stage = EnrichmentStage("radarr_upgrade")
+        stage.add("ratings", lambda: fetch_mdblist_ratings("movie", tmdb_id) if tmdb_id else "", default="")
+        stage.add("trailer", lambda: get_tmdb_trailer_url("movie", str(tmdb_id), TMDB_TRAILER_LANG) if tmdb_id else None)
+        stage.add("poster", lambda: fetch_jellyfin_poster(item_id))
+        enriched = stage.run()
+
+        if enriched["ratings"]:
+            msg += f"\n\n*{t('new_ratings_movie')}:*\n{enriched['ratings']}"
+        trailer_url = enriched["trailer"]
+        if trailer_url:
+            msg += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
+
+        # Send and remove the entry only after success
+        try:
+            send_notification(item_id, msg, poster=enriched["poster"] or {})
+        except Exception as ex:
+            logging.warning(f"Radarr worker: send_notification failed: {ex}")
+
+        radarr_pending.bump("confirmed")
+        return True
+
+    else:
+        # No changes yet — schedule next check
+        entry["next_check_ts"] = pending_next_check_ts(entry, now, RADARR_IDLE_RECHECK_SEC)
+        radarr_pending.put(k, entry)
+        return False
+
+
 def _radarr_worker_loop():
     """
     Background loop that checks Radarr pending entries and sends a full
     'quality updated' message once Jellyfin has switched to the new file
     and the quality snapshot actually differs (video + audio).
     """
-    import time, os
-
     while True:
+        # sleeps exactly until the nearest next_check_ts (webhooks wake it up earlier)
+        pend = radarr_pending.wait_due()
+        now = _now_ts()
         try:
-            pend = _load_json(RADARR_PENDING_FILE)
             if pend:
-                now = _now_ts()
-                changed = False
-                to_delete = []
-
-                for k, entry in list(pend.items()):
-                    # Wait until it's time to re-check
-                    next_ts = float(entry.get("next_check_ts") or 0.0)
-                    if now < next_ts:
-                        continue
-
-                    old_snap = entry.get("snapshot") or {}
-
-                    # Resolve current Jellyfin item by TMDb (with optional IMDb fallback)
-                    item_id, name_now, year_now = _resolve_current_item_id(entry)
-                    if not item_id:
-                        # Jellyfin hasn't indexed/linked it yet — try again later
-                        entry["next_check_ts"] = now + RADARR_RECHECK_AFTER_SEC
-                        pend[k] = entry
-                        changed = True
-                        continue
-
-                    # Pull fresh details
-                    details = get_item_details(item_id)
-
-                    # If Radarr told us the expected new file path,
-                    # wait until Jellyfin points to a file with the same basename
-                    expected_path = (entry.get("new_path") or "").strip()
-                    if expected_path:
-                        cur_path = (_jf_main_file_path_from_details(details) or "").strip()
-                        if cur_path:
-                            if os.path.basename(cur_path).lower() != os.path.basename(expected_path).lower():
-                                # Jellyfin not yet switched to the new file — postpone
-                                entry["next_check_ts"] = now + RADARR_RECHECK_AFTER_SEC
-                                pend[k] = entry
-                                changed = True
-                                continue
-
-                    # Build a new quality snapshot and compare with the stored one
-                    new_snap = _build_video_snapshot_from_details(details)
-
-                    if new_snap and _snap_signature(old_snap) != _snap_signature(new_snap):
-                        # ================== Build the full "movie-like" message ==================
-                        name = entry.get("movie_name") or name_now or "Movie"
-                        year = entry.get("year") or year_now or ""
-
-                        overview, runtime_label = _extract_overview_and_runtime(details)
-
-                        msg = f"*{t('quality_updated')}*\n\n*{name}* *({year})*"
-                        if overview:
-                            msg += f"\n\n{overview}"
-                        msg += f"\n\n*{t('new_runtime')}*\n{runtime_label}"
-
-                        # Quality diff (was → now)
-                        msg += "\n\n" + _format_quality_diff_for_message(old_snap, new_snap)
-
-                        # Audio tracks list (as in the new-movie template)
-                        msg += "\n\n" + _build_audio_tracks_block_from_details(details)
-
-                        # Ratings (MDBList via TMDb)
-                        tmdb_id = None
-                        try:
-                            item0 = (details.get("Items") or [{}])[0]
-                            pids = item0.get("ProviderIds") or {}
-                            tmdb_id = pids.get("Tmdb") or pids.get("TmdbId") or pids.get("TheMovieDb")
-                            if tmdb_id:
-                                ratings_text = fetch_mdblist_ratings("movie", tmdb_id)
-                                if ratings_text:
-                                    msg += f"\n\n*{t('new_ratings_movie')}:*\n{ratings_text}"
-                        except Exception as ex:
-                            logging.debug(f"ratings for upgrade failed: {ex}")
-
-                        # Trailer (same helper as for Movie, if present)
-                        # Trailer (как в шаблоне Movie)
-                        try:
-                            trailer_url = None
-                            if tmdb_id:
-                                trailer_url = get_tmdb_trailer_url("movie", str(tmdb_id), TMDB_TRAILER_LANG)
-                            if trailer_url:
-                                msg += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
-                        except NameError:
-                            logging.debug("get_tmdb_trailer_url is not defined")
-                        except Exception as ex:
-                            logging.debug(f"trailer for upgrade failed: {ex}")
-
-                        # Send and remove the entry only after success
-                        try:
-                            send_notification(item_id, msg)
-                        except Exception as ex:
-                            logging.warning(f"Radarr worker: send_notification failed: {ex}")
-
-                        to_delete.append(k)
-
-                    else:
-                        # No changes yet — schedule next check
-                        entry["next_check_ts"] = now + RADARR_RECHECK_AFTER_SEC
-                        pend[k] = entry
-                        changed = True
-
-                # Persist changes (updated next_check_ts / deletions)
-                if to_delete:
-                    for key in to_delete:
-                        pend.pop(key, None)
-                    changed = True
-
-                if changed:
-                    _store_json(RADARR_PENDING_FILE, pend)
+                done = run_pending_batch("radarr", pend, lambda k, entry: _radarr_check_pending(k, entry, now))
+                to_delete = [k for k, ok in done.items() if ok]
+
+                # Rescheduled entries are already stored row by row; drop the finished ones
+                radarr_pending.delete(to_delete)
 
         except Exception as ex:
             logging.warning(f"Radarr worker loop error: {ex}")
-
-        time.sleep(RADARR_SCAN_PERIOD_SEC)
-
-def _jf_main_file_path_from_details(details: dict) -> str | None:
-    try:
-        item0 = (details.get("Items") or [{}])[0]
-        # приоритетно из MediaSources
-        for ms in (item0.get("MediaSources") or []):
-            p = ms.get("Path")
-            if p:
-                return str(p)
-        # иногда путь есть и на самом Item
-        p = item0.get("Path")
-        return str(p) if p else None
-    except Exception:
-        return None
-
+            time.sleep(RADARR_SCAN_PERIOD_SEC)
+        finally:
+            # entries the failed pass did not get to are retried after the usual interval
+            radarr_pending.finish(pend, now + RADARR_RECHECK_AFTER_SEC)
 
 def _resolve_current_item_id(entry: dict) -> tuple[str|None, str|None, int|None]:
     """Возвращает (item_id, name, year) по данным записи ожидалки."""
@@ -3453,81 +4568,26 @@ def _resolve_current_item_id(entry: dict) -> tuple[str|None, str|None, int|None]
 
 #Пробуем sonarr
 
-def _provider_tvdb_equals(item: dict, tvdb_id: str | int) -> bool:
-    p = (item.get("ProviderIds") or {})
-    s = str(tvdb_id).strip().lower()
-    for k in ("Tvdb", "TvdbId", "TheTVDB"):
-        v = p.get(k)
-        if v and str(v).strip().lower() == s:
-            return True
-    return False
-
-def _provider_tmdb_equals_series(item: dict, tmdb_id: str | int) -> bool:
-    p = (item.get("ProviderIds") or {})
-    s = str(tmdb_id).strip().lower()
-    for k in ("Tmdb", "TmdbId", "TheMovieDb"):
-        v = p.get(k)
-        if v is not None and str(v).strip().lower() == s:
-            return True
-    return False
-
-def _provider_tvmaze_equals(item: dict, tvmaze_id: str | int) -> bool:
-    p = (item.get("ProviderIds") or {})
-    s = str(tvmaze_id).strip().lower()
-    for k in ("TvMaze", "Tvmaze", "TVMazeId"):
-        v = p.get(k)
-        if v and str(v).strip().lower() == s:
-            return True
-    return False
-
-def _provider_imdb_equals_series(item: dict, imdb_id: str | int) -> bool:
-    p = (item.get("ProviderIds") or {})
-    s = str(imdb_id).strip().lower()
-    for k in ("Imdb", "ImdbId"):
-        v = p.get(k)
-        if v and str(v).strip().lower() == s:
-            return True
-    return False
-
-def _jf_find_series_candidates(fields_extra: str = "ProviderIds,ProductionYear,Name"):
-    return {
-        "api_key": JELLYFIN_API_KEY,
-        "IncludeItemTypes": "Series",
-        "Recursive": "true",
-        "Fields": fields_extra,
-        "StartIndex": 0, "Limit": 10000
-    }
-
 def _jf_find_series_by_ids(tvdb=None, tmdb=None, tvmaze=None, imdb=None, expected_title=None, expected_year=None):
-    """Возвращает (series_id, name, year) по любому из ID (приоритет: TVDB → TMDB → TVMaze → IMDb)."""
-    try:
-        url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=_jf_find_series_candidates(), timeout=20)
-        r.raise_for_status()
-        items = (r.json() or {}).get("Items") or []
-    except Exception:
-        items = []
-
-    def score(it):
-        s = 0
-        if expected_year and int(it.get("ProductionYear") or 0) == int(expected_year): s += 3
-        if expected_title:
-            from difflib import SequenceMatcher
-            s += int(SequenceMatcher(None,
-                                     (expected_title or "").strip().casefold(),
-                                     (it.get("Name") or "").strip().casefold()).ratio() * 2)
-        return -s
-
-    # фильтрации по провайдерам
+    """
+    Возвращает (series_id, name, year) по любому из ID (приоритет: TVDB → TMDB → TVMaze → IMDb).
+    Без ID (или если ни один не нашёлся) — по точному нормализованному названию и году.
+    """
+    # поиск по индексу провайдеров (без выкачивания всех сериалов)
     cands = []
-    if tvdb:  cands = [x for x in items if _provider_tvdb_equals(x, tvdb)]
-    if not cands and tmdb:   cands = [x for x in items if _provider_tmdb_equals_series(x, tmdb)]
-    if not cands and tvmaze: cands = [x for x in items if _provider_tvmaze_equals(x, tvmaze)]
-    if not cands and imdb:   cands = [x for x in items if _provider_imdb_equals_series(x, imdb)]
+    for provider, value in (("tvdb", tvdb), ("tmdb", tmdb), ("tvmaze", tvmaze), ("imdb", imdb)):
+        if value:
+            cands = provider_index.lookup("Series", provider, value)
+            if cands:
+                break
+    if not cands and expected_title:
+        want = normalize_title(expected_title)[0]
+        cands = [it for it in provider_index.find_by_title("Series", expected_title, expected_year)
+                 if it.get("norm") == want
+                 and not (expected_year and it.get("ProductionYear") and int(it["ProductionYear"]) != int(expected_year))]
     if not cands:
         return None
-    cands.sort(key=score)
-    top = cands[0]
+    top = rank_by_title(cands, expected_title, expected_year)[0]
     return top.get("Id"), top.get("Name"), top.get("ProductionYear")
 
 def _jf_find_season_by_index(series_id: str, season_number: int) -> tuple[str|None, str|None]:
@@ -3541,7 +4601,7 @@ def _jf_find_season_by_index(series_id: str, season_number: int) -> tuple[str|No
             "Limit": 200,
         }
         url = f"{JELLYFIN_BASE_URL}/emby/Items"
-        r = requests.get(url, params=params, timeout=10)
+        r = http_client.get(url, params=params, timeout=10)
         r.raise_for_status()
         for it in (r.json() or {}).get("Items") or []:
             if int(it.get("IndexNumber") or -1) == int(season_number):
@@ -3550,14 +4610,8 @@ def _jf_find_season_by_index(series_id: str, season_number: int) -> tuple[str|No
     except Exception:
         return None, None
 
-def _collect_season_episode_signatures(series_id: str, season_id: str, only_epnums: set[int] | None = None) -> tuple[dict, int]:
-    """
-    Возвращает (sig_by_epnum, present_count),
-    где sig_by_epnum = {episodeNumber -> signature} только для epnums (если заданы).
-    present_count — сколько эпизодов с файлами в сезоне (для сравнения с season_counts.json).
-    """
-    sigs = {}
-    present_count = 0
+def _fetch_season_episodes(series_id: str, season_id: str) -> list | None:
+    """Эпизоды сезона (с MediaStreams/MediaSources) одним запросом; None — Jellyfin не ответил."""
     try:
         url = f"{JELLYFIN_BASE_URL}/emby/Shows/{series_id}/Episodes"
         params = {
@@ -3566,35 +4620,50 @@ def _collect_season_episode_signatures(series_id: str, season_id: str, only_epnu
             "IsMissing": "false",
             "Fields": "IndexNumber,MediaStreams,MediaSources"
         }
-        r = requests.get(url, params=params, timeout=20)
+        r = http_client.get(url, params=params, timeout=20)
         r.raise_for_status()
-        items = (r.json() or {}).get("Items") or []
-        for it in items:
-            epnum = it.get("IndexNumber")
-            if epnum is None:
-                continue
-            present_count += 1
-            epnum = int(epnum)
-            if only_epnums and epnum not in only_epnums:
-                continue
-            details = {"Items": [it]}
-            snap = _build_video_snapshot_from_details(details)
-            sig = _snap_signature(snap or {})
-            sigs[epnum] = sig
+        return (r.json() or {}).get("Items") or []
     except Exception as ex:
-        logging.warning(f"_collect_season_episode_signatures failed: {ex}")
-    return sigs, present_count
-
+        logging.warning(f"_fetch_season_episodes failed for {series_id}/{season_id}: {ex}")
+        return None
 
-@app.route("/sonarr/webhook", methods=["POST"])
-def sonarr_webhook():
-    if not SONARR_ENABLED:
-        return "sonarr disabled", 200
+def _season_episode_signatures(items: list, only_epnums: set[int] | None = None) -> tuple[dict, int]:
+    """
+    Возвращает (sig_by_epnum, present_count) по уже скачанным эпизодам сезона,
+    где sig_by_epnum = {episodeNumber -> signature} только для epnums (если заданы).
+    present_count — сколько эпизодов с файлами в сезоне (для сравнения с season_counts).
+    """
+    sigs = {}
+    present_count = 0
+    for it in items or []:
+        epnum = it.get("IndexNumber")
+        if epnum is None:
+            continue
+        present_count += 1
+        epnum = int(epnum)
+        if only_epnums and epnum not in only_epnums:
+            continue
+        snap = _build_video_snapshot_from_details({"Items": [it]})
+        sigs[epnum] = _snap_signature(snap or {})
+    return sigs, present_count
+
+@app.route("/sonarr/webhook", methods=["POST"])
+def sonarr_webhook():
+    if not SONARR_ENABLED:
+        return "sonarr disabled", 200
     if SONARR_WEBHOOK_SECRET and (request.args.get("secret") or "") != SONARR_WEBHOOK_SECRET:
         return "forbidden", 403
 
     p = request.get_json(silent=True, force=True) or {}
+    if EVENT_QUEUE_ENABLED or not is_background_leader():
+        event_id = enqueue_event("sonarr", p)
+        logging.info(f"Sonarr webhook: queued as #{event_id}")
+        return "accepted", 202
+    return process_sonarr_event(p)
+
 
+def process_sonarr_event(p: dict):
+    """Событие Sonarr (grab): запоминаем сезоны/серии, качество которых ждём обновлённым в Jellyfin."""
     # Разрешаем только grab-события (разные варианты поля/формата)
     event = (p.get("eventType") or p.get("event") or "").strip().lower()
     # В Sonarr это обычно "Grab", но на всякий случай ловим подстроку.
@@ -3625,7 +4694,7 @@ def sonarr_webhook():
     if not by_season:
         return "no season numbers", 200
 
-    pend = _load_json(SONARR_PENDING_FILE)
+    pend = {}
     now  = _now_ts()
     touched = 0
 
@@ -3646,12 +4715,14 @@ def sonarr_webhook():
             "baseline_sigs": None,
             "baseline_present": None,
             "next_check_ts": now + SONARR_RECHECK_AFTER_SEC,
+            "created_ts": now,
+            "attempts": 0,
             "event": "grab",
         }
         touched += 1
 
     if touched:
-        _store_json(SONARR_PENDING_FILE, pend)
+        sonarr_pending.put_many(pend)
         logging.info(f"Sonarr webhook (grab): stored {touched} season(s) for '{title}'")
     return "ok", 200
 
@@ -3666,527 +4737,1384 @@ def _resolve_series_from_entry(entry: dict):
         expected_year=entry.get("release_year"),
     )
 
+def _sonarr_check_pending(key: str, entry: dict, episodes: list | None, now: float) -> bool:
+    """
+    Проверка одной созревшей записи Sonarr по уже скачанным эпизодам её сезона.
+    Сама перепланирует запись, если ждём дальше; True — запись можно удалять.
+    """
+    epnums = entry.get("epnums") or []
+    incoming_count = int(entry.get("incoming_count") or 0)
+    series_id, season_id = entry["series_id"], entry["season_id"]
+    season_name = entry.get("season_name") or f"Season {entry.get('season_number')}"
+    series_name = entry.get("series_title")
+    release_year = entry.get("release_year")
+
+    if episodes is None:
+        # Jellyfin не ответил или id устарели (сериал пересоздан) — на следующем проходе резолвим заново
+        entry.pop("series_id", None)
+        entry.pop("season_id", None)
+        entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
+        sonarr_pending.put(key, entry); return False
+
+    # 2) Сколько реальных эпизодов с файлами сейчас
+    _, present_count_all = _season_episode_signatures(episodes, None)
+
+    # 3) Эталон из season_counts
+    with season_lock(season_id):
+        st = season_counts.get(season_id)
+    last_count = int((st or {}).get("last_count") or 0)
+
+    # Если Sonarr тянет > чем было — это новые эпизоды, не апгрейд
+    if incoming_count > last_count:
+        sonarr_pending.bump("abandoned")
+        return True
+
+    # 4) Собираем сигнатуры ТОЛЬКО по тем сериям, которые Sonarr захватил
+    want = set(int(x) for x in epnums)
+    cur_sigs, _ = _season_episode_signatures(episodes, only_epnums=want)
+
+    baseline = entry.get("baseline_sigs")
+    if not baseline:
+        # первая фиксация baseline — ждём изменений
+        entry["baseline_sigs"] = cur_sigs
+        entry["baseline_present"] = present_count_all
+        entry["next_check_ts"] = pending_next_check_ts(entry, now, SONARR_IDLE_RECHECK_SEC)
+        sonarr_pending.put(key, entry)
+        return False
+
+    # 5) Ищем первый сдвиг
+    changed_eps = []
+    for ep in want:
+        old = baseline.get(str(ep)) if isinstance(baseline, dict) else None
+        if old is None:
+            old = baseline.get(ep) if isinstance(baseline, dict) else None
+        new = cur_sigs.get(ep)
+        if new and old and new != old:
+            changed_eps.append(ep)
+
+    if not changed_eps:
+        entry["next_check_ts"] = pending_next_check_ts(entry, now, SONARR_IDLE_RECHECK_SEC)
+        sonarr_pending.put(key, entry)
+        return False
+
+    # ==== СЛАЕМ УВЕДОМЛЕНИЕ (шаблон как "новые серии", но с заголовком обновления) ====
+    # Всё, что нужно для сообщения, независимо друг от друга — собираем параллельно
+    series_tmdb_id = entry.get("tmdb")
+    stage = EnrichmentStage("sonarr_upgrade")
+    stage.add("items", lambda: get_items_details([series_id, season_id]), default={})
+    stage.add("series", lambda items: items.get(series_id) or {}, deps=("items",), default={})
+    stage.add("season", lambda items: items.get(season_id) or {}, deps=("items",), default={})
+    if INCLUDE_MEDIA_TECH_INFO:
+        stage.add("tech", lambda: build_season_media_tech_text(series_id, season_id), default="")
+    stage.add("ratings", lambda: fetch_mdblist_ratings("show", series_tmdb_id) if series_tmdb_id else "", default="")
+    stage.add("trailer", lambda: get_tmdb_trailer_url("tv", str(series_tmdb_id), TMDB_TRAILER_LANG) if series_tmdb_id else None)
+    # Куда слать постер (сезон → сериал), постер качаем один раз
+    stage.add("poster", lambda: pick_jellyfin_poster(season_id, series_id), default=(season_id, None))
+    enriched = stage.run()
+
+    series_details = enriched["series"]
+    season_details = enriched["season"]
+    season_item = (season_details.get("Items") or [{}])[0]
+    series_item = (series_details.get("Items") or [{}])[0]
+    overview_to_use = (season_item.get("Overview") or series_item.get("Overview") or "").strip()
+
+    # Какие серии изменились (напр., E01, E02…)
+    changed_eps_str = ", ".join(f"E{int(x):02d}" for x in sorted(changed_eps))
+
+    msg = (
+        f"*{t('quality_updated')}*\n\n"
+        f"*{series_name or entry.get('series_title') or 'Series'}* *({release_year or entry.get('release_year') or ''})*\n\n"
+        f"*{season_name}*\n\n"
+        f"{overview_to_use}\n\n"
+        f"\n\n*{t('updated')}*: {changed_eps_str}" if changed_eps_str else
+        f"*{t('quality_updated')}*\n\n"
+        f"*{series_name or entry.get('series_title') or 'Series'}* *({release_year or entry.get('release_year') or ''})*\n\n"
+        f"*{season_name}*\n\n"
+        f"{overview_to_use}\n\n"
+    )
+
+    if enriched.get("tech"):
+        msg += enriched["tech"]
+
+    # Рейтинги/трейлер по сериалу
+    if enriched["ratings"]:
+        msg += f"\n\n*{t('new_ratings_show')}:*\n{enriched['ratings']}"
+    trailer_url = enriched["trailer"]
+    if trailer_url:
+        msg += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
+
+    target_image_id, poster = enriched["poster"]
+
+    try:
+        send_notification(target_image_id, msg, poster=poster)
+        sonarr_pending.bump("confirmed")
+        return True   # чистим ТОЛЬКО после отправки
+    except Exception as ex:
+        logging.warning(f"Sonarr worker: send_notification failed: {ex}")
+        entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
+        sonarr_pending.put(key, entry)
+        return False
+
+
 def _sonarr_worker_loop():
     while True:
+        # спим ровно до ближайшего next_check_ts (вебхук Sonarr будит раньше)
+        pend = sonarr_pending.wait_due()
+        now = _now_ts()
         try:
-            pend = _load_json(SONARR_PENDING_FILE)
-            if not pend:
-                time.sleep(SONARR_SCAN_PERIOD_SEC); continue
-
-            now = _now_ts()
-            changed = False
             to_delete = []
 
-            for key, entry in list(pend.items()):
-                next_ts = float(entry.get("next_check_ts") or 0.0)
-                if now < next_ts:
+            # 1) Резолв сериала/сезона: id, найденные на прошлых проходах, берём из записи
+            resolved = {}        # key -> entry (с series_id/season_id)
+            seasons_seen = {}    # (series_id, season_number) -> (season_id, season_name) в пределах прохода
+            for key, entry in pend.items():
+                if pending_expire_if_old(sonarr_pending, key, entry, now):
                     continue
-
                 season_number = entry.get("season_number")
-                epnums = entry.get("epnums") or []
-                incoming_count = int(entry.get("incoming_count") or 0)
-                if season_number is None or not epnums:
+                if season_number is None or not entry.get("epnums"):
+                    sonarr_pending.bump("abandoned")
                     to_delete.append(key); continue
-
-                # 1) Резолв сериала/сезона
-                found = _resolve_series_from_entry(entry)
-                if not found:
-                    entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
-                    pend[key] = entry; changed = True; continue
-                series_id, series_name, release_year = found
-
-                sid, sname = _jf_find_season_by_index(series_id, int(season_number))
-                if not sid:
-                    entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
-                    pend[key] = entry; changed = True; continue
-                season_id, season_name = sid, sname or f"Season {season_number}"
-
-                # 2) Сколько реальных эпизодов с файлами сейчас
-                _, present_count_all = _collect_season_episode_signatures(series_id, season_id, None)
-
-                # 3) Эталон из season_counts.json
-                with _season_counts_lock:
-                    st = season_counts.get(season_id)
-                last_count = int((st or {}).get("last_count") or 0)
-
-                # Если Sonarr тянет > чем было — это новые эпизоды, не апгрейд
-                if incoming_count > last_count:
-                    to_delete.append(key)
-                    continue
-
-                # 4) Собираем сигнатуры ТОЛЬКО по тем сериям, которые Sonarr захватил
-                want = set(int(x) for x in epnums)
-                cur_sigs, _ = _collect_season_episode_signatures(series_id, season_id, only_epnums=want)
-
-                baseline = entry.get("baseline_sigs")
-                if not baseline:
-                    # первая фиксация baseline — ждём изменений
-                    entry["baseline_sigs"] = cur_sigs
-                    entry["baseline_present"] = present_count_all
+                if not (entry.get("series_id") and entry.get("season_id")):
+                    found = _resolve_series_from_entry(entry)
+                    if not found:
+                        entry["next_check_ts"] = pending_next_check_ts(entry, now, SONARR_IDLE_RECHECK_SEC)
+                        sonarr_pending.put(key, entry); continue
+                    series_id, series_name, release_year = found
+                    skey = (series_id, int(season_number))
+                    if skey not in seasons_seen:
+                        seasons_seen[skey] = _jf_find_season_by_index(series_id, int(season_number))
+                    sid, sname = seasons_seen[skey]
+                    if not sid:
+                        entry["next_check_ts"] = pending_next_check_ts(entry, now, SONARR_IDLE_RECHECK_SEC)
+                        sonarr_pending.put(key, entry); continue
                     entry["series_id"] = series_id
-                    entry["season_id"] = season_id
-                    entry["season_name"] = season_name
+                    entry["season_id"] = sid
+                    entry["season_name"] = sname or f"Season {season_number}"
                     entry["series_title"] = series_name or entry.get("series_title")
                     entry["release_year"] = release_year or entry.get("release_year")
-                    entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
-                    pend[key] = entry; changed = True
-                    continue
+                resolved[key] = entry
 
-                # 5) Ищем первый сдвиг
-                changed_eps = []
-                for ep in want:
-                    old = baseline.get(str(ep)) if isinstance(baseline, dict) else None
-                    if old is None:
-                        old = baseline.get(ep) if isinstance(baseline, dict) else None
-                    new = cur_sigs.get(ep)
-                    if new and old and new != old:
-                        changed_eps.append(ep)
-
-                if not changed_eps:
-                    entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
-                    pend[key] = entry; changed = True
-                    continue
+            # 2) Эпизоды каждого сезона — один запрос на сезон, сколько бы записей на него ни ссылалось
+            skeys = {(entry["series_id"], entry["season_id"]): None for entry in resolved.values()}
+            season_episodes = run_pending_batch("sonarr_seasons", skeys, lambda skey, _: _fetch_season_episodes(*skey))
 
-                # ==== СЛАЕМ УВЕДОМЛЕНИЕ (шаблон как "новые серии", но с заголовком обновления) ====
-                # planned_total (опционально)
-                series_tmdb_id = entry.get("tmdb")
-                planned_total = None
-                try:
-                    if series_tmdb_id and 'get_tmdb_season_total_episodes' in globals():
-                        planned_total = get_tmdb_season_total_episodes(series_tmdb_id, int(season_number), TMDB_TRAILER_LANG)
-                except Exception as ex:
-                    logging.debug(f"sonarr planned_total failed: {ex}")
-
-                series_details = get_item_details(series_id)
-                season_details = get_item_details(season_id)
-                season_item = (season_details.get("Items") or [{}])[0]
-                series_item = (series_details.get("Items") or [{}])[0]
-                overview_to_use = (season_item.get("Overview") or series_item.get("Overview") or "").strip()
-
-                # Какие серии изменились (напр., E01, E02…)
-                changed_eps_str = ", ".join(f"E{int(x):02d}" for x in sorted(changed_eps))
-
-                msg = (
-                    f"*{t('quality_updated')}*\n\n"
-                    f"*{series_name or entry.get('series_title') or 'Series'}* *({release_year or entry.get('release_year') or ''})*\n\n"
-                    f"*{season_name}*\n\n"
-                    f"{overview_to_use}\n\n"
-                    f"\n\n*{t('updated')}*: {changed_eps_str}" if changed_eps_str else
-                    f"*{t('quality_updated')}*\n\n"
-                    f"*{series_name or entry.get('series_title') or 'Series'}* *({release_year or entry.get('release_year') or ''})*\n\n"
-                    f"*{season_name}*\n\n"
-                    f"{overview_to_use}\n\n"
-                )
+            done = run_pending_batch(
+                "sonarr", resolved,
+                lambda key, entry: _sonarr_check_pending(
+                    key, entry, season_episodes.get((entry["series_id"], entry["season_id"])), now))
+            to_delete += [key for key, ok in done.items() if ok]
 
-                if INCLUDE_MEDIA_TECH_INFO:
-                    try:
-                        season_tech = build_season_media_tech_text(series_id, season_id)
-                        if season_tech:
-                            msg += season_tech
-                    except Exception as ex:
-                        logging.warning(f"Sonarr worker: season tech failed: {ex}")
+            sonarr_pending.delete(to_delete)
 
-                # Рейтинги/трейлер по сериалу
-                try:
-                    if series_tmdb_id:
-                        ratings_text = fetch_mdblist_ratings("show", series_tmdb_id)
-                        if ratings_text:
-                            msg += f"\n\n*{t('new_ratings_show')}:*\n{ratings_text}"
-                        if 'get_tmdb_trailer_url' in globals():
-                            trailer_url = get_tmdb_trailer_url("tv", str(series_tmdb_id), TMDB_TRAILER_LANG)
-                            if trailer_url:
-                                msg += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
-                except Exception as ex:
-                    logging.debug(f"Sonarr worker: ratings/trailer failed: {ex}")
+        except Exception as ex:
+            logging.warning(f"Sonarr worker loop error: {ex}")
+            time.sleep(SONARR_SCAN_PERIOD_SEC)
+        finally:
+            # то, до чего упавший проход не дошёл, — на обычный интервал
+            sonarr_pending.finish(pend, now + SONARR_RECHECK_AFTER_SEC)
 
-                # Куда слать постер
-                try:
-                    target_image_id = season_id if jellyfin_image_exists(season_id) else series_id
-                except Exception:
-                    target_image_id = series_id
 
+#Пробуем заполнять информацию о сезонах
+def _prime_fetch_episode_page(start_index: int, with_total: bool) -> tuple[list, int | None]:
+    """Одна страница эпизодов для priming: стабильный порядок по DateCreated, чтобы смещение-чекпоинт оставалось верным."""
+    params = {
+        "api_key": JELLYFIN_API_KEY,
+        "IncludeItemTypes": "Episode",
+        "Recursive": "true",
+        "IsMissing": "false",
+        "Fields": "SeasonId,LocationType,Path",   # Path/LocationType — для _episode_has_file
+        "SortBy": "DateCreated,SortName",
+        "SortOrder": "Ascending",
+        "EnableImages": "false",
+        "EnableUserData": "false",
+        "EnableTotalRecordCount": "true" if with_total else "false",
+        "StartIndex": start_index,
+        "Limit": SEASON_COUNTS_PRIME_PAGE_SIZE,
+    }
+    r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=60)
+    r.raise_for_status()
+    data = r.json() or {}
+    return data.get("Items") or [], (int(data.get("TotalRecordCount") or 0) if with_total else None)
+
+
+def _prime_apply_page(page: list, cursor: dict) -> None:
+    """Счёт страницы — в season_counts_prime, в той же транзакции сдвигаем чекпоинт: рестарт не посчитает её дважды."""
+    present: dict = {}
+    for ep in page:
+        season_id = ep.get("SeasonId")
+        if season_id:
+            present[season_id] = present.get(season_id, 0) + (1 if _episode_has_file(ep) else 0)
+    db = _state_db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.executemany(
+            "INSERT INTO season_counts_prime (season_id, present) VALUES (?, ?)"
+            " ON CONFLICT(season_id) DO UPDATE SET present = present + excluded.present",
+            list(present.items()),
+        )
+        db.execute("INSERT OR REPLACE INTO state_meta (key, value) VALUES ('season_prime_cursor', ?)",
+                   (json.dumps(cursor),))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+
+
+def _prime_finish() -> int:
+    """Скан дошёл до конца: переносим счёт в season_counts (только пустые записи), чистим staging и чекпоинт."""
+    db = _state_db()
+    rows = db.execute("SELECT season_id, present FROM season_counts_prime").fetchall()
+    dirty: set = set()
+    for row in rows:
+        with season_lock(row["season_id"]):
+            st = season_counts.get(row["season_id"])
+            if not st:
+                season_counts[row["season_id"]] = {"last_count": int(row["present"]), "last_sent_ts": 0}
+                dirty.add(row["season_id"])
+            elif "last_count" not in st:
+                st["last_count"] = int(row["present"])
+                dirty.add(row["season_id"])
+    mark_season_dirty(*dirty)
+    flush_season_counts()   # staging сейчас будет удалён — счёт должен лечь на диск до этого
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("DELETE FROM season_counts_prime")
+        db.execute("DELETE FROM state_meta WHERE key = 'season_prime_cursor'")
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return len(dirty)
+
+
+def _prime_season_counts_once():
+    """
+    Дополняет season_counts начальными значениями last_count (кол-во эпизодов с файлами) для всех сезонов.
+    Один рекурсивный проход по эпизодам библиотеки, счёт группируется по SeasonId. До
+    SEASON_COUNTS_PRIME_CONCURRENCY страниц запрашиваются одновременно, применяются строго по порядку;
+    после каждой — чекпоинт в state_meta, так что рестарт продолжает с места остановки.
+    Существующие записи не перетирает.
+    """
+    try:
+        try:
+            cursor = json.loads(state_meta_get("season_prime_cursor") or "{}")
+        except ValueError:
+            cursor = {}
+        if cursor.get("start_index"):
+            logging.info(f"Prime season_counts: resuming at episode {cursor['start_index']}")
+        else:
+            _state_db().execute("DELETE FROM season_counts_prime")   # чужие остатки без чекпоинта не считаем
+            cursor = {"start_index": 0, "total": None}
+
+        started, last_log = time.time(), time.time()
+        scanned = 0
+        limit = SEASON_COUNTS_PRIME_PAGE_SIZE
+        next_start = int(cursor["start_index"])
+        with ThreadPoolExecutor(max_workers=max(1, SEASON_COUNTS_PRIME_CONCURRENCY),
+                                thread_name_prefix="season-prime") as pool:
+            inflight: deque = deque()
+            done = False
+            while not done:
+                while len(inflight) < max(1, SEASON_COUNTS_PRIME_CONCURRENCY):
+                    with_total = cursor.get("total") is None and not inflight
+                    inflight.append(pool.submit(_prime_fetch_episode_page, next_start, with_total))
+                    next_start += limit
                 try:
-                    send_notification(target_image_id, msg)
-                    to_delete.append(key)   # чистим ТОЛЬКО после отправки
+                    page, total = inflight.popleft().result()
                 except Exception as ex:
-                    logging.warning(f"Sonarr worker: send_notification failed: {ex}")
-                    entry["next_check_ts"] = now + SONARR_RECHECK_AFTER_SEC
-                    pend[key] = entry; changed = True
+                    for fut in inflight:
+                        fut.cancel()
+                    logging.warning(f"Prime season_counts: episode page failed at {cursor['start_index']}: {ex}; "
+                                    f"will resume from there on next start")
+                    return
+                if total is not None:
+                    cursor["total"] = total
+                cursor["start_index"] += len(page)
+                _prime_apply_page(page, cursor)
+                scanned += len(page)
+                done = len(page) < limit
+
+                if time.time() - last_log >= SEASON_COUNTS_PRIME_LOG_SEC:
+                    last_log = time.time()
+                    logging.info(f"Prime season_counts: {cursor['start_index']}/{cursor.get('total') or '?'} episodes, "
+                                 f"{scanned / max(0.001, last_log - started):.0f} episodes/s")
+            for fut in inflight:
+                fut.cancel()
+
+        added = _prime_finish()
+        elapsed = time.time() - started
+        logging.info(f"Prime season_counts: completed, {cursor['start_index']} episodes, {added} new season(s), "
+                     f"{elapsed:.1f}s ({scanned / max(0.001, elapsed):.0f} episodes/s)")
+    except Exception as ex:
+        logging.warning(f"Prime season_counts error: {ex}")
+
+
+
+
+#Сверка season_counts: пересчитываем только сезоны, изменившиеся с прошлого раза
+_reconcile_seasons_lock = threading.Lock()
+_reconcile_seasons_noted: set = set()   # сезоны из ItemDeleted/ItemUpdated — удаление серии дельта не покажет
 
-            if to_delete:
-                for k in to_delete:
-                    pend.pop(k, None)
-                changed = True
-            if changed:
-                _store_json(SONARR_PENDING_FILE, pend)
 
+def _jf_date_ts(value) -> float | None:
+    """'2024-05-01T12:34:56.1234567Z' (формат Jellyfin) → unix ts."""
+    try:
+        return datetime.strptime(str(value)[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def note_season_changed(season_id: str | None) -> None:
+    if season_id:
+        with _reconcile_seasons_lock:
+            _reconcile_seasons_noted.add(season_id)
+
+
+def _season_present_count(season_id: str) -> int:
+    """Эпизоды с файлами в сезоне — по ParentId, без series_id (в дельте его может не быть)."""
+    params = {
+        "api_key": JELLYFIN_API_KEY,
+        "ParentId": season_id,
+        "IncludeItemTypes": "Episode",
+        "Recursive": "true",
+        "IsMissing": "false",
+        "Fields": "LocationType,Path",
+        "EnableImages": "false",
+        "EnableUserData": "false",
+    }
+    r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=20)
+    r.raise_for_status()
+    return sum(1 for ep in ((r.json() or {}).get("Items") or []) if _episode_has_file(ep))
+
+
+def reconcile_season_counts() -> int:
+    """
+    Один проход сверки: сезоны, у которых с high-water mark (state_meta) сохранялись эпизоды или сам сезон,
+    плюс отмеченные вебхуками удаления. Правим last_count только у уже известных сезонов.
+    Сезоны со свежими (моложе SEASON_COUNTS_RECONCILE_SETTLE_SEC) сериями откладываем, пока окно не истечёт
+    (срок хранится вместе с id в state_meta), сезоны в пачке коалесера — до следующего прохода;
+    иначе новая серия «тихо» попадёт в счётчик и её не объявят. Возвращает число исправленных сезонов.
+    """
+    started = _now_ts()
+    hwm = float(state_meta_get("season_reconcile_hwm") or 0)
+    if not hwm:
+        # первый запуск: начальные значения — дело priming/вебхуков, дальше следим за изменениями
+        state_meta_set("season_reconcile_hwm", started)
+        return 0
+    try:
+        stored = json.loads(state_meta_get("season_reconcile_deferred") or "{}")
+    except ValueError:
+        stored = {}
+    if isinstance(stored, list):
+        stored = dict.fromkeys(stored, 0.0)   # прежний формат: просто список id
+    deferred: dict = {}   # season_id -> не сверять раньше этого момента
+    candidates: set = set()
+    for season_id, ready_ts in stored.items():
+        if float(ready_ts or 0) > started:
+            deferred[season_id] = float(ready_ts)
+        else:
+            candidates.add(season_id)
+    with _reconcile_seasons_lock:
+        noted = set(_reconcile_seasons_noted)
+        _reconcile_seasons_noted.clear()
+    candidates |= noted
+
+    fresh_cutoff = started - SEASON_COUNTS_RECONCILE_SETTLE_SEC
+    start_index, page_size = 0, 1000
+    while True:
+        params = {
+            "api_key": JELLYFIN_API_KEY,
+            "IncludeItemTypes": "Episode,Season",
+            "Recursive": "true",
+            # небольшой запас назад — на расхождение часов и неатомарность сохранения в Jellyfin
+            "MinDateLastSaved": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(hwm - 60)),
+            "Fields": "SeasonId,DateCreated",
+            "EnableImages": "false",
+            "EnableUserData": "false",
+            "StartIndex": start_index,
+            "Limit": page_size,
+        }
+        try:
+            r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=30)
+            r.raise_for_status()
+            page = (r.json() or {}).get("Items") or []
+        except Exception:
+            with _reconcile_seasons_lock:
+                _reconcile_seasons_noted.update(noted)   # не теряем — попробуем в следующий раз
+            raise
+        for it in page:
+            season_id = it.get("Id") if it.get("Type") == "Season" else it.get("SeasonId")
+            if not season_id:
+                continue
+            created = _jf_date_ts(it.get("DateCreated"))
+            if created and created > fresh_cutoff:
+                deferred[season_id] = max(deferred.get(season_id, 0.0), created + SEASON_COUNTS_RECONCILE_SETTLE_SEC)
+            else:
+                candidates.add(season_id)
+        if len(page) < page_size:
+            break
+        start_index += len(page)
+
+    for season_id in _episode_coalescer.held_seasons():
+        deferred.setdefault(season_id, started)
+    tracked = {sid for sid in candidates if sid not in deferred and sid in season_counts}
+
+    fixed = 0
+    for season_id in tracked:
+        try:
+            present = _season_present_count(season_id)
         except Exception as ex:
-            logging.warning(f"Sonarr worker loop error: {ex}")
+            logging.debug(f"Reconcile season_counts: count for {season_id} failed: {ex}")
+            deferred.setdefault(season_id, started)
+            continue
+        with season_lock(season_id):
+            st = season_counts.get(season_id)
+            if st is not None and int(st.get("last_count") or 0) != present:
+                logging.info(f"Reconcile season_counts: {season_id} {st.get('last_count')} → {present}")
+                st["last_count"] = present
+                mark_season_dirty(season_id)
+                fixed += 1
 
-        time.sleep(SONARR_SCAN_PERIOD_SEC)
+    state_meta_set("season_reconcile_deferred", json.dumps(dict(sorted(deferred.items()))))
+    state_meta_set("season_reconcile_hwm", started)
+    return fixed
 
 
-#Пробуем заполнять информацию о сезонах
-def _prime_season_counts_once():
+def _season_counts_reconcile_loop():
+    while True:
+        time.sleep(SEASON_COUNTS_RECONCILE_SEC)
+        try:
+            fixed = reconcile_season_counts()
+            if fixed:
+                logging.info(f"Reconcile season_counts: {fixed} season(s) corrected")
+        except Exception as ex:
+            logging.warning(f"Reconcile season_counts error: {ex}")
+
+
+
+
+#Очередь входящих событий (SQLite в state_directory)
+# Вебхуки только сохраняют событие и отвечают 202, а обогащение и рассылку делают фоновые воркеры.
+# Недоставленное переживает рестарт; события, упавшие EVENT_QUEUE_MAX_ATTEMPTS раз, уходят в dead-letter.
+_event_queue_wakeup = threading.Event()
+_event_workers_lock = threading.Lock()
+_event_workers_started = False
+_event_queue_local = threading.local()   # lease — (id, lease_ts) события, которое сейчас обрабатывает поток; held — не удалять
+
+
+def enqueue_event(source: str, payload: dict, not_before_ts: float | None = None) -> int:
+    """Сохраняет событие ('jellyfin' | 'radarr' | 'sonarr') в очередь и будит воркеры. Возвращает id."""
+    now = _now_ts()
+    cur = _state_db().execute(
+        "INSERT INTO event_queue (source, payload, next_attempt_ts, created_ts) VALUES (?, ?, ?, ?)",
+        (source, json.dumps(payload, ensure_ascii=False), not_before_ts or now, now),
+    )
+    _ensure_event_workers()
+    _event_queue_wakeup.set()
+    return cur.lastrowid
+
+
+def _event_queue_claim() -> sqlite3.Row | None:
     """
-    Проходит все сериалы и их сезоны в Jellyfin и дополняет season_counts.json
-    начальными значениями last_count (кол-во эпизодов с файлами).
-    Существующие записи не перетирает.
+    Атомарно забирает одно готовое событие. Событие, которое висит в 'processing' дольше
+    EVENT_QUEUE_LEASE_SEC (процесс упал посреди обработки), выдаётся повторно.
     """
-    import time
+    db = _state_db()
+    now = _now_ts()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        row = db.execute(
+            "SELECT *, ? AS lease_ts FROM event_queue"
+            " WHERE (status = 'pending' AND next_attempt_ts <= ?)"
+            "    OR (status = 'processing' AND claimed_ts < ?)"
+            " ORDER BY next_attempt_ts, id LIMIT 1",
+            (now, now, now - EVENT_QUEUE_LEASE_SEC),
+        ).fetchone()
+        if row is not None:
+            db.execute(
+                "UPDATE event_queue SET status = 'processing', claimed_ts = ?, attempts = attempts + 1 WHERE id = ?",
+                (now, row["id"]),
+            )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    return row
+
 
+def _event_queue_fail(row: sqlite3.Row, error: str) -> None:
+    db = _state_db()
+    attempts = int(row["attempts"]) + 1
+    if attempts >= EVENT_QUEUE_MAX_ATTEMPTS:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "INSERT OR REPLACE INTO event_dead_letter (id, source, payload, attempts, last_error, created_ts, failed_ts)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (row["id"], row["source"], row["payload"], attempts, error, row["created_ts"], _now_ts()),
+            )
+            db.execute("DELETE FROM event_queue WHERE id = ?", (row["id"],))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        logging.error(f"Event queue: #{row['id']} ({row['source']}) moved to dead-letter after {attempts} attempts: {error}")
+        return
+    delay = EVENT_QUEUE_RETRY_BASE_SEC * (2 ** (attempts - 1))
+    db.execute(
+        "UPDATE event_queue SET status = 'pending', next_attempt_ts = ?, last_error = ? WHERE id = ?",
+        (_now_ts() + delay, error, row["id"]),
+    )
+    logging.warning(f"Event queue: #{row['id']} ({row['source']}) failed, retry in {int(delay)}s: {error}")
+
+
+def event_queue_hold_current() -> tuple | None:
+    """
+    Событие очереди, которое обрабатывает текущий поток, не удалять по завершении: оно остаётся
+    в 'processing' (аренда EVENT_QUEUE_LEASE_SEC), пока его не снимет event_queue_release_held.
+    Упади процесс раньше — аренда истечёт и событие выдадут заново. Вне воркера очереди — None.
+    """
+    lease = getattr(_event_queue_local, "lease", None)
+    if lease is not None:
+        _event_queue_local.held = True
+    return lease
+
+
+def event_queue_release_held(leases, retry_payload: dict | None = None) -> None:
+    """
+    Удаляет удержанные события (только если аренда всё ещё наша) и, если нужно, одной транзакцией
+    с этим ставит retry_payload в очередь как новое событие 'jellyfin'.
+    """
+    leases = list(leases)
+    if not leases and retry_payload is None:
+        return
+    db = _state_db()
+    db.execute("BEGIN IMMEDIATE")
     try:
-        start_index = 0
-        limit = SEASON_COUNTS_PRIME_PAGE_SIZE
-        last_save_ts = time.time()
+        if retry_payload is not None:
+            now = _now_ts()
+            db.execute(
+                "INSERT INTO event_queue (source, payload, next_attempt_ts, created_ts) VALUES (?, ?, ?, ?)",
+                ("jellyfin", json.dumps(retry_payload, ensure_ascii=False), now, now),
+            )
+        db.executemany(
+            "DELETE FROM event_queue WHERE id = ? AND status = 'processing' AND claimed_ts = ?",
+            leases,
+        )
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    if retry_payload is not None:
+        _event_queue_wakeup.set()
+
+
+def _dispatch_queued_event(source: str, payload: dict):
+    if source == "jellyfin":
+        return process_jellyfin_event(payload)
+    if source == "jellyfin_socket":
+        return process_jellyfin_socket_batch(payload)
+    if source == "radarr":
+        return process_radarr_event(payload)
+    if source == "sonarr":
+        return process_sonarr_event(payload)
+    raise ValueError(f"unknown event source '{source}'")
+
+
+def _event_queue_idle_wait(max_wait: float = 5.0) -> float:
+    """Сколько спать без работы: до ближайшего отложенного повтора, но не дольше max_wait."""
+    try:
+        row = _state_db().execute(
+            "SELECT MIN(next_attempt_ts) AS ts FROM event_queue WHERE status = 'pending'"
+        ).fetchone()
+        if row and row["ts"] is not None:
+            return max(0.05, min(max_wait, float(row["ts"]) - _now_ts()))
+    except Exception:
+        pass
+    return max_wait
 
-        while True:
-            # 1) Берём страницу сериалов
-            params = {
-                "api_key": JELLYFIN_API_KEY,
-                "IncludeItemTypes": "Series",
-                "Recursive": "true",
-                "Fields": "ProviderIds,ProductionYear,Name",
-                "StartIndex": start_index,
-                "Limit": limit,
-            }
-            url = f"{JELLYFIN_BASE_URL}/emby/Items"
+
+def _event_queue_worker_loop():
+    while True:
+        try:
+            row = _event_queue_claim()
+        except Exception as ex:
+            logging.warning(f"Event queue claim failed: {ex}")
+            row = None
+        if row is None:
+            _event_queue_wakeup.wait(timeout=_event_queue_idle_wait())
+            _event_queue_wakeup.clear()
+            continue
+
+        _event_queue_local.lease = (row["id"], row["lease_ts"])
+        _event_queue_local.held = False
+        try:
+            result = _dispatch_queued_event(row["source"], json.loads(row["payload"]))
+            if _event_queue_local.held:
+                logging.info(f"Event queue: #{row['id']} ({row['source']}) held until its batch is sent: {result}")
+            else:
+                _state_db().execute("DELETE FROM event_queue WHERE id = ?", (row["id"],))
+                logging.info(f"Event queue: #{row['id']} ({row['source']}) done: {result}")
+        except Exception as ex:
             try:
-                r = requests.get(url, params=params, timeout=20)
-                r.raise_for_status()
-                data = r.json() or {}
-                series_items = data.get("Items") or []
-                if not series_items:
-                    break
-            except Exception as ex:
-                logging.warning(f"Prime season_counts: series page failed at {start_index}: {ex}")
-                break
+                _event_queue_fail(row, str(ex))
+            except Exception as ex2:
+                logging.warning(f"Event queue: cannot record failure of #{row['id']}: {ex2}")
+        finally:
+            _event_queue_local.lease = None
+
+
+def _ensure_event_workers() -> None:
+    """Ленивый старт воркеров очереди (работает и под gunicorn, где __main__ не выполняется)."""
+    global _event_workers_started
+    if _event_workers_started or not is_background_leader():
+        return   # очередь разбирает только процесс-лидер; остальные лишь кладут в неё события
+    with _event_workers_lock:
+        if _event_workers_started:
+            return
+        for i in range(max(1, EVENT_QUEUE_WORKERS)):
+            threading.Thread(target=_event_queue_worker_loop, name=f"event-queue-{i}", daemon=True).start()
+        _event_workers_started = True
+
+
+def replay_dead_letters(ids: list[int] | None = None) -> int:
+    """Возвращает события из dead-letter обратно в очередь (все или только ids). Возвращает их число."""
+    db = _state_db()
+    now = _now_ts()
+    where, args = "", ()
+    if ids:
+        where = f" WHERE id IN ({','.join('?' * len(ids))})"
+        args = tuple(int(x) for x in ids)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        rows = db.execute(f"SELECT * FROM event_dead_letter{where}", args).fetchall()
+        for r in rows:
+            db.execute(
+                "INSERT INTO event_queue (source, payload, next_attempt_ts, created_ts) VALUES (?, ?, ?, ?)",
+                (r["source"], r["payload"], now, r["created_ts"]),
+            )
+            db.execute("DELETE FROM event_dead_letter WHERE id = ?", (r["id"],))
+        db.execute("COMMIT")
+    except Exception:
+        db.execute("ROLLBACK")
+        raise
+    if rows:
+        _ensure_event_workers()
+        _event_queue_wakeup.set()
+    return len(rows)
 
-            for series in series_items:
-                series_id = series.get("Id")
-                if not series_id:
-                    continue
 
-                # 2) Берём сезоны сериала (не рекурсивно)
-                try:
-                    p2 = {
-                        "api_key": JELLYFIN_API_KEY,
-                        "ParentId": series_id,
-                        "IncludeItemTypes": "Season",
-                        "Recursive": "false",
-                        "Fields": "IndexNumber,Name",
-                        "Limit": 500,
-                    }
-                    r2 = requests.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=p2, timeout=15)
-                    r2.raise_for_status()
-                    seasons = (r2.json() or {}).get("Items") or []
-                except Exception as ex:
-                    logging.debug(f"Prime season_counts: list seasons failed: {ex}")
-                    continue
+def _queue_admin_allowed() -> bool:
+    secret = (request.args.get("secret") or request.headers.get("X-Notifierr-Secret") or "").strip()
+    return not EVENT_QUEUE_ADMIN_SECRET or secret == EVENT_QUEUE_ADMIN_SECRET
 
-                for season in seasons:
-                    season_id = season.get("Id")
-                    if not season_id:
-                        continue
-                    # 3) Считаем фактическое число эпизодов с файлами
-                    try:
-                        present = get_season_episode_count(series_id, season_id)
-                    except Exception as ex:
-                        logging.debug(f"Prime season_counts: count episodes failed: {ex}")
-                        continue
-
-                    # 4) Заполняем только пустые записи
-                    with _season_counts_lock:
-                        st = season_counts.get(season_id)
-                        if not st:
-                            season_counts[season_id] = {"last_count": int(present), "last_sent_ts": 0}
-                        elif "last_count" not in st:
-                            st["last_count"] = int(present)
-                            season_counts[season_id] = st
-
-                # Периодически сохраняем на диск
-                if (time.time() - last_save_ts) >= SEASON_COUNTS_PRIME_SAVE_SEC:
-                    with _season_counts_lock:
-                        save_season_counts(season_counts)
-                    last_save_ts = time.time()
-
-            start_index += limit
-
-        # Финальное сохранение
-        with _season_counts_lock:
-            save_season_counts(season_counts)
-        logging.info("Prime season_counts: completed.")
-    except Exception as ex:
-        logging.warning(f"Prime season_counts error: {ex}")
 
+@app.route("/queue/dead-letters", methods=["GET"])
+def queue_dead_letters():
+    if not _queue_admin_allowed():
+        return "forbidden", 403
+    rows = _state_db().execute(
+        "SELECT id, source, attempts, last_error, created_ts, failed_ts FROM event_dead_letter ORDER BY id"
+    ).fetchall()
+    return {"dead_letters": [dict(r) for r in rows]}, 200
 
 
+@app.route("/queue/replay", methods=["POST"])
+def queue_replay():
+    """POST /queue/replay — вернуть всё; ?id=5&id=7 — только выбранные."""
+    if not _queue_admin_allowed():
+        return "forbidden", 403
+    ids = [int(x) for x in request.args.getlist("id") if str(x).isdigit()]
+    n = replay_dead_letters(ids or None)
+    logging.info(f"Event queue: {n} dead-letter event(s) replayed")
+    return {"replayed": n}, 200
 
-@app.route("/webhook", methods=["POST"])
-def announce_new_releases_from_jellyfin():
+
+def _wake_pending_for_jellyfin_event(payload: dict) -> None:
+    """
+    Событие Jellyfin по фильму/серии → досрочная перепроверка подходящих ожидающих записей
+    Radarr/Sonarr (через PENDING_WAKE_DELAY_SEC), а не ждать страхового опроса.
+    """
+    item_type = payload.get("ItemType")
+    at_ts = _now_ts() + PENDING_WAKE_DELAY_SEC
     try:
-        payload = json.loads(request.data)
-        item_type = payload.get("ItemType")
-        tmdb_id = payload.get("Provider_tmdb")
-        item_name = payload.get("Name")
-        release_year = payload.get("Year")
-        series_name = payload.get("SeriesName")
-        season_epi = payload.get("EpisodeNumber00")
-        season_num = payload.get("SeasonNumber00")
-
-        if item_type == "Movie":
-                movie_id = payload.get("ItemId")
-                overview = payload.get("Overview")
-                runtime = payload.get("RunTime")
-                # Remove release_year from movie_name if present
-                movie_name = item_name
-                movie_name_cleaned = movie_name.replace(f" ({release_year})", "").strip()
-
-                trailer_url = get_tmdb_trailer_url("movie", tmdb_id, TMDB_TRAILER_LANG)
-
-                notification_message = (
-                    f"*{t('new_movie_title')}*\n\n"
-                    f"*{movie_name_cleaned}* *({release_year})*\n\n"
-                    f"{overview}\n\n"
-                    f"*{t('new_runtime')}*\n{runtime}"
-                )
+        if item_type == "Movie" and RADARR_ENABLED:
+            keys = [f"tmdb:{payload.get('Provider_tmdb')}" if payload.get("Provider_tmdb") else None,
+                    f"imdb:{payload.get('Provider_imdb')}" if payload.get("Provider_imdb") else None]
+            woken = [k for k in keys if k and radarr_pending.wake(k, at_ts)]
+        elif item_type in ("Episode", "Season") and SONARR_ENABLED and sonarr_pending.count():
+            series_id = payload.get("SeriesId")
+            season_id = payload.get("SeasonId") if item_type == "Episode" else payload.get("ItemId")
+            if not series_id or not season_id:
+                item0 = (get_item_details(payload.get("ItemId")).get("Items") or [{}])[0]
+                series_id = series_id or item0.get("SeriesId")
+                season_id = season_id or (item0.get("SeasonId") if item_type == "Episode" else item0.get("Id"))
+            if not series_id:
+                return
+            # записи, ещё не привязанные к Jellyfin: сверяем сериал через индекс внешних ID
+            def _same_series(entry: dict) -> bool:
+                for provider in ("tvdb", "tmdb", "tvmaze", "imdb"):
+                    if entry.get(provider) and any(c.get("Id") == series_id
+                                                   for c in provider_index.lookup("Series", provider, entry[provider])):
+                        return True
+                return False
+
+            woken = sonarr_pending.wake_where(
+                lambda k, e: (e.get("season_id") == season_id) if e.get("season_id") else _same_series(e), at_ts)
+        else:
+            return
+        if woken:
+            logging.info(f"Jellyfin {item_type} event: pending re-check woken for {', '.join(woken)}")
+    except Exception as ex:
+        logging.warning(f"Could not wake pending entries for Jellyfin event: {ex}")
+
+
+def process_episode_batch(payload: dict):
+    """
+    Episode-пайплайн: проверка анти-спама по season_counts, обогащение и одно сообщение
+    «добавлено N из M» по сезону. При включённом коалесинге вызывается один раз на пачку
+    вебхуков сезона (с payload последнего из них).
+    """
+    # 1) Базовые ID (из вебхука, если шаблон их передаёт, иначе — из деталей эпизода)
+    episode_id = payload.get("ItemId")
+    season_id = payload.get("SeasonId")
+    series_id = payload.get("SeriesId")
+    if not season_id or not series_id:
+        file_details = get_item_details(episode_id)
+        item0 = (file_details.get("Items") or [{}])[0]
+        season_id = item0.get("SeasonId")
+        series_id = item0.get("SeriesId")
+
+    if not season_id or not series_id:
+        logging.warning("Episode payload missing SeasonId/SeriesId; skipping.")
+        return "Skipped: missing SeasonId/SeriesId", 200
+
+    # 2-3) Всё, что нужно для решения анти-спама, + дешёвые (кэшируемые) рейтинги/трейлер.
+    # Сезон+сериал (один запрос) и счётчик серий идут параллельно; TMDb-запросы стартуют, как только известен TMDb id.
+    stage = EnrichmentStage("episode")
+    stage.add("items", lambda: get_items_details([season_id, series_id]), required=True)
+    stage.add("season", lambda items: items.get(season_id) or {"Items": []}, deps=("items",), required=True)
+    stage.add("series", lambda items: items.get(series_id) or {"Items": []}, deps=("items",), required=True)
+    stage.add("present_count", lambda: get_season_episode_count(series_id, season_id), required=True)
+    stage.add("tmdb_id", lambda series: extract_tmdb_id_from_jellyfin_details(series), deps=("series",))
+    stage.add("season_number", lambda season: extract_season_number_from_details(season), deps=("season",))
+    stage.add("planned_total",
+              lambda tmdb_id, season_number: (
+                  get_tmdb_season_total_episodes(tmdb_id, season_number, TMDB_TRAILER_LANG)
+                  if tmdb_id and season_number is not None else None),
+              deps=("tmdb_id", "season_number"))
+    stage.add("ratings", lambda tmdb_id: fetch_mdblist_ratings("show", tmdb_id) if tmdb_id else "",
+              deps=("tmdb_id",), default="")
+    stage.add("trailer", lambda tmdb_id: get_tmdb_trailer_url("tv", tmdb_id, TMDB_TRAILER_LANG) if tmdb_id else None,
+              deps=("tmdb_id",))
+    enriched = stage.run()
+
+    season_details = enriched["season"]
+    series_details = enriched["series"]
+    season_item = (season_details.get("Items") or [{}])[0]
+    series_item = (series_details.get("Items") or [{}])[0]
+
+    series_name = series_item.get("Name") or payload.get("SeriesName") or "Unknown series"
+    season_name = season_item.get("Name") or "Season"
+    release_year = series_item.get("ProductionYear") or payload.get("Year") or ""
+
+    present_count = enriched["present_count"]
+    planned_total = enriched["planned_total"]
+
+    # 4) Анти-спам на основе состояния
+    now_ts = time.time()
+    with season_lock(season_id):
+        st = season_counts.get(season_id) or {}
+        last_sent = float(st.get("last_sent_ts") or 0)
+        last_count = int(st.get("last_count") or 0)
+
+        should_send = False
+        # отправляем, если увеличилось число эпизодов...
+        if present_count > last_count:
+            # ...и прошло не меньше заданного окна (или сезон добит до планового числа)
+            quiet_enough = (now_ts - last_sent) >= EPISODE_MSG_MIN_GAP_SEC
+            completed = planned_total and present_count >= planned_total
+            should_send = bool(quiet_enough or completed)
+
+        # обновляем «наблюдаемое» состояние (чтобы при следующем вебхуке знали актуальный счётчик)
+        st["last_count"] = present_count
+        # но метку отправки перепишем только если реально пошлём
+        season_counts[season_id] = st
+        mark_season_dirty(season_id)
+        if not should_send:
+            logging.info(
+                f"(Episode batch) Suppressed by anti-spam: {series_name}/{season_name} now {present_count}"
+                + (f" of {planned_total}" if planned_total else ""))
+            return "Suppressed by anti-spam window", 200
+
+    # 5) Тяжёлое — только если реально шлём: техблок по всему сезону и постер
+    stage = EnrichmentStage("episode_send")
+    if INCLUDE_MEDIA_TECH_INFO:
+        stage.add("tech", lambda: build_season_media_tech_text(series_id, season_id), default="")
+    stage.add("poster", lambda: pick_jellyfin_poster(season_id, series_id), default=(season_id, None))
+    enriched.update(stage.run())
+    ratings_text = enriched["ratings"]
+    trailer_url = enriched["trailer"]
+
+    overview_to_use = (
+            season_item.get("Overview")
+            or series_item.get("Overview")
+            or payload.get("Overview")
+            or ""
+    )
+    # 6) Сообщение: «добавлено N из M»
+    added_line = (
+        t('season_added_progress').format(added=present_count, total=planned_total)
+        if planned_total else
+        t('season_added_count_only').format(added=present_count)
+    )
+    notification_message = (
+        f"*{t('new_episode_title')}*\n\n"
+        f"*{series_name}* *({release_year})*\n\n"
+        f"*{season_name}*\n\n"
+        f"{overview_to_use}\n\n"
+        f"{added_line}"
+    )
 
-                # Добавляем блок качества/аудио (опционально, по умолчанию включено)
-                if INCLUDE_MEDIA_TECH_INFO:
-                    try:
-                        movie_details = get_item_details(movie_id)
-                        tech_text = build_movie_media_tech_text(movie_details)
-                        if tech_text:
-                            notification_message += tech_text
-                    except Exception as e:
-                        logging.warning(f"Could not append media tech info: {e}")
-
-                if tmdb_id:
-                    # приводим тип к тому, что ждёт MDblist: movie или series
-                    mdblist_type = item_type.lower()
-                    ratings_text = fetch_mdblist_ratings(mdblist_type, tmdb_id)
-                    if ratings_text:
-                        notification_message += f"\n\n*{t('new_ratings_movie')}:*\n{ratings_text}"
-
-                if trailer_url:
-                    notification_message += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
-
-                send_notification(movie_id, notification_message)
-                logging.info(f"(Movie) {movie_name} {release_year} notification was sent.")
-                return "Movie notification was sent"
-
-        if item_type == "Season":
-                season_id = payload.get("ItemId")
-                season = item_name
-                season_details = get_item_details(season_id)
-                series_id = season_details["Items"][0].get("SeriesId")
-                series_details = get_item_details(series_id)
-                # Remove release_year from series_name if present
-                series_name_cleaned = series_name.replace(f" ({release_year})", "").strip()
+    # Блок техники по сезону (по умолчанию включён через INCLUDE_MEDIA_TECH_INFO)
+    if enriched.get("tech"):
+        notification_message += f"{enriched['tech']}"
+
+    if ratings_text:
+        notification_message += f"\n\n*{t('new_ratings_show')}:*\n{ratings_text}"
+    if trailer_url:
+        notification_message += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
+
+    # 7) Отправка (постер сезона → фолбэк на сериал)
+    target_id, poster = enriched["poster"]
+    if target_id == series_id:
+        logging.warning("(Episode batch) Season image missing; fallback to series image.")
+    send_notification(target_id, notification_message, poster=poster)
+
+    # 8) Зафиксировать момент отправки
+    with season_lock(season_id):
+        season_counts[season_id]["last_sent_ts"] = now_ts
+    mark_season_dirty(season_id)
+
+    logging.info(
+        f"(Episode batch) {series_name}/{season_name}: sent {present_count}"
+        + (f" of {planned_total}" if planned_total else "")
+    )
+    return "Episode batch notification was sent to telegram", 200
 
+
+#Коалесинг Episode-вебхуков: пачка серий одного сезона → один прогон пайплайна
+class EpisodeCoalescer:
+    """
+    Debounce по SeasonId: события копятся, пока по сезону не наступит тишина quiet_sec
+    (но не дольше max_hold_sec от первого события), затем handler(season_id, payload, events, leases)
+    вызывается один раз с payload последнего события. Обработчики выполняются в отдельном потоке.
+    leases — удержанные события очереди пачки, кроме тех, что ещё нужны другим ждущим пачкам
+    (одна пачка /socket может накрыть несколько сезонов).
+    """
+
+    def __init__(self, quiet_sec: float, max_hold_sec: float, handler):
+        self.quiet_sec = float(quiet_sec)
+        self.max_hold_sec = max(float(max_hold_sec), self.quiet_sec)
+        self.handler = handler
+        self._pending: dict = {}   # season_id -> {"payload", "first", "last", "events", "leases"}
+        self._cond = threading.Condition()
+        self._thread = None
+        self.events = 0
+        self.flushes = 0
+
+    def _due(self, rec: dict) -> float:
+        return min(rec["last"] + self.quiet_sec, rec["first"] + self.max_hold_sec)
+
+    def submit(self, season_id: str, payload: dict, lease: tuple | None = None) -> int:
+        now = time.monotonic()
+        with self._cond:
+            rec = self._pending.get(season_id)
+            if rec is None:
+                rec = self._pending[season_id] = {"first": now, "events": 0, "leases": set()}
+            rec["payload"] = payload
+            if lease is not None:
+                rec["leases"].add(lease)
+            rec["last"] = now
+            rec["events"] += 1
+            self.events += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="episode-coalescer", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return rec["events"]
+
+    def drain(self) -> list:
+        """Забрать всё, что ещё ждёт (для выхода процесса): [(season_id, payload, events, leases)]."""
+        with self._cond:
+            out = [(sid, rec["payload"], rec["events"], set(rec["leases"])) for sid, rec in self._pending.items()]
+            self._pending.clear()
+            return out
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    due = [sid for sid, rec in self._pending.items() if self._due(rec) <= now]
+                    if due:
+                        batch = [(sid, self._pending.pop(sid)) for sid in due]
+                        still_held = set().union(*(rec["leases"] for rec in self._pending.values()))
+                        for _, rec in batch:
+                            rec["leases"] -= still_held
+                        break
+                    timeout = min((self._due(rec) for rec in self._pending.values()), default=now + 60) - now
+                    self._cond.wait(timeout=max(0.05, timeout))
+            for sid, rec in batch:
+                self.flushes += 1
                 try:
-                    series_tmdb_id = extract_tmdb_id_from_jellyfin_details(series_details)
-                except NameError:
-                    # если helper ещё не добавлен — используем то, что пришло из вебхука
-                    series_tmdb_id = payload.get("Provider_tmdb")
-
-                trailer_url = get_tmdb_trailer_url("tv", series_tmdb_id, TMDB_TRAILER_LANG)
-
-                # Get TMDb ID via external API
-                tmdb_id = extract_tmdb_id_from_jellyfin_details(series_details)
-
-                # **Новые строки**: получаем рейтинги для сериала
-                ratings_text = fetch_mdblist_ratings("show", tmdb_id) if tmdb_id else ""
-                # Если есть рейтинги — добавляем пустую строку после них
-                ratings_section = f"{ratings_text}\n\n" if ratings_text else ""
-
-                # Get series overview if season overview is empty
-                overview_to_use = payload.get("Overview") if payload.get("Overview") else series_details["Items"][0].get(
-                    "Overview")
-
-                notification_message = (
-                    f"*{t('new_season_title')}*\n\n"
-                    f"*{series_name_cleaned}* *({release_year})*\n\n"
-                    f"*{season}*\n\n"
-                    f"{overview_to_use}"
-                )
+                    self.handler(sid, rec["payload"], rec["events"], rec["leases"])
+                except Exception as ex:
+                    logging.warning(f"Episode coalescer: handler failed for season {sid}: {ex}")
 
-                if ratings_text:
-                    notification_message += f"\n\n*{t('new_ratings_show')}:*\n{ratings_text}"
+    def held_seasons(self) -> set:
+        with self._cond:
+            return set(self._pending)
 
-                if trailer_url:
-                    notification_message += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
+    def stats(self) -> dict:
+        with self._cond:
+            return {"pending_seasons": len(self._pending), "events": self.events, "flushes": self.flushes}
 
-                target_id = season_id if jellyfin_image_exists(season_id) else series_id
-                if target_id == series_id:
-                    logging.warning(
-                        f"{series_name_cleaned} {season} image does not exist, falling back to series image")
 
-                send_notification(target_id, notification_message)
-                logging.info(f"(Season) {series_name_cleaned} {season} notification was sent.")
-                return "Season notification was sent"
+def _flush_episode_batch(season_id: str, payload: dict, events: int, leases: set) -> None:
+    """
+    Рассылка пачки сезона. События очереди, из которых она собрана, лежат в 'processing' до этого момента
+    и удаляются только здесь — рестарт/падение в окне тишины их не теряет (аренда истечёт, событие выдадут заново).
+    """
+    logging.info(f"(Episode batch) season {season_id}: quiet window elapsed, {events} webhook(s) coalesced")
+    try:
+        process_episode_batch(payload)
+    except Exception as ex:
+        logging.warning(f"(Episode batch) season {season_id} failed: {ex}")
+        if EVENT_QUEUE_ENABLED:
+            # повтор с backoff — уже через очередь событий (payload помечен _coalesced)
+            event_queue_release_held(leases, retry_payload=payload)
+        return
+    event_queue_release_held(leases)
+
+
+_episode_coalescer = EpisodeCoalescer(EPISODE_COALESCE_QUIET_SEC, EPISODE_COALESCE_MAX_HOLD_SEC, _flush_episode_batch)
+
+
+def _coalesce_episode_event(payload: dict):
+    season_id = payload.get("SeasonId")
+    series_id = payload.get("SeriesId")
+    if not season_id or not series_id:
+        item0 = (get_item_details(payload.get("ItemId")).get("Items") or [{}])[0]
+        season_id = item0.get("SeasonId")
+        series_id = item0.get("SeriesId")
+    if not season_id or not series_id:
+        logging.warning("Episode payload missing SeasonId/SeriesId; skipping.")
+        return "Skipped: missing SeasonId/SeriesId", 200
+
+    events = _episode_coalescer.submit(
+        season_id, dict(payload, SeasonId=season_id, SeriesId=series_id, _coalesced=True),
+        lease=event_queue_hold_current())
+    logging.info(
+        f"(Episode) {payload.get('SeriesName')} S{payload.get('SeasonNumber00')}E{payload.get('EpisodeNumber00')} "
+        f"held for season batch ({events} event(s) so far)")
+    return "Coalesced into season batch", 202
+
+
+@atexit.register
+def _release_coalesced_episodes():
+    # сохранность от этого не зависит (события и так в 'processing'); при штатном выходе лишь
+    # возвращаем их в 'pending', чтобы следующий запуск не ждал истечения аренды
+    leases = set().union(*(held for _, _, _, held in _episode_coalescer.drain()))
+    if not leases:
+        return
+    try:
+        _state_db().executemany(
+            "UPDATE event_queue SET status = 'pending', next_attempt_ts = ? WHERE id = ? AND status = 'processing' AND claimed_ts = ?",
+            [(_now_ts(), row_id, lease_ts) for row_id, lease_ts in leases],
+        )
+    except Exception as ex:
+        logging.warning(f"Episode coalescer: could not release held events: {ex}")
+
+
+#Один элемент может прийти и вебхуком, и через /socket, и повторно из догонялки после рестарта — объявляем его один раз
+class AnnouncedItems:
+    """
+    Объявленные элементы в notifierr.db (таблица announced_items) со сроком жизни ttl:
+    отметки переживают перезапуск и общие для всех процессов. Просроченные строки чистятся
+    не чаще раза в PRUNE_EVERY_SEC.
+    """
+    PRUNE_EVERY_SEC = 3600.0
+
+    def __init__(self, ttl: float):
+        self.ttl = float(ttl)
+        self._pruned_ts = 0.0
+        self.added = 0
+        self.duplicates = 0
+
+    def add(self, item_id: str) -> bool:
+        """Атомарно отметить элемент, если живой отметки ещё нет. True — отметили (объявлять)."""
+        now = _now_ts()
+        db = _state_db()
+        cur = db.execute(
+            "INSERT INTO announced_items (item_id, announced_ts) VALUES (?, ?)"
+            " ON CONFLICT(item_id) DO UPDATE SET announced_ts = excluded.announced_ts WHERE announced_ts < ?",
+            (item_id, now, now - self.ttl),
+        )
+        if now - self._pruned_ts >= self.PRUNE_EVERY_SEC:
+            self._pruned_ts = now
+            db.execute("DELETE FROM announced_items WHERE announced_ts < ?", (now - self.ttl,))
+        if cur.rowcount > 0:
+            self.added += 1
+            return True
+        self.duplicates += 1
+        return False
+
+    def discard(self, item_id: str) -> None:
+        _state_db().execute("DELETE FROM announced_items WHERE item_id = ?", (item_id,))
+
+    def stats(self) -> dict:
+        size = int(_state_db().execute("SELECT COUNT(*) FROM announced_items").fetchone()[0])
+        return {"size": size, "added": self.added, "duplicates": self.duplicates}
+
 
+_announced_items = AnnouncedItems(ttl=ANNOUNCED_ITEMS_TTL_SEC)
+_ANNOUNCE_ONCE_TYPES = ("Movie", "Season", "MusicAlbum")   # Episode и так сводится в пачку и проходит анти-спам
+
+
+def process_jellyfin_event(payload: dict):
+    """
+    Обработка одного события Jellyfin Webhook (Movie / Season / Episode / MusicAlbum).
+    Ошибки Jellyfin/сети пробрасываются наружу — очередь событий повторит попытку.
+    """
+    item_id = payload.get("ItemId")
+    once = (payload.get("ItemType") in _ANNOUNCE_ONCE_TYPES and item_id
+            and str(payload.get("NotificationType") or "").lower() not in ("itemupdated", "itemdeleted"))
+    if once and not _announced_items.add(item_id):
+        logging.info(f"({payload.get('ItemType')}) {payload.get('Name')}: already announced, skipping duplicate event")
+        return "Already announced", 200
+    try:
+        return _process_jellyfin_event(payload)
+    except Exception:
+        if once:
+            _announced_items.discard(item_id)   # повтор из очереди должен объявить заново
+        raise
+
+
+def _process_jellyfin_event(payload: dict):
+    item_type = payload.get("ItemType")
+    tmdb_id = payload.get("Provider_tmdb")
+    item_name = payload.get("Name")
+    release_year = payload.get("Year")
+    series_name = payload.get("SeriesName")
+    season_epi = payload.get("EpisodeNumber00")
+    season_num = payload.get("SeasonNumber00")
+
+    # Movie/Series — сразу в индекс внешних ID (Radarr/Sonarr-воркеры найдут их без полного пересбора)
+    provider_index.note_webhook(payload)
+    if PENDING_EVENT_WAKE:
+        _wake_pending_for_jellyfin_event(payload)
+
+    # Обновление/удаление элемента — повод перепроверить ожидания, но не «новинка»
+    notification_type = str(payload.get("NotificationType") or "").lower()
+    if notification_type in ("itemupdated", "itemdeleted"):
         if item_type == "Episode":
-            # 1) Базовые ID
-            episode_id = payload.get("ItemId")
-            file_details = get_item_details(episode_id)
-            item0 = (file_details.get("Items") or [{}])[0]
-            season_id = item0.get("SeasonId")
-            series_id = item0.get("SeriesId")
-
-            if not season_id or not series_id:
-                logging.warning("Episode payload missing SeasonId/SeriesId; skipping.")
-                return "Skipped: missing SeasonId/SeriesId", 200
-
-            # 2) Детали сезона и сериала
-            season_details = get_item_details(season_id)
-            series_details = get_item_details(series_id)
-            season_item = (season_details.get("Items") or [{}])[0]
-            series_item = (series_details.get("Items") or [{}])[0]
-
-            series_name = series_item.get("Name") or payload.get("SeriesName") or "Unknown series"
-            season_name = season_item.get("Name") or "Season"
-            release_year = series_item.get("ProductionYear") or payload.get("Year") or ""
-
-            # 3) Фактическое число серий сейчас (Jellyfin) + план (TMDb)
-            present_count = get_season_episode_count(series_id, season_id)
+            note_season_changed(payload.get("SeasonId"))
+        logging.info(f"({item_type}) {item_name}: {payload.get('NotificationType')} — no announcement")
+        return "Not an ItemAdded event", 200
+
+    if item_type == "Movie":
+            movie_id = payload.get("ItemId")
+            overview = payload.get("Overview")
+            runtime = payload.get("RunTime")
+            # Remove release_year from movie_name if present
+            movie_name = item_name
+            movie_name_cleaned = movie_name.replace(f" ({release_year})", "").strip()
+
+            # Все доп. данные независимы друг от друга — собираем параллельно
+            stage = EnrichmentStage("movie")
+            stage.add("trailer", lambda: get_tmdb_trailer_url("movie", tmdb_id, TMDB_TRAILER_LANG))
+            # приводим тип к тому, что ждёт MDblist: movie или series
+            stage.add("ratings", lambda: fetch_mdblist_ratings(item_type.lower(), tmdb_id) if tmdb_id else "", default="")
+            # блок качества/аудио (опционально, по умолчанию включено)
+            if INCLUDE_MEDIA_TECH_INFO:
+                stage.add("tech", lambda: build_movie_media_tech_text(get_item_details(movie_id)), default="")
+            stage.add("poster", lambda: fetch_jellyfin_poster(movie_id))
+            enriched = stage.run()
 
-            try:
-                series_tmdb_id = extract_tmdb_id_from_jellyfin_details(series_details)
-            except NameError:
-                series_tmdb_id = None
-
-            season_number = extract_season_number_from_details(season_details)
-            planned_total = (
-                get_tmdb_season_total_episodes(series_tmdb_id, season_number, TMDB_TRAILER_LANG)
-                if series_tmdb_id and season_number is not None else None
+            notification_message = (
+                f"*{t('new_movie_title')}*\n\n"
+                f"*{movie_name_cleaned}* *({release_year})*\n\n"
+                f"{overview}\n\n"
+                f"*{t('new_runtime')}*\n{runtime}"
             )
 
-            # 4) Анти-спам на основе состояния
-            now_ts = time.time()
-            with _season_counts_lock:
-                st = season_counts.get(season_id) or {}
-                last_sent = float(st.get("last_sent_ts") or 0)
-                last_count = int(st.get("last_count") or 0)
-
-                should_send = False
-                # отправляем, если увеличилось число эпизодов...
-                if present_count > last_count:
-                    # ...и прошло не меньше заданного окна (или сезон добит до планового числа)
-                    quiet_enough = (now_ts - last_sent) >= EPISODE_MSG_MIN_GAP_SEC
-                    completed = planned_total and present_count >= planned_total
-                    should_send = bool(quiet_enough or completed)
-
-                # обновляем «наблюдаемое» состояние (чтобы при следующем вебхуке знали актуальный счётчик)
-                st["last_count"] = present_count
-                # но метку отправки перепишем только если реально пошлём
-                season_counts[season_id] = st
-                if not should_send:
-                    save_season_counts(season_counts)
-                    logging.info(
-                        f"(Episode batch) Suppressed by anti-spam: {series_name}/{season_name} now {present_count}"
-                        + (f" of {planned_total}" if planned_total else ""))
-                    return "Suppressed by anti-spam window", 200
-
-            # 5) Доп. данные: рейтинги + трейлер по сериалу
-            ratings_text = fetch_mdblist_ratings("show", series_tmdb_id) if series_tmdb_id else ""
-            trailer_url = get_tmdb_trailer_url("tv", series_tmdb_id, TMDB_TRAILER_LANG) if series_tmdb_id else None
-
-            overview_to_use = (
-                    season_item.get("Overview")
-                    or series_item.get("Overview")
-                    or payload.get("Overview")
-                    or ""
-            )
-            # 6) Сообщение: «добавлено N из M»
-            added_line = (
-                t('season_added_progress').format(added=present_count, total=planned_total)
-                if planned_total else
-                t('season_added_count_only').format(added=present_count)
-            )
+            if enriched.get("tech"):
+                notification_message += enriched["tech"]
+
+            ratings_text = enriched["ratings"]
+            if ratings_text:
+                notification_message += f"\n\n*{t('new_ratings_movie')}:*\n{ratings_text}"
+
+            trailer_url = enriched["trailer"]
+            if trailer_url:
+                notification_message += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
+
+            send_notification(movie_id, notification_message, poster=enriched["poster"] or {})
+            logging.info(f"(Movie) {movie_name} {release_year} notification was sent.")
+            return "Movie notification was sent"
+
+    if item_type == "Season":
+            season_id = payload.get("ItemId")
+            season = item_name
+            # Remove release_year from series_name if present
+            series_name_cleaned = series_name.replace(f" ({release_year})", "").strip()
+
+            # season + series (одним запросом, если SeriesId пришёл в вебхуке) → TMDb id → (трейлер | рейтинги);
+            # постер сезона — параллельно со всем
+            payload_series_id = payload.get("SeriesId")
+            stage = EnrichmentStage("season")
+            if payload_series_id:
+                stage.add("items", lambda: get_items_details([season_id, payload_series_id]), required=True)
+                stage.add("season", lambda items: items[season_id], deps=("items",), required=True)
+                stage.add("series_id", lambda: payload_series_id)
+                stage.add("series", lambda items: items[payload_series_id], deps=("items",), required=True)
+            else:
+                stage.add("season", lambda: get_item_details(season_id), required=True)
+                stage.add("series_id", lambda season: season["Items"][0].get("SeriesId"), deps=("season",), required=True)
+                stage.add("series", lambda series_id: get_item_details(series_id), deps=("series_id",), required=True)
+            stage.add("tmdb_id", lambda series: extract_tmdb_id_from_jellyfin_details(series), deps=("series",))
+            stage.add("trailer", lambda tmdb_id: get_tmdb_trailer_url("tv", tmdb_id, TMDB_TRAILER_LANG), deps=("tmdb_id",))
+            stage.add("ratings", lambda tmdb_id: fetch_mdblist_ratings("show", tmdb_id) if tmdb_id else "",
+                      deps=("tmdb_id",), default="")
+            stage.add("poster", lambda series_id: pick_jellyfin_poster(season_id, series_id),
+                      deps=("series_id",), default=(season_id, None))
+            enriched = stage.run()
+
+            series_id = enriched["series_id"]
+            series_details = enriched["series"]
+            trailer_url = enriched["trailer"]
+            ratings_text = enriched["ratings"]
+            # Если есть рейтинги — добавляем пустую строку после них
+            ratings_section = f"{ratings_text}\n\n" if ratings_text else ""
+
+            # Get series overview if season overview is empty
+            overview_to_use = payload.get("Overview") if payload.get("Overview") else series_details["Items"][0].get(
+                "Overview")
+
             notification_message = (
-                f"*{t('new_episode_title')}*\n\n"
-                f"*{series_name}* *({release_year})*\n\n"
-                f"*{season_name}*\n\n"
-                f"{overview_to_use}\n\n"
-                f"{added_line}"
+                f"*{t('new_season_title')}*\n\n"
+                f"*{series_name_cleaned}* *({release_year})*\n\n"
+                f"*{season}*\n\n"
+                f"{overview_to_use}"
             )
 
-            # Блок техники по сезону (по умолчанию включён через INCLUDE_MEDIA_TECH_INFO)
-            if INCLUDE_MEDIA_TECH_INFO:
-                try:
-                    season_tech = build_season_media_tech_text(series_id, season_id)
-                    if season_tech:
-                        notification_message += f"{season_tech}"
-                except Exception as e:
-                    logging.warning(f"Could not append season tech info: {e}")
-
             if ratings_text:
                 notification_message += f"\n\n*{t('new_ratings_show')}:*\n{ratings_text}"
+
             if trailer_url:
                 notification_message += f"\n\n[🎥]({trailer_url})[{t('new_trailer')}]({trailer_url})"
 
-            # 7) Отправка (постер сезона → фолбэк на сериал)
-            target_id = season_id if jellyfin_image_exists(season_id) else series_id
+            target_id, poster = enriched["poster"]
             if target_id == series_id:
-                logging.warning("(Episode batch) Season image missing; fallback to series image.")
-            send_notification(target_id, notification_message)
+                logging.warning(
+                    f"{series_name_cleaned} {season} image does not exist, falling back to series image")
+
+            send_notification(target_id, notification_message, poster=poster)
+            logging.info(f"(Season) {series_name_cleaned} {season} notification was sent.")
+            return "Season notification was sent"
+
+    if item_type == "Episode":
+        if EPISODE_COALESCE_QUIET_SEC > 0 and not payload.get("_coalesced"):
+            return _coalesce_episode_event(payload)
+        return process_episode_batch(payload)
+
+    if item_type == "MusicAlbum":
+            album_id = payload.get("ItemId")
+            album_name = payload.get("Name")
+            artist = payload.get("Artist")
+            year = payload.get("Year")
+            overview = payload.get("Overview")
+            runtime = payload.get("RunTime")
+            musicbrainzalbum_id = payload.get("Provider_musicbrainzalbum")
+
+            # Формируем ссылку на MusicBrainz, если есть ID
+            mb_link = f"https://musicbrainz.org/release/{musicbrainzalbum_id}" if musicbrainzalbum_id else ""
+
+            # Шаблон уведомления
+            notification_message = (
+                f"*{t('new_album_title')}*\n\n"
+                f"*{artist}*\n\n"
+                f"*{album_name} ({year})*\n\n"
+                f"{(overview + '\n\n') if overview else ''}"
+                f"*{t('new_runtime')}*\n{runtime}\n\n"
+                f"{f'[MusicBrainz]({mb_link})' if mb_link else ''}\n"
+            )
 
-            # 8) Зафиксировать момент отправки
-            with _season_counts_lock:
-                season_counts[season_id]["last_sent_ts"] = now_ts
-                save_season_counts(season_counts)
+            # Отправляем обложку альбома, если есть, иначе ничего страшного
+            _, poster = pick_jellyfin_poster(album_id)
+            if not poster:
+                logging.warning(f"Album cover not found for {album_name}, sending text-only.")
+            # {} — обложки нет: каналы сами уйдут в текстовый режим, повторно не скачивая
+            send_notification(album_id, notification_message, poster=poster or {})
+
+            logging.info(f"(Album) {artist} – {album_name} ({year}) notification sent.")
+            return "Album notification was sent"
+
+    if item_type == "Movie":
+        logging.info(f"(Movie) {item_name} Notification Was Already Sent")
+    elif item_type == "Season":
+        logging.info(f"(Season) {series_name} {item_name} Notification Was Already Sent")
+    elif item_type == "Episode":
+        logging.info(f"(Episode) {series_name} S{season_num}E{season_epi} Notification Was Already Sent")
+    else:
+        logging.error('Item type not supported')
+    return "Item type not supported."
 
-            logging.info(
-                f"(Episode batch) {series_name}/{season_name}: sent {present_count}"
-                + (f" of {planned_total}" if planned_total else "")
-            )
-            return "Episode batch notification was sent to telegram", 200
-
-
-        if item_type == "MusicAlbum":
-                album_id = payload.get("ItemId")
-                album_name = payload.get("Name")
-                artist = payload.get("Artist")
-                year = payload.get("Year")
-                overview = payload.get("Overview")
-                runtime = payload.get("RunTime")
-                musicbrainzalbum_id = payload.get("Provider_musicbrainzalbum")
-
-                # Формируем ссылку на MusicBrainz, если есть ID
-                mb_link = f"https://musicbrainz.org/release/{musicbrainzalbum_id}" if musicbrainzalbum_id else ""
-
-                # Шаблон уведомления
-                notification_message = (
-                    f"*{t('new_album_title')}*\n\n"
-                    f"*{artist}*\n\n"
-                    f"*{album_name} ({year})*\n\n"
-                    f"{(overview + '\n\n') if overview else ''}"
-                    f"*{t('new_runtime')}*\n{runtime}\n\n"
-                    f"{f'[MusicBrainz]({mb_link})' if mb_link else ''}\n"
-                )
 
-                # Отправляем обложку альбома, если есть, иначе ничего страшного
-                target_id = album_id if jellyfin_image_exists(album_id) else None
-                if target_id is None:
-                    logging.warning(f"Album cover not found for {album_name}, sending text-only.")
-                    # Вызовем отправку без картинки: используем send_notification на тексте
-                    send_notification(album_id, notification_message)  # он сам отправит текст, если картинки нет
-                else:
-                    send_notification(target_id, notification_message)
+#Jellyfin WebSocket (/socket): LibraryChanged → те же обработчики, что и у Webhook-плагина
+def _jellyfin_item_to_payload(item: dict, notification_type: str) -> dict:
+    """Элемент /Items → payload в формате Jellyfin Webhook-плагина (поля, которые читает process_jellyfin_event)."""
+    overview, runtime = _extract_overview_and_runtime({"Items": [item]})
+    payload = {
+        "NotificationType": notification_type,
+        "ItemId": item.get("Id"),
+        "ItemType": item.get("Type"),
+        "Name": item.get("Name"),
+        "Year": item.get("ProductionYear"),
+        "Overview": overview,
+        "RunTime": runtime,
+        "SeriesName": item.get("SeriesName"),
+        "SeriesId": item.get("SeriesId"),
+        "SeasonId": item.get("SeasonId"),
+        "Artist": item.get("AlbumArtist"),
+    }
+    for k, v in (item.get("ProviderIds") or {}).items():
+        payload[f"Provider_{str(k).lower()}"] = v
+    if item.get("Type") == "Episode":
+        if item.get("ParentIndexNumber") is not None:
+            payload["SeasonNumber00"] = f"{int(item['ParentIndexNumber']):02d}"
+        if item.get("IndexNumber") is not None:
+            payload["EpisodeNumber00"] = f"{int(item['IndexNumber']):02d}"
+    elif item.get("Type") == "Season" and item.get("IndexNumber") is not None:
+        payload["SeasonNumber00"] = f"{int(item['IndexNumber']):02d}"
+    return payload
+
+
+def process_jellyfin_socket_batch(batch: dict):
+    """
+    Пачка из одного сообщения LibraryChanged: {"added": [ids], "updated": [ids]}.
+    Детали — пакетно (get_items_details), дальше каждый элемент идёт в process_jellyfin_event:
+    добавленные — как ItemAdded (объявление), обновлённые — как ItemUpdated (только перепроверка ожиданий).
+    """
+    added = [i for i in batch.get("added") or [] if i]
+    updated = [i for i in batch.get("updated") or [] if i and i not in added]
+    items = {}
+    ids = added + updated
+    for i in range(0, len(ids), 100):
+        items.update(get_items_details(ids[i:i + 100]))
+    for item_ids, notification_type, types in ((added, "ItemAdded", ("Movie", "Season", "Episode", "MusicAlbum")),
+                                               (updated, "ItemUpdated", ("Movie", "Season", "Episode"))):
+        for item_id in item_ids:
+            item = ((items.get(item_id) or {}).get("Items") or [None])[0]
+            if item and item.get("Type") in types:
+                process_jellyfin_event(_jellyfin_item_to_payload(item, notification_type))
+
+
+def _jellyfin_ws_url() -> str:
+    if JELLYFIN_WS_URL:
+        return JELLYFIN_WS_URL
+    parts = urlsplit(JELLYFIN_BASE_URL)
+    scheme = "wss" if parts.scheme == "https" else "ws"
+    return f"{scheme}://{parts.netloc}{parts.path.rstrip('/')}/socket?api_key={JELLYFIN_API_KEY}&deviceId=jellyfin-notifierr"
+
+
+def _handle_jellyfin_ws_message(msg: dict) -> None:
+    if msg.get("MessageType") != "LibraryChanged":
+        return
+    data = msg.get("Data") or {}
+    added = list(data.get("ItemsAdded") or [])
+    # ItemsUpdated при сканировании летят тысячами — смотрим их, только если есть что перепроверять
+    pending = (RADARR_ENABLED and radarr_pending.count()) or (SONARR_ENABLED and sonarr_pending.count())
+    updated = list(data.get("ItemsUpdated") or []) if PENDING_EVENT_WAKE and pending else []
+    if not added and not updated:
+        return
+    batch = {"added": added, "updated": updated}
+    logging.info(f"Jellyfin socket: LibraryChanged, {len(added)} added / {len(updated)} updated")
+    # Jellyfin сообщает о добавлении до того, как дочитает метаданные — обрабатываем с задержкой
+    if EVENT_QUEUE_ENABLED:
+        enqueue_event("jellyfin_socket", batch, not_before_ts=_now_ts() + JELLYFIN_WS_PROCESS_DELAY_SEC)
+    else:
+        threading.Timer(JELLYFIN_WS_PROCESS_DELAY_SEC, process_jellyfin_socket_batch, args=(batch,)).start()
 
-                logging.info(f"(Album) {artist} – {album_name} ({year}) notification sent.")
-                return "Album notification was sent"
 
-        if item_type == "Movie":
-            logging.info(f"(Movie) {item_name} Notification Was Already Sent")
-        elif item_type == "Season":
-            logging.info(f"(Season) {series_name} {item_name} Notification Was Already Sent")
-        elif item_type == "Episode":
-            logging.info(f"(Episode) {series_name} S{season_num}E{season_epi} Notification Was Already Sent")
-        else:
-            logging.error('Item type not supported')
-        return "Item type not supported."
+def _jellyfin_ws_loop():
+    """Держит соединение с /socket: KeepAlive по ForceKeepAlive, переподключение с экспоненциальной паузой."""
+    url = _jellyfin_ws_url()
+    backoff = 1.0
+    while True:
+        ws = None
+        try:
+            ws = websocket.create_connection(url, timeout=10)
+            logging.info("Jellyfin socket: connected")
+            backoff = 1.0
+            keepalive_every = None
+            next_keepalive = float("inf")
+            ws.settimeout(5)
+            while True:
+                try:
+                    raw = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    raw = None
+                if keepalive_every and time.monotonic() >= next_keepalive:
+                    ws.send(json.dumps({"MessageType": "KeepAlive"}))
+                    next_keepalive = time.monotonic() + keepalive_every
+                if not raw:
+                    continue
+                try:
+                    msg = json.loads(raw)
+                except ValueError:
+                    continue
+                if msg.get("MessageType") == "ForceKeepAlive":
+                    # Data — таймаут сервера в секундах; шлём KeepAlive в два раза чаще
+                    keepalive_every = max(1.0, float(msg.get("Data") or 60) / 2)
+                    next_keepalive = time.monotonic()
+                    continue
+                try:
+                    _handle_jellyfin_ws_message(msg)
+                except Exception as ex:
+                    logging.warning(f"Jellyfin socket: message handling failed: {ex}")
+        except Exception as ex:
+            delay = backoff * (1 + random.random() * 0.25)
+            logging.warning(f"Jellyfin socket: disconnected ({ex}); reconnect in {delay:.0f}s")
+            time.sleep(delay)
+            backoff = min(backoff * 2, JELLYFIN_WS_BACKOFF_MAX_SEC)
+        finally:
+            if ws is not None:
+                try:
+                    ws.close()
+                except Exception:
+                    pass
+
+
+def _start_jellyfin_ws_listener() -> None:
+    if not JELLYFIN_WS_ENABLED:
+        return
+    if websocket is None:
+        logging.warning("JELLYFIN_WS_ENABLED=1, but websocket-client is not installed; socket listener disabled")
+        return
+    threading.Thread(target=_jellyfin_ws_loop, name="jellyfin-socket", daemon=True).start()
+
+
+@app.route("/webhook", methods=["POST"])
+def announce_new_releases_from_jellyfin():
+    try:
+        payload = json.loads(request.data)
+        if EVENT_QUEUE_ENABLED or not is_background_leader():
+            event_id = enqueue_event("jellyfin", payload)
+            logging.info(f"Jellyfin webhook: {payload.get('ItemType')} {payload.get('ItemId')} queued as #{event_id}")
+            return "Accepted", 202
+        return process_jellyfin_event(payload)
 
     # Handle specific HTTP errors
     except HTTPError as http_err:
@@ -4202,15 +6130,239 @@ def announce_new_releases_from_jellyfin():
 def health():
     return "ok", 200
 
-#if __name__ == "__main__":
-#    app.run(host="0.0.0.0", port=5000)
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Внутренние счётчики (пулы HTTP-соединений и т.п.) для диагностики."""
+    return {
+        "process": {"pid": os.getpid(), "leader": is_background_leader()},
+        "http": http_client.stats(),
+        "tmdb_trailer_cache": _tmdb_trailer_cache.stats(),
+        "mdblist_cache": dict(_mdblist_stats),
+        "enrichment": enrichment_stats(),
+        "episode_coalescer": _episode_coalescer.stats(),
+        "provider_index": provider_index.stats(),
+        "announced_items": _announced_items.stats(),
+        "radarr_pending": radarr_pending.stats(),
+        "sonarr_pending": sonarr_pending.stats(),
+    }, 200
+
+
+@app.route("/index/rebuild", methods=["POST"])
+def provider_index_rebuild():
+    """Полная перестройка индекса Series/Movie по внешним ID (обычно не нужна — индекс живёт на дельтах)."""
+    if not _queue_admin_allowed():
+        return "Forbidden", 403
+    try:
+        n = provider_index.rebuild()
+    except Exception as ex:
+        logging.warning(f"Provider index rebuild failed: {ex}")
+        return {"error": str(ex)}, 502
+    return {"items": n}, 200
 
-if __name__ == "__main__":
+#Пропущенные за время простоя элементы: state_meta["catchup_hwm"] — момент, до которого мы точно слушали вебхуки
+_CATCHUP_TYPES = ("Movie", "Season", "Episode", "MusicAlbum")
+
+
+def catch_up_missed_items(hwm: float) -> int:
+    """
+    Элементы, созданные в Jellyfin после hwm (с запасом CATCHUP_OVERLAP_SEC), — от новых к старым,
+    пока DateCreated не опустится до отметки. Уходят в очередь пачками "jellyfin_socket" (как added из /socket:
+    детали одним запросом, Episode сводятся коалесером, повторы отсекает _announced_items),
+    каждая следующая — на CATCHUP_BATCH_INTERVAL_SEC позже. Возвращает число поставленных элементов.
+    """
+    cutoff = hwm - CATCHUP_OVERLAP_SEC
+    found, start_index, page_size = [], 0, 200
+    done = False
+    while not done and len(found) < CATCHUP_MAX_ITEMS:
+        params = {
+            "api_key": JELLYFIN_API_KEY,
+            "IncludeItemTypes": ",".join(_CATCHUP_TYPES),
+            "Recursive": "true",
+            "SortBy": "DateCreated",
+            "SortOrder": "Descending",
+            "Fields": "DateCreated",
+            "EnableImages": "false",
+            "EnableUserData": "false",
+            "StartIndex": start_index,
+            "Limit": page_size,
+        }
+        r = http_client.get(f"{JELLYFIN_BASE_URL}/emby/Items", params=params, timeout=30)
+        r.raise_for_status()
+        page = (r.json() or {}).get("Items") or []
+        for it in page:
+            created = _jf_date_ts(it.get("DateCreated"))
+            if created is None or created <= cutoff:
+                done = True
+                break
+            if it.get("Id"):
+                found.append(it["Id"])
+        done = done or len(page) < page_size
+        start_index += len(page)
+
+    if len(found) >= CATCHUP_MAX_ITEMS:
+        found = found[:CATCHUP_MAX_ITEMS]
+        logging.warning(f"Catch-up: more than {CATCHUP_MAX_ITEMS} items since last run; only the newest are announced")
+    found.reverse()   # объявляем в порядке добавления
+    now = _now_ts()
+    size = max(1, CATCHUP_BATCH_SIZE)
+    for n, i in enumerate(range(0, len(found), size)):
+        enqueue_event("jellyfin_socket", {"added": found[i:i + size], "updated": []},
+                      not_before_ts=now + n * CATCHUP_BATCH_INTERVAL_SEC)
+    return len(found)
+
+
+def _catch_up_loop():
+    """Сначала догоняем простой (до успеха — отметку не двигаем), затем раз в CATCHUP_HEARTBEAT_SEC двигаем её."""
+    hwm = float(state_meta_get("catchup_hwm") or 0)
+    if not hwm:
+        logging.info("Catch-up: first start — only the high-water mark is recorded")
+    delay = 30.0
+    while hwm:
+        try:
+            n = catch_up_missed_items(hwm)
+            logging.info(f"Catch-up: {n} item(s) created since "
+                         f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(hwm))} queued")
+            break
+        except Exception as ex:
+            logging.warning(f"Catch-up failed: {ex}; retry in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 900.0)
+    while True:
+        try:
+            state_meta_set("catchup_hwm", _now_ts())
+        except Exception as ex:
+            logging.warning(f"Catch-up: cannot store high-water mark: {ex}")
+        time.sleep(CATCHUP_HEARTBEAT_SEC)
+
+
+#Фоновые циклы: один процесс-лидер на state_directory (python app.py или gunicorn -w N)
+_leader_lock_fd = None
+_leader_state_lock = threading.Lock()
+_background_started = False
+_election_started = False
+
+
+def is_background_leader() -> bool:
+    return _leader_lock_fd is not None
+
+
+def _try_acquire_leader_lock() -> bool:
+    """Неблокирующий захват LEADER_LOCK_FILE. Блокировку держит ОС: процесс умер — файл свободен."""
+    global _leader_lock_fd
+    fd = os.open(LEADER_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _leader_lock_fd = fd
+    return True
+
+
+def _start_background_loops() -> None:
+    """Всё, что должно работать в одном экземпляре: очередь событий, воркеры Radarr/Sonarr, priming, /socket."""
+    global _background_started
+    if _background_started:
+        return
+    _background_started = True
+    # пока процесс был ведомым, таблицы менял лидер — берём их заново
+    radarr_pending.reload()
+    sonarr_pending.reload()
+    fresh_counts = load_season_counts()
+    with _season_counts_lock:
+        season_counts.clear()
+        season_counts.update(fresh_counts)
+
+    threading.Thread(target=_season_counts_flusher_loop, name="season-counts-flush", daemon=True).start()
+    _ensure_event_workers()   # заодно разбираем то, что осталось в очереди с прошлого запуска
     if RADARR_ENABLED:
         threading.Thread(target=_radarr_worker_loop, name="radarr-qual-worker", daemon=True).start()
     if SONARR_ENABLED:
         threading.Thread(target=_sonarr_worker_loop, name="sonarr-qual-worker", daemon=True).start()
     if SEASON_COUNTS_PRIME_ON_START:
         threading.Thread(target=_prime_season_counts_once, name="season-counts-prime", daemon=True).start()
+    if SEASON_COUNTS_RECONCILE_SEC > 0:
+        threading.Thread(target=_season_counts_reconcile_loop, name="season-counts-reconcile", daemon=True).start()
+    if CATCHUP_ON_START:
+        threading.Thread(target=_catch_up_loop, name="catch-up", daemon=True).start()
+    _start_jellyfin_ws_listener()
+
+
+def _leader_election_loop() -> None:
+    while True:
+        time.sleep(LEADER_RETRY_SEC)
+        with _leader_state_lock:
+            try:
+                if not _try_acquire_leader_lock():
+                    continue
+            except Exception as ex:
+                logging.warning(f"Leader election: cannot lock {LEADER_LOCK_FILE}: {ex}")
+                continue
+            logging.info(f"Leader election: pid {os.getpid()} took over background workers")
+            _start_background_loops()
+            return
+
+
+def start_background_services() -> None:
+    """
+    Процесс, захвативший LEADER_LOCK_FILE, запускает фоновые циклы; остальные только принимают вебхуки
+    (и кладут их в очередь) и ждут, не освободится ли место. Повторные вызовы ничего не делают.
+    python app.py — вызывается при импорте. Под gunicorn — в каждом воркере сразу после fork, из хука
+    post_worker_init в gunicorn.conf.py: с --preload модуль импортирует мастер, и ни блокировка, ни потоки,
+    ни соединение с БД не должны оказаться в нём (блокировку воркер не смог бы отпустить, а fork процесса
+    с потоками небезопасен). Запущен gunicorn без этого файла — выборы пройдут с первым запросом воркера.
+    """
+    global _election_started
+    with _leader_state_lock:
+        if _election_started:
+            return
+        _election_started = True
+        try:
+            leader = _try_acquire_leader_lock()
+        except Exception as ex:
+            logging.warning(f"Leader election: cannot lock {LEADER_LOCK_FILE}: {ex}")
+            leader = False
+        if leader:
+            logging.info(f"Leader election: pid {os.getpid()} runs background workers")
+            _start_background_loops()
+            return
+    logging.info(f"Leader election: pid {os.getpid()} serves webhooks only, waiting for the leader slot")
+    threading.Thread(target=_leader_election_loop, name="leader-election", daemon=True).start()
+
+
+@app.before_request
+def _elect_on_first_request():
+    # запасной путь: gunicorn запущен со своим конфигом, без хука post_worker_init из gunicorn.conf.py
+    if not _election_started:
+        start_background_services()
+
+
+def _exit_on_sigterm(signum, frame):
+    # docker stop / systemd шлют SIGTERM; выходим через SystemExit, чтобы отработали atexit-хуки
+    # (сброс изменённых season_counts, возврат удержанных событий очереди)
+    logging.info(f"SIGTERM received, pid {os.getpid()} shutting down")
+    sys.exit(0)
+
+
+def _install_sigterm_handler() -> None:
+    """python app.py: по умолчанию SIGTERM убивает процесс без atexit. Чужой обработчик не трогаем."""
+    if threading.current_thread() is not threading.main_thread():
+        return
+    if signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+        signal.signal(signal.SIGTERM, _exit_on_sigterm)
+
+
+# под gunicorn выборы — из post_worker_init (gunicorn.conf.py), а SIGTERM обрабатывает сам воркер (и тоже выходит через sys.exit)
+if "gunicorn" not in sys.modules:
+    _install_sigterm_handler()
+    start_background_services()
+
+
+if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
 
@@ -0,0 +1,11 @@
+# Конфиг gunicorn по умолчанию: gunicorn читает ./gunicorn.conf.py сам (gunicorn -w N app:app).
+# Фоновые циклы (очередь событий, Radarr/Sonarr, догонялка, /socket) работают в одном воркере-лидере;
+# выборы проходят в каждом воркере сразу после fork — не в мастере, даже с --preload.
+import sys
+
+
+def post_worker_init(worker):
+    module = sys.modules.get(getattr(worker.wsgi, "import_name", ""))
+    start = getattr(module, "start_background_services", None)
+    if start is not None:
+        start()